@@ -1,18 +1,45 @@
 import time
 import math
+from array import array
 import utime
-from ucollections import namedtuple
+import micropython
+import uasyncio as asyncio
 from urandom import getrandbits
 from machine import SPI
 from machine import Pin
+import LoRaCompression
+import Metrics
+import Trace
+from PicoLogger import LOG_RECEIVED, LOG_SENT, LOG_RELAY, LOG_RADIO, LEVEL_DEBUG, LEVEL_INFO, LEVEL_WARNING
 
 #Constants
 FLAGS_ACK = 0x80
 FLAGS_REPT_SEND = 0x81
 FLAGS_REPT_REPLY = 0x82
+#LoRaTransfer frames, fragments are covered by the per window FLAGS_FRAGMENT_ACK instead of per frame acks
+FLAGS_FRAGMENT = 0x04
+FLAGS_TRANSFER_REQUEST = 0x05
+FLAGS_FRAGMENT_ACK = 0x84
+#Several short messages to one neighbour in one frame, each as header_id, length, data.
+#Answered by one FLAGS_ACK frame packed the same way with the replies
+FLAGS_AGGREGATE = 0x06
+#LoRaRouting route discovery, a broadcast request collecting the path and a reply sent back along it
+FLAGS_ROUTE_REQUEST = 0x07
+FLAGS_ROUTE_REPLY = 0x87
+
+#Data portion compressed, see LoRaCompression. Receivers strip these bits before looking at the flags
+FLAGS_COMPRESSED_DICTIONARY = LoRaCompression.COMPRESSED_DICTIONARY
+FLAGS_COMPRESSED_DEFLATE = LoRaCompression.COMPRESSED_DEFLATE
+FLAGS_COMPRESSION = FLAGS_COMPRESSED_DICTIONARY | FLAGS_COMPRESSED_DEFLATE
+
+#header, relay list and data have to fit the 256 byte FIFO
+MAX_PAYLOAD_LENGTH = 255
 
 BROADCAST_ADDRESS = 255
 
+#on_recv returns this to answer later through LoRa.answer(), the ack waits for it up to reply_wait_ms
+REPLY_LATER = object()
+
 REG_00_FIFO = 0x00
 REG_01_OP_MODE = 0x01
 REG_06_FRF_MSB = 0x06
@@ -32,6 +59,14 @@ REG_21_PREAMBLE_LSB = 0x21
 REG_22_PAYLOAD_LENGTH = 0x22
 REG_26_MODEM_CONFIG3 = 0x26
 
+#Burst read of REG_10_FIFO_RX_CURRENT_ADDR .. REG_1A_PKT_RSSI_VALUE, offsets into the status buffer
+RX_STATUS_LENGTH = 11
+RX_STATUS_CURRENT_ADDR = 1
+RX_STATUS_IRQ_FLAGS = 3
+RX_STATUS_NB_BYTES = 4
+RX_STATUS_SNR = 10
+RX_STATUS_RSSI = 11
+
 REG_4D_PA_DAC = 0x4d
 REG_40_DIO_MAPPING1 = 0x40
 REG_0D_FIFO_ADDR_PTR = 0x0d
@@ -42,6 +77,7 @@ PA_SELECT = 0x80
 
 CAD_DETECTED_MASK = 0x01
 RX_DONE = 0x40
+PAYLOAD_CRC_ERROR = 0x20
 TX_DONE = 0x08
 CAD_DONE = 0x04
 CAD_DETECTED = 0x01
@@ -57,6 +93,24 @@ REG_09_PA_CONFIG = 0x09
 FXOSC = 32000000.0
 FSTEP = (FXOSC / 524288)
 
+PREAMBLE_LENGTH = 8
+#Signal bandwidth in Hz, indexed by the upper nibble of REG_1D_MODEM_CONFIG1
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+def time_on_air_ms(modem_config, payload_length, preamble_length=PREAMBLE_LENGTH):
+    #Airtime of one frame for a ModemConfig entry, from the SX1276 datasheet (section 4.1.1.7)
+    bandwidth = BANDWIDTHS[modem_config[0] >> 4]
+    coding_rate = (modem_config[0] >> 1) & 0x07
+    implicit_header = modem_config[0] & 0x01
+    spreading_factor = modem_config[1] >> 4
+    crc = (modem_config[1] >> 2) & 0x01
+    low_data_rate = (modem_config[2] >> 3) & 0x01
+
+    symbol_ms = (1 << spreading_factor) * 1000.0 / bandwidth
+    payload_symbols = 8 + max(math.ceil((8 * payload_length - 4 * spreading_factor + 28 + 16 * crc - 20 * implicit_header) /
+                                        (4 * (spreading_factor - 2 * low_data_rate))) * (coding_rate + 4), 0)
+    return (preamble_length + 4.25) * symbol_ms + payload_symbols * symbol_ms
+
 class ModemConfig():
     Bw125Cr45Sf128 = (0x72, 0x74, 0x04) #< Bw = 125 kHz, Cr = 4/5, Sf = 128chips/symbol, CRC on. Default medium range
     Bw500Cr45Sf128 = (0x92, 0x74, 0x04) #< Bw = 500 kHz, Cr = 4/5, Sf = 128chips/symbol, CRC on. Fast+short range
@@ -72,12 +126,174 @@ class SPIConfig():
     esp32_1 = (1, 14, 13, 12)
     esp32_2 = (2, 18, 23, 19)
 
+class Packet(object):
+    """
+    One received frame. The rx ring holds a fixed pool of these, the interrupt fills buffer, length,
+    rssi_raw and snr_raw and process_rx decodes the header in place. message is a memoryview into buffer,
+    so it is only valid until the ring comes back around to this slot, use copy() to keep a frame.
+    """
+    __slots__ = ('buffer', 'view', 'length', 'rssi_raw', 'snr_raw', 'header_to', 'header_from', 'header_from_previous',
+                 'header_id', 'header_flags', 'relay_Addresses', 'message', 'rssi', 'snr')
+
+    def __init__(self, size=256):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.rssi_raw = 0
+        self.snr_raw = 0
+        self.header_to = 0
+        self.header_from = 0
+        self.header_from_previous = None
+        self.header_id = 0
+        self.header_flags = 0
+        self.relay_Addresses = []
+        self.message = b''
+        self.rssi = 0
+        self.snr = 0
+
+    def decode(self, freq):
+        #Fills the header fields from buffer, returns False if the frame is too short for its header and relay list
+        snr = self.snr_raw / 4
+        rssi = self.rssi_raw
+
+        if snr < 0:
+            rssi = snr + rssi
+        else:
+            rssi = rssi * 16 / 15
+
+        if freq >= 779:
+            rssi = round(rssi - 157, 2)
+        else:
+            rssi = round(rssi - 164, 2)
+
+        self.rssi = rssi
+        self.snr = snr
+        if self.length < 5:
+            return False
+
+        buffer = self.buffer
+        self.header_to = buffer[0]
+        self.header_from = buffer[1]
+        self.header_id = buffer[2]
+        self.header_flags = buffer[3]
+        relay_Addresses_len = buffer[4]
+        self.header_from_previous = None
+        if 5 + relay_Addresses_len > self.length:
+            return False
+
+        self.relay_Addresses = []
+        for i in range(5, 5 + relay_Addresses_len):
+            self.relay_Addresses.append(buffer[i])
+
+        self.message = self.view[5 + relay_Addresses_len:self.length]
+        return True
+
+    def copy(self):
+        #Detached copy that stays valid after the ring slot is reused
+        packet = Packet(0)
+        packet.length = self.length
+        packet.header_to = self.header_to
+        packet.header_from = self.header_from
+        packet.header_from_previous = self.header_from_previous
+        packet.header_id = self.header_id
+        packet.header_flags = self.header_flags
+        packet.relay_Addresses = list(self.relay_Addresses)
+        packet.message = self.message if type(self.message) == str else bytes(self.message)
+        packet.rssi = self.rssi
+        packet.snr = self.snr
+        return packet
+
+    def __repr__(self):
+        message = self.message if type(self.message) == str else bytes(self.message)
+        return "Payload(message=" + repr(message) + ", header_to=" + str(self.header_to) + ", header_from=" + str(self.header_from) + \
+            ", header_id=" + str(self.header_id) + ", header_flags=" + str(self.header_flags) + ", relay_Addresses=" + str(self.relay_Addresses) + \
+            ", rssi=" + str(self.rssi) + ", snr=" + str(self.snr) + ")"
+
+class DutyCycle(object):
+    """
+    DutyCycle(percent)
+    Rolling one hour airtime budget, kept as the airtime used in each of the last 60 minutes.
+    """
+    def __init__(self, percent):
+        self.budget_ms = int(3600000 * percent / 100)
+        self._used = array('L', [0] * 60)
+        self._minute = array('l', [-1] * 60)
+
+    def used_ms(self):
+        now = int(time.time() // 60)
+        used = 0
+        for i in range(60):
+            if(now - self._minute[i] < 60):
+                used += self._used[i]
+        return used
+
+    def delay_ms(self, airtime_ms):
+        #How long a frame of airtime_ms has to wait until it fits in the budget, 0 if it can go now
+        now = time.time()
+        over = self.used_ms() + airtime_ms - self.budget_ms
+        if(over <= 0):
+            return 0
+        #Free the oldest minutes until enough airtime has expired
+        for age in range(59, -1, -1):
+            minute = int(now // 60) - age
+            i = minute % 60
+            if(self._minute[i] == minute):
+                over -= self._used[i]
+                if(over <= 0):
+                    return int(((minute + 60) * 60 - now) * 1000)
+        return 3600000
+
+    def record(self, airtime_ms):
+        minute = int(time.time() // 60)
+        i = minute % 60
+        if(self._minute[i] != minute):
+            self._minute[i] = minute
+            self._used[i] = 0
+        self._used[i] += int(airtime_ms)
+
+class PendingSend(object):
+    #One reliable send waiting for its ack, kept in LoRa._pending under (header_to, header_id)
+    __slots__ = ('data', 'header_to', 'header_id', 'header_flags', 'relay_Addresses', 'retries', 'attempts',
+                 'sent_at', 'deadline', 'done', 'result', 'on_done')
+
+    def __init__(self, data, header_to, header_id, header_flags, relay_Addresses, retries, on_done):
+        self.data = data
+        self.header_to = header_to
+        self.header_id = header_id
+        self.header_flags = header_flags
+        self.relay_Addresses = relay_Addresses
+        self.retries = retries
+        self.attempts = 0
+        self.sent_at = 0
+        self.deadline = 0
+        self.done = False
+        self.result = None
+        self.on_done = on_done
+
+#RelayTransaction.state
+RELAY_FORWARDING = 0 #our copy is on its way to the next hop
+RELAY_WAITING = 1 #next hop has it, waiting for the reply to come back along the path
+RELAY_RETURNING = 2 #reply (or failure notice) on its way to the previous hop
+RELAY_DONE = 3 #kept until deadline so retransmissions of the frame are not relayed twice
+
+class RelayTransaction(object):
+    #One frame this node relays, kept in LoRa._relays under (origin, header_id)
+    __slots__ = ('payload', 'message', 'state', 'deadline')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.message = None
+        self.state = RELAY_FORWARDING
+        self.deadline = 0
+
 class LoRa(object):
     def __init__(self, spi_channel, interrupt, this_address, cs_pin, pico_logger, reset_pin=None, freq=433.3, tx_power=14,
-                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None):
+                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None,
+                 deferred_rx=False, rx_slots=4, schedule_rx=False, duty_cycle=None, compress=False):
         """
         Lora(channel, interrupt, this_address, cs_pin, reset_pin=None, freq=868.0, tx_power=14,
-                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None)
+                 modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False, acks=False, crypto=None,
+                 deferred_rx=False, rx_slots=4, schedule_rx=False, duty_cycle=None, compress=False)
         channel: SPI channel, check SPIConfig for preconfigured names
         interrupt: GPIO interrupt pin
         this_address: set address for this device [0-254]
@@ -89,6 +305,12 @@ class LoRa(object):
         receive_all: if True, don't filter packets on address
         acks: if True, request acknowledgments
         crypto: if desired, an instance of ucrypto AES (https://docs.pycom.io/firmwareapi/micropython/ucrypto/) - not tested
+        deferred_rx: if True, the interrupt only copies frames into the rx ring and process_rx() must be called from the main loop
+        rx_slots: number of frames the rx ring can hold before frames are dropped (counted in rx_dropped)
+        schedule_rx: if True (and deferred_rx), the interrupt also queues process_rx() with micropython.schedule
+        duty_cycle: optional airtime budget in percent per hour, frames that would exceed it are deferred
+        compress: if True, the data of every frame is sent compressed when that makes it shorter
+                  (compressed frames are always understood, whatever this is set to)
         """
         
         self._spi_channel = spi_channel
@@ -106,17 +328,86 @@ class LoRa(object):
         self._this_address = this_address
         self._last_header_id = 0
 
-        self._last_payload = None
-        self._last_relay_payload = None
+        self._pending = {}
         self.crypto = crypto
+        self.compress = compress
+        self.compressed_frames = 0
+        self.compression_saved_bytes = 0
+        self.compression_saved_ms = 0
 
         self.cad_timeout = 0
         self.send_retries = 2
-        self.wait_packet_sent_timeout = 0.2
-        self.retry_timeout = 0.3
+        self.wait_packet_sent_timeout = 0.2 #margin on top of the frame's airtime
+        self.retry_timeout = 0.3 #margin for the peer to answer until its round trip time has been measured
+        self.max_retry_timeout = 30
+
+        # smoothed round trip time per neighbour, address -> [srtt_ms, rttvar_ms, samples]
+        self._rtt = {}
+        # backed off retransmission timeout per neighbour, kept until a first try is acked (RFC 6298 5.7)
+        self._rto_backoff = {}
+
+        # queue_send holds direct messages up to aggregate_hold_ms (0 sends at once) so messages
+        # to the same neighbour share a FLAGS_AGGREGATE frame of at most aggregate_max_length bytes
+        # header_to -> [deadline, [PendingSend], length]
+        self.aggregate_hold_ms = 0
+        self.aggregate_max_length = 200
+        self.aggregated_messages = 0
+        self._outbox = {}
+
+        self.duty_cycle = DutyCycle(duty_cycle) if duty_cycle else None
+        self.airtime_total_ms = 0
+        self.tx_deferred = 0
+        self._tx_start = 0
+        self._tx_airtime_ms = 0
+        # acks and replies from send_soon waiting for the frame on air, sent by poll_pending
+        self._tx_queue = []
+
+        # recently acked frames, (header_from, header_id, header_flags) -> [ticks_ms, reply]
+        # a retransmission inside duplicate_ttl is answered with the cached reply
+        self.duplicate_ttl = 10
+        self.duplicate_cache_size = 16
+        self.duplicates = 0
+        self._seen = {}
+
+        # replies on_recv promised with REPLY_LATER, (origin, header_id) -> [deadline, on_reply(reply)]
+        # no_reply is acked instead when answer() does not come within reply_wait_ms
+        self.reply_wait_ms = 1000
+        self.no_reply = "4" #warning 4, the message made it but nobody replied
+        self._replies_due = {}
 
         self.pico_logger = pico_logger
-        self.relay_payload = None
+
+        # frames to relay, queued by process_rx and worked off by relay_check_repeat without blocking
+        # (origin, header_id) -> RelayTransaction
+        self.max_relays = 8
+        self._relay_inbox = []
+        self._relays = {}
+        # our own relayed sends waiting for the reply, header_id -> [deadline, on_done(result), header_to, ticks_ms sent]
+        self._relay_replies = {}
+
+        # rx ring, filled by _handle_interrupt and drained by process_rx
+        # one slot is always kept free so head == tail means empty
+        self._deferred_rx = deferred_rx
+        self.schedule_rx = schedule_rx
+        self._rx_size = rx_slots + 1
+        self._rx_packets = [Packet() for _ in range(self._rx_size)]
+        self._rx_head = 0
+        self._rx_tail = 0
+        self._rx_busy = False
+        self.rx_dropped = 0
+        self._rx_dropped_logged = 0
+        self._process_rx_ref = self._scheduled_process_rx
+
+        # optional hooks: rx_event and tx_event are set() from the interrupt (see AsyncLoRa),
+        # on_frame(packet) is called by process_rx for every frame addressed to this node
+        self.rx_event = None
+        self.tx_event = None
+        self.on_frame = None
+        # header_flags -> handler(packet) for frames addressed to this node that bypass the
+        # ack/on_recv path, see LoRaTransfer
+        self.flag_handlers = {}
+        # optional LoRaRouting.Router, learns routes from every frame heard and drops routes over failed links
+        self.router = None
         #Setup the module
         #gpio_interrupt = Pin(self._interrupt, Pin.IN, Pin.PULL_DOWN)
         gpio_interrupt = Pin(self._interrupt, Pin.IN)
@@ -137,6 +428,25 @@ class LoRa(object):
         # cs gpio pin
         self.cs = Pin(self._cs_pin, Pin.OUT)
         self.cs.value(1)
+
+        # preallocated spi buffers (register byte + a full FIFO) and the views used per transaction
+        self._spi_out = bytearray(257)
+        self._spi_in = bytearray(257)
+        self._spi_out_view = memoryview(self._spi_out)
+        self._spi_in_view = memoryview(self._spi_in)
+        self._spi_single_out = self._spi_out_view[:2]
+        self._spi_single_in = self._spi_in_view[:2]
+
+        # the interrupt gets its own buffers so it never clobbers a transaction the main loop is building
+        self._isr_out = bytearray(RX_STATUS_LENGTH + 1)
+        self._isr_in = bytearray(RX_STATUS_LENGTH + 1)
+        self._isr_out_view = memoryview(self._isr_out)
+        self._isr_register_view = self._isr_out_view[:1]
+        self._isr_single_out = self._isr_out_view[:2]
+
+        # last value written to each configuration register, _shadow_valid marks which ones are known
+        self._shadow = bytearray(0x80)
+        self._shadow_valid = bytearray(0x80)
         
         # set mode
         self._spi_write(REG_01_OP_MODE, MODE_SLEEP | LONG_RANGE_MODE)
@@ -147,26 +457,23 @@ class LoRa(object):
             "LoRa initialization failed"
 
         self.pico_logger.WriteNewLog("LoRa Set!")
-        self._spi_write(REG_0E_FIFO_TX_BASE_ADDR, 0)
-        self._spi_write(REG_0F_FIFO_RX_BASE_ADDR, 0)
+        # FIFO tx and rx base address
+        self._spi_write(REG_0E_FIFO_TX_BASE_ADDR, (0, 0))
         
         self.set_mode_idle()
 
-        # set modem config (Bw125Cr45Sf128)
-        self._spi_write(REG_1D_MODEM_CONFIG1, self._modem_config[0])
-        self._spi_write(REG_1E_MODEM_CONFIG2, self._modem_config[1])
-        self._spi_write(REG_26_MODEM_CONFIG3, self._modem_config[2])
-
-        # set preamble length (8)
-        self._spi_write(REG_20_PREAMBLE_MSB, 0)
-        self._spi_write(REG_21_PREAMBLE_LSB, 8)
+        # modem config, preamble, frequency and tx power
+        for register, values in self._config_registers():
+            self._write_registers_cached(register, values)
+        
+    def on_recv(self, message):
+        # This should be overridden by the user
+        pass
 
+    def _config_registers(self):
         # set frequency
         frf = int((self._freq * 1000000.0) / FSTEP)
-        self._spi_write(REG_06_FRF_MSB, (frf >> 16) & 0xff)
-        self._spi_write(REG_07_FRF_MID, (frf >> 8) & 0xff)
-        self._spi_write(REG_08_FRF_LSB, frf & 0xff)
-        
+
         # Set tx power
         if self._tx_power < 5:
             self._tx_power = 5
@@ -174,39 +481,105 @@ class LoRa(object):
             self._tx_power = 23
 
         if self._tx_power < 20:
-            self._spi_write(REG_4D_PA_DAC, PA_DAC_ENABLE)
-            self._tx_power -= 3
+            pa_dac = PA_DAC_ENABLE
+            pa_config = PA_SELECT | (self._tx_power - 3 - 5)
         else:
-            self._spi_write(REG_4D_PA_DAC, PA_DAC_DISABLE)
+            pa_dac = PA_DAC_DISABLE
+            pa_config = PA_SELECT | (self._tx_power - 5)
+
+        return (
+            (REG_06_FRF_MSB, ((frf >> 16) & 0xff, (frf >> 8) & 0xff, frf & 0xff)),
+            (REG_09_PA_CONFIG, (pa_config,)),
+            (REG_1D_MODEM_CONFIG1, self._modem_config[0:2]),
+            (REG_20_PREAMBLE_MSB, (PREAMBLE_LENGTH >> 8, PREAMBLE_LENGTH & 0xff)),
+            (REG_26_MODEM_CONFIG3, self._modem_config[2:3]),
+            (REG_4D_PA_DAC, (pa_dac,)),
+        )
+
+    def _write_registers_cached(self, register, values):
+        #Writes only the span of contiguous registers that differs from the shadow copy, returns how many were written
+        first = None
+        last = None
+        for i in range(len(values)):
+            if(not self._shadow_valid[register + i] or self._shadow[register + i] != values[i]):
+                if(first is None):
+                    first = i
+                last = i
+        if(first is None):
+            return 0
+
+        self._spi_write(register + first, values[first:last + 1])
+        for i in range(first, last + 1):
+            self._shadow[register + i] = values[i]
+            self._shadow_valid[register + i] = 1
+        return last - first + 1
+
+    def reconfigure(self, freq=None, tx_power=None, modem_config=None, this_address=None):
+        """
+        Retunes the radio in place without resetting the chip or dropping the rx ring.
+        Only registers whose value changed are written, returns how many registers that was.
+        """
+        if this_address is not None:
+            self._this_address = this_address
+        if freq is not None:
+            self._freq = freq
+        if tx_power is not None:
+            self._tx_power = tx_power
+        if modem_config is not None:
+            self._modem_config = modem_config
+
+        changed = []
+        for register, values in self._config_registers():
+            for i in range(len(values)):
+                if(not self._shadow_valid[register + i] or self._shadow[register + i] != values[i]):
+                    changed.append((register, values))
+                    break
+        if(len(changed) == 0):
+            return 0
 
-        self._spi_write(REG_09_PA_CONFIG, PA_SELECT | (self._tx_power - 5))
-        
-    def on_recv(self, message):
-        # This should be overridden by the user
-        pass
+        # frequency and modem settings may only change in sleep or standby
+        self.wait_packet_sent()
+        mode = self._mode
+        self.set_mode_idle()
+
+        written = 0
+        for register, values in changed:
+            written += self._write_registers_cached(register, values)
+
+        if(mode == MODE_RXCONTINUOUS):
+            self.set_mode_rx()
+        self.pico_logger.WriteNewLog("LoRa reconfigured: freq " + str(self._freq) + "\ttx_power " + str(self._tx_power) + "\tmodem_config " + str(self._modem_config) + "\tregisters written: " + str(written))
+        return written
 
     def sleep(self):
         if self._mode != MODE_SLEEP:
             self._spi_write(REG_01_OP_MODE, MODE_SLEEP)
             self._mode = MODE_SLEEP
+            Trace.record(Trace.MODE, MODE_SLEEP)
 
     def set_mode_tx(self):
         if self._mode != MODE_TX:
             self._spi_write(REG_01_OP_MODE, MODE_TX)
             self._spi_write(REG_40_DIO_MAPPING1, 0x40)  # Interrupt on TxDone
             self._mode = MODE_TX
+            Trace.record(Trace.MODE, MODE_TX)
 
     def set_mode_rx(self):
+        #A frame still on air is not cut short, the TxDone interrupt switches to rx after it
+        if self._transmitting():
+            return
         if self._mode != MODE_RXCONTINUOUS:
             self._spi_write(REG_01_OP_MODE, MODE_RXCONTINUOUS)
             self._spi_write(REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
             self._mode = MODE_RXCONTINUOUS
+            Trace.record(Trace.MODE, MODE_RXCONTINUOUS)
             
     def set_mode_cad(self):
         if self._mode != MODE_CAD:
             self._spi_write(REG_01_OP_MODE, MODE_CAD)
             self._spi_write(REG_40_DIO_MAPPING1, 0x80)  # Interrupt on CadDone
             self._mode = MODE_CAD
+            Trace.record(Trace.MODE, MODE_CAD)
 
     def _is_channel_active(self):
         self.set_mode_cad()
@@ -231,82 +604,410 @@ class LoRa(object):
             else:
                 return status
 
+    def airtime_ms(self, payload_length):
+        return time_on_air_ms(self._modem_config, payload_length)
+
+    def tx_remaining_ms(self):
+        #Time left before the frame being transmitted is overdue (airtime + wait_packet_sent_timeout)
+        elapsed = time.ticks_diff(time.ticks_ms(), self._tx_start)
+        return int(self._tx_airtime_ms + self.wait_packet_sent_timeout * 1000) - elapsed
+
+    def _transmitting(self):
+        #True until TxDone, or until the frame is overdue when the interrupt got lost
+        return self._mode == MODE_TX and self.tx_remaining_ms() > 0
+
+    def tx_busy_ms(self):
+        #Airtime left of the frame being transmitted, 0 once the radio is free
+        if(not self._transmitting()):
+            return 0
+        return max(0, int(self._tx_airtime_ms) - time.ticks_diff(time.ticks_ms(), self._tx_start))
+
+    def tx_delay_ms(self, payload_length):
+        #How long a frame has to be held back to stay inside the duty cycle budget
+        if(self.duty_cycle is None):
+            return 0
+        return self.duty_cycle.delay_ms(self.airtime_ms(payload_length))
+
     def wait_packet_sent(self):
         # wait for `_handle_interrupt` to switch the mode back
-        start = time.time()
-        while time.time() - start < self.wait_packet_sent_timeout:
-            if self._mode != MODE_TX:
-                return True
+        while self._mode == MODE_TX:
+            if self.tx_remaining_ms() <= 0:
+                return False
 
-        return False
+        return True
 
     def set_mode_idle(self):
         if self._mode != MODE_STDBY:
             self._spi_write(REG_01_OP_MODE, MODE_STDBY)
             self._mode = MODE_STDBY
-
-    def send(self, data, header_to, header_id=0, header_flags=0, relay_Addresses = None):
-        self.pico_logger.WriteNewLog("LoRaSending Message: " + str(data) + "\tTo " + str(header_to) + "\t relay: " + str(relay_Addresses))
-        #utime.sleep(0.2)
-        #Just so we dont send messages while its transmitting
-        self.wait_packet_sent()
+            Trace.record(Trace.MODE, MODE_STDBY)
+
+    def send(self, data, header_to, header_id=0, header_flags=0, relay_Addresses = None, log = True):
+        if(log and self.pico_logger.Enabled(LEVEL_DEBUG, LOG_SENT)):
+            self.pico_logger.Log(LEVEL_DEBUG, LOG_SENT, header_to, "LoRaSending Message: %s\tTo %s\t relay: %s", data if type(data) == str else bytes(data), header_to, relay_Addresses)
+        #Never waits for the frame on air, the caller tries again later or uses send_soon
+        if(self._transmitting()):
+            return False
         self.set_mode_idle()
         self.wait_cad()
 
         header = [header_to, self._this_address, header_id, header_flags]
         self.relay_list_to_number(relay_Addresses, header)
         if type(data) == int:
-            data = [data]
-        elif type(data) == bytes:
-            data = [p for p in data]
+            data = bytes((data,))
         elif type(data) == str:
-            data = [ord(s) for s in data]
+            data = data.encode()
+
+        if(self.compress and len(data) > 1):
+            compression, compressed = LoRaCompression.compress(data)
+            if(compression):
+                saved_ms = self.airtime_ms(len(header) + len(data)) - self.airtime_ms(len(header) + len(compressed))
+                self.compressed_frames += 1
+                self.compression_saved_bytes += len(data) - len(compressed)
+                self.compression_saved_ms += saved_ms
+                header[3] = header_flags | compression
+                data = compressed
 
         if self.crypto:
-            data = [b for b in self._encrypt(bytes(data))]
+            data = self._encrypt(bytes(data))
+
+        payload_length = len(header) + len(data)
+        if(payload_length > MAX_PAYLOAD_LENGTH):
+            raise ValueError("LoRa frame of " + str(payload_length) + " bytes does not fit the FIFO, use LoRaTransfer")
+        airtime = self.airtime_ms(payload_length)
+        if(self.duty_cycle is not None):
+            if(self.duty_cycle.delay_ms(airtime) > 0):
+                self.tx_deferred += 1
+                Metrics.count(Metrics.TX_DEFERRED)
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RADIO, header_to, "LoRa duty cycle budget used up, frame to %s deferred", header_to)
+                return False
+            self.duty_cycle.record(airtime)
         
-        payload = header + data
         self._spi_write(REG_0D_FIFO_ADDR_PTR, 0)
-        self._spi_write(REG_00_FIFO, payload)
-        self._spi_write(REG_22_PAYLOAD_LENGTH, len(payload))
-        
+        self._spi_write_fifo(header, data)
+        self._spi_write(REG_22_PAYLOAD_LENGTH, payload_length)
+        Trace.record(Trace.SEND, payload_length)
+
+        self._tx_airtime_ms = airtime
+        self._tx_start = time.ticks_ms()
+        self.airtime_total_ms += airtime
+        Metrics.count(Metrics.TX_FRAMES)
+        Metrics.count(Metrics.TX_AIRTIME_MS, int(airtime))
         self.set_mode_tx()
         return True
 
+    def send_soon(self, data, header_to, header_id=0, header_flags=0, relay_Addresses=None, log=True):
+        #send() for acks and replies, held for poll_pending while another frame is on air instead of waiting for it
+        if(len(self._tx_queue) > 0 or self._transmitting()):
+            self._tx_queue.append((data, header_to, header_id, header_flags, relay_Addresses, log))
+            return
+        self.send(data, header_to, header_id, header_flags, relay_Addresses, log)
+        self.set_mode_rx()
+
+    def _flush_tx_queue(self):
+        #One frame per TxDone, the rest wait for the next poll
+        if(len(self._tx_queue) == 0 or self._transmitting()):
+            return
+        frame = self._tx_queue.pop(0)
+        self.send(frame[0], frame[1], frame[2], frame[3], frame[4], frame[5])
+        self.set_mode_rx()
+
     def send_to_wait(self, data, header_to, header_flags=0, retries=3, headerId = 0):
-        if(headerId != 0):
-            self._last_header_id = headerId
-        else:
-            self._last_header_id = self.get_new_header_id()
+        entry = self.start_send(data, header_to, header_flags=header_flags, retries=retries, header_id=headerId)
+        self.wait_pending(entry)
+        if entry.result:
+            return entry.result
+        return "1." + str(header_to) +".LoRa Could not Contact"
+
+    def start_send(self, data, header_to, header_flags=0, retries=3, header_id=0, relay_Addresses=None, on_done=None):
+        """
+        Sends data and registers it in the pending table without waiting for the ack.
+        Any number of these can be outstanding, process_rx matches acks against the table and
+        poll_pending retransmits. on_done(entry) is called once entry.result is known:
+        the reply Packet (direct) or True (relay) on success, None on failure.
+        """
+        if(header_id == 0):
+            header_id = self.get_new_header_id()
+
+        entry = PendingSend(data, header_to, header_id, header_flags, relay_Addresses, retries, on_done)
+        self._start_pending(entry)
+        return entry
+
+    def _start_pending(self, entry):
+        if entry.header_to == BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
+            self.send_soon(entry.data, entry.header_to, entry.header_id, entry.header_flags, entry.relay_Addresses)
+            self._finish_pending(entry, True)
+            return
+
+        key = (entry.header_to, entry.header_id)
+        previous = self._pending.get(key)
+        if(previous is not None):
+            self.pico_logger.Log(LEVEL_INFO, LOG_SENT, 0, "Pending send replaced: %s", key)
+            self._finish_pending(previous, None)
+        #Transmit before registering so a frame send() rejects is not retried by poll_pending
+        self._transmit_pending(entry)
+        self._pending[key] = entry
 
-        for _ in range(retries + 1):
-            self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags)
+    def queue_send(self, data, header_to, retries=3, header_id=0, on_done=None):
+        """
+        start_send for a direct message that may wait up to aggregate_hold_ms for other messages to
+        header_to, they then go out together in one FLAGS_AGGREGATE frame with a single ack.
+        Returns the PendingSend, entry.result and on_done(entry) work as for start_send.
+        """
+        if(header_id == 0):
+            header_id = self.get_new_header_id()
+        length = 2 + len(self._data_bytes(data))
+        if(self.aggregate_hold_ms <= 0 or header_to == BROADCAST_ADDRESS or length > self.aggregate_max_length):
+            return self.start_send(data, header_to, retries=retries, header_id=header_id, on_done=on_done)
+
+        entry = PendingSend(data, header_to, header_id, 0, None, retries, on_done)
+        batch = self._outbox.get(header_to)
+        if(batch is not None and batch[2] + length > self.aggregate_max_length):
+            self._flush_outbox(header_to)
+            batch = None
+        if(batch is None):
+            batch = [time.ticks_add(time.ticks_ms(), self.aggregate_hold_ms), [], 0]
+            self._outbox[header_to] = batch
+        batch[1].append(entry)
+        batch[2] += length
+        return entry
+
+    def _data_bytes(self, data):
+        if type(data) == int:
+            return bytes((data,))
+        if type(data) == str:
+            return data.encode()
+        return data
+
+    def _flush_outbox(self, header_to):
+        entries = self._outbox.pop(header_to)[1]
+        if(len(entries) == 1):
+            self._start_pending(entries[0])
+            return
+
+        data = bytearray()
+        retries = 0
+        for entry in entries:
+            message = self._data_bytes(entry.data)
+            data.append(entry.header_id)
+            data.append(len(message))
+            data.extend(message)
+            retries = max(retries, entry.retries)
+        self.aggregated_messages += len(entries)
+        aggregate = PendingSend(data, header_to, self.get_new_header_id(), FLAGS_AGGREGATE, None, retries,
+                                lambda aggregate: self._aggregate_done(aggregate, entries))
+        self._start_pending(aggregate)
+
+    def _aggregate_done(self, aggregate, entries):
+        #Hands every queued message its part of the aggregated ack
+        replies = {}
+        if(aggregate.result is not None):
+            for header_id, message in self._split_aggregate(aggregate.result.message):
+                replies[header_id] = message
+        for entry in entries:
+            result = None
+            if(entry.header_id in replies):
+                result = aggregate.result.copy()
+                result.header_id = entry.header_id
+                result.message = bytes(replies[entry.header_id])
+                if(entry.data == "H"):
+                    result.message = self.convert_lora_rssi_snr(result.message[2:])
+            entry.attempts = aggregate.attempts
+            entry.done = True
+            entry.result = result
+            if(entry.on_done is not None):
+                entry.on_done(entry)
+
+    def _split_aggregate(self, message):
+        #[(header_id, data)] from header_id, length, data records, a truncated record ends the list
+        records = []
+        position = 0
+        while position + 2 <= len(message):
+            end = position + 2 + message[position + 1]
+            if(end > len(message)):
+                break
+            records.append((message[position], message[position + 2:end]))
+            position = end
+        return records
+
+    def _aggregate_packets(self, packet):
+        #One detached packet per message of an aggregate frame, as if each had come on its own
+        packets = []
+        for header_id, message in self._split_aggregate(packet.message):
+            sub_packet = packet.copy()
+            sub_packet.header_id = header_id
+            sub_packet.header_flags = 0
+            sub_packet.message = bytes(message)
+            packets.append(sub_packet)
+        return packets
+
+    def _transmit_pending(self, entry):
+        if(not self.send(entry.data, entry.header_to, header_id=entry.header_id, header_flags=entry.header_flags, relay_Addresses=entry.relay_Addresses)):
+            #Another frame on air or deferred by the duty cycle, try again once it's done without using up a retry
             self.set_mode_rx()
+            entry.deadline = time.ticks_add(time.ticks_ms(), max(self.tx_delay_ms(self._frame_length(entry)), self.tx_busy_ms(), 1))
+            return
+        entry.attempts += 1
+        if(entry.attempts > 1):
+            Metrics.count(Metrics.SEND_RETRIES)
+            Trace.record(Trace.RETRY, (entry.header_to << 8) | entry.attempts)
+        self.set_mode_rx()
+        entry.sent_at = self._tx_start
+        entry.deadline = time.ticks_add(time.ticks_ms(), self._ack_timeout_ms(entry))
+
+    def _frame_length(self, entry):
+        relay_length = 0 if entry.relay_Addresses is None else len(entry.relay_Addresses)
+        data_length = 1 if type(entry.data) == int else len(entry.data)
+        return 5 + relay_length + data_length
+
+    def _ack_timeout_ms(self, entry):
+        #Exponential backoff on the neighbour's retransmission timeout, with up to half a timeout of jitter
+        timeout = self.retransmission_timeout_ms(entry.header_to, self._frame_length(entry))
+        timeout = min(timeout << (entry.attempts - 1), int(self.max_retry_timeout * 1000))
+        timeout += timeout * getrandbits(8) >> 9
+        if(entry.header_flags == FLAGS_AGGREGATE):
+            #The receiver acks once on_recv has replied to every message in the frame, each may take
+            #up to its reply_wait_ms (taken to be the same as ours)
+            timeout += len(self._split_aggregate(entry.data)) * self.reply_wait_ms
+        return timeout
+
+    def retransmission_timeout_ms(self, address, frame_length):
+        """
+        srtt + 4 * rttvar for a neighbour we have measured (RFC 6298), otherwise both frames' airtime
+        plus retry_timeout. Never less than the airtime of our frame and an equally long ack, nor than
+        the backed off timeout of the last send that needed retries.
+        """
+        airtime = int(2 * self.airtime_ms(frame_length))
+        rtt = self._rtt.get(address)
+        if(rtt is None):
+            timeout = airtime + int(self.retry_timeout * 1000)
+        else:
+            timeout = max(rtt[0] + 4 * rtt[1], airtime)
+        return max(timeout, self._rto_backoff.get(address, 0))
 
-            if header_to == BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
-                return True
+    def _sample_rtt(self, address, rtt_ms):
+        rtt = self._rtt.get(address)
+        if(rtt is None):
+            self._rtt[address] = [rtt_ms, rtt_ms >> 1, 1]
+            return
+        rtt[1] = (3 * rtt[1] + abs(rtt[0] - rtt_ms)) >> 2
+        rtt[0] = (7 * rtt[0] + rtt_ms) >> 3
+        rtt[2] += 1
+
+    def rtt_stats(self):
+        #address:srtt/rttvar/samples for every neighbour, separated by ';'
+        stats = []
+        for address in self._rtt:
+            rtt = self._rtt[address]
+            stats.append(str(address) + ":" + str(rtt[0]) + "/" + str(rtt[1]) + "/" + str(rtt[2]))
+        return ";".join(stats)
+
+    def _finish_pending(self, entry, result):
+        if(entry.done):
+            return
+        entry.done = True
+        entry.result = result
+        #Karn: a retried send can't tell which transmission was acked, so only first tries are sampled
+        if(entry.header_to != BROADCAST_ADDRESS):
+            Metrics.count(Metrics.ACK_FAILED if result is None else Metrics.ACK_OK)
+            Metrics.observe(Metrics.SEND_ATTEMPTS, entry.attempts)
+        if(result is not None and entry.attempts == 1 and entry.header_to != BROADCAST_ADDRESS):
+            rtt_ms = time.ticks_diff(time.ticks_ms(), entry.sent_at)
+            Metrics.observe(Metrics.ACK_RTT_MS, rtt_ms)
+            self._sample_rtt(entry.header_to, rtt_ms)
+            self._rto_backoff.pop(entry.header_to, None)
+        elif(entry.attempts > 1 and entry.header_to != BROADCAST_ADDRESS and entry.header_flags != FLAGS_AGGREGATE):
+            #Without a sample the next send starts from the timeout that was last waited for, so a slow
+            #neighbour gets answered on the first try and measured instead of always being retried
+            timeout = self.retransmission_timeout_ms(entry.header_to, self._frame_length(entry))
+            self._rto_backoff[entry.header_to] = min(timeout << (entry.attempts - 1), int(self.max_retry_timeout * 1000))
+        if(self._pending.get((entry.header_to, entry.header_id)) is entry):
+            del self._pending[(entry.header_to, entry.header_id)]
+        if(result is None):
+            Trace.record(Trace.ACK_TIMEOUT, entry.header_to)
+            if(self.router is not None):
+                self.router.link_failed(entry.header_to)
+            if(entry.relay_Addresses is None):
+                self.pico_logger.Log(LEVEL_WARNING, LOG_SENT, entry.header_to, "1.%s.LoRa Could not Contact", entry.header_to)
+            else:
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, entry.header_to, "ACK: Failed")
+        if(entry.on_done is not None):
+            entry.on_done(entry)
+
+    def poll_pending(self):
+        #Retransmits (or gives up on) every pending send whose ack timer ran out, sends held messages that are due
+        self._flush_tx_queue()
+        now = time.ticks_ms()
+        for header_to in list(self._outbox):
+            if(time.ticks_diff(now, self._outbox[header_to][0]) >= 0):
+                self._flush_outbox(header_to)
+        for key in list(self._replies_due):
+            if(time.ticks_diff(now, self._replies_due[key][0]) >= 0):
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RECEIVED, key[0], "No reply for %s from %s in time", key[1], key[0])
+                self._replies_due.pop(key)[1](self.no_reply)
+        if(len(self._pending) == 0):
+            return
+        for entry in list(self._pending.values()):
+            if(entry.done or time.ticks_diff(now, entry.deadline) < 0):
+                continue
+            if(entry.attempts > entry.retries):
+                self._finish_pending(entry, None)
+            else:
+                self._transmit_pending(entry)
+
+    def next_pending_ms(self, default_ms=100):
+        #Milliseconds until the earliest ack timer runs out, so async callers know how long they may sleep
+        wait_ms = default_ms
+        now = time.ticks_ms()
+        for entry in self._pending.values():
+            wait_ms = min(wait_ms, max(0, time.ticks_diff(entry.deadline, now)))
+        for batch in self._outbox.values():
+            wait_ms = min(wait_ms, max(0, time.ticks_diff(batch[0], now)))
+        for due in self._replies_due.values():
+            wait_ms = min(wait_ms, max(0, time.ticks_diff(due[0], now)))
+        if(len(self._tx_queue) > 0):
+            #TxDone does not wake the rx wait, sleep for the rest of the airtime instead
+            wait_ms = min(wait_ms, max(self.tx_busy_ms(), 1))
+        return wait_ms
+
+    def wait_pending(self, entry):
+        while not entry.done:
+            self.process_rx()
+            self.poll_pending()
+        return entry.result
+
+    def _match_pending(self, packet, overheard=False):
+        #Completes the pending send this packet acknowledges, returns True if there was one
+        entry = self._pending.get((packet.header_from, packet.header_id))
+        if(entry is None):
+            return False
+
+        if(entry.relay_Addresses is None):
+            if(overheard or packet.header_to != self._this_address or packet.header_flags != FLAGS_ACK):
+                return False
+            if(self.pico_logger.Enabled(LEVEL_DEBUG, LOG_RECEIVED)):
+                #packet is an rx ring slot, the log gets its text before the slot is reused
+                self.pico_logger.Log(LEVEL_DEBUG, LOG_RECEIVED, packet.header_from, "Direct Message Reply: %s", str(packet))
+            result = packet.copy()
+            if(entry.data == "H"):
+                result.message = self.convert_lora_rssi_snr(result.message[2:])
+        else:
+            #The next hop either repeats our frame onwards (overheard) or replies straight back to us
+            if(overheard and packet.header_flags != FLAGS_REPT_SEND and packet.header_flags != FLAGS_REPT_REPLY):
+                return False
+            if(not overheard and (packet.header_to != self._this_address or packet.header_flags != FLAGS_REPT_REPLY)):
+                return False
+            if(self.pico_logger.Enabled(LEVEL_DEBUG, LOG_RELAY)):
+                self.pico_logger.Log(LEVEL_DEBUG, LOG_RELAY, packet.header_from, "ACK: %s", str(packet))
+            result = True
 
-            start = time.time()
-            while time.time() - start < self.retry_timeout + (self.retry_timeout * (getrandbits(16) / (2**16 - 1))):
-                if self._last_payload:
-                    if self._last_payload.header_to == self._this_address and \
-                            self._last_payload.header_flags == FLAGS_ACK and \
-                            self._last_payload.header_id == self._last_header_id:
-                        self.pico_logger.WriteNewLog("Direct Message Reply: " + str(self._last_payload))
-                        if(data == "H"):
-                            modifiedMessage = self.convert_lora_rssi_snr(self._last_payload.message[2:])
-                            return namedtuple(
-                                "Payload",
-                                ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'relay_Addresses', 'rssi', 'snr']
-                                )(modifiedMessage, self._last_payload.header_to, self._last_payload.header_from, self._last_payload.header_id, self._last_payload.header_flags, self._last_payload.relay_Addresses, self._last_payload.rssi, self._last_payload.snr)
-                                
-                        return self._last_payload
-        self.pico_logger.WriteNewLog("1." + str(header_to) +".LoRa Could not Contact")
-        return "1." + str(header_to) +".LoRa Could not Contact"
+        Trace.record(Trace.ACK_MATCH, entry.header_id)
+        self._finish_pending(entry, result)
+        return True
 
     def convert_lora_rssi_snr(self, incomming_message):
         modifiedMessage = ""
-        splitMessage = incomming_message.split(b'.')
+        splitMessage = bytes(incomming_message).split(b'.')
         for message in splitMessage:
             modifiedMessage += "rssi" + str((int(message[0]) - 40) *-1)
             modifiedMessage += "snr" + str(int(message[1]) - 40) + "."
@@ -314,90 +1015,196 @@ class LoRa(object):
         modifiedMessage = modifiedMessage[:len(modifiedMessage)-1]
         return modifiedMessage
                 
-    def send_to_wait_relay(self, data, header_to, relay_Addresses, header_flags=FLAGS_REPT_SEND, retries=3, header_id = 0):
-        if(header_id != 0):
-            self._last_header_id = header_id
-        else:
-            self._last_header_id = self.get_new_header_id()
-
-        for _ in range(retries + 1):
-            
-            self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags, relay_Addresses=relay_Addresses)
-
-            self.set_mode_rx()
-            self.wait_packet_sent()
-            start = time.time()
-            
-            while time.time() - start < self.retry_timeout + (self.retry_timeout * (getrandbits(16) / (2**16 - 1))):
-                if self._last_relay_payload or self._last_payload:
-
-                    if (self._last_relay_payload and self._last_relay_payload.header_from_previous == self._this_address and \
-                            self._last_relay_payload.header_from == header_to and \
-                            (self._last_relay_payload.header_flags == FLAGS_REPT_SEND or\
-                             self._last_relay_payload.header_flags == FLAGS_REPT_REPLY) and \
-                            self._last_relay_payload.header_id == self._last_header_id) or\
-                            \
-                            (self._last_payload and self._last_payload.header_to == self._this_address and \
-                            self._last_payload.header_flags == FLAGS_REPT_REPLY and \
-                            self._last_payload.header_id == self._last_header_id):
-                    
-                        #TODO _last_header_id might be changed, we we try fix this?
-                        if(self._last_relay_payload): 
-                            self.pico_logger.WriteNewLog("ACK: " + str(self._last_relay_payload))
-                        else:
-                            self.pico_logger.WriteNewLog("ACK: " + str(self._last_payload))
-                        self._last_relay_payload = None
-                        return True
-        self.pico_logger.WriteNewLog("ACK: Failed")
-        return False
-
     def get_new_header_id(self):
-        if(self._last_header_id is None or self._last_header_id + 1 > 256):
-            return 1
-        return self._last_header_id + 1
+        #Every call hands out a new id so several sends can be in flight at once
+        if(self._last_header_id is None or self._last_header_id + 1 > 255):
+            self._last_header_id = 1
+        else:
+            self._last_header_id += 1
+        return self._last_header_id
         
-    def send_ack(self, header_to, header_id):
-        reply = None
-        rssi_snr_message = self._set_rssi_snr_to_message(self._last_payload.message, self._last_payload.rssi, self._last_payload.snr)
-        if(rssi_snr_message != self._last_payload.message):
-            reply = rssi_snr_message
+    def send_ack(self, packet):
+        #Acks packet with on_recv's reply, now or once a REPLY_LATER reply is answered
+        ack = (packet.header_from, packet.header_id, packet.header_flags)
+        #Retransmissions that come in before the reply are ignored, see _answer_duplicate
+        self._remember_reply(ack, None)
+        if(packet.header_flags == FLAGS_AGGREGATE):
+            sub_packets = self._aggregate_packets(packet)
+            replies = [None] * len(sub_packets)
+            for i in range(len(sub_packets)):
+                self._reply_to(sub_packets[i], lambda reply, i=i: self._aggregate_reply(ack, sub_packets, replies, i, reply))
         else:
-            reply = self.on_recv(self._last_payload)
-        self.send(reply, header_to, header_id, FLAGS_ACK)
-        self.wait_packet_sent()
+            self._reply_to(packet, lambda reply: self._send_reply(ack, reply))
+
+    def _aggregate_reply(self, ack, sub_packets, replies, index, reply):
+        #The aggregated ack goes out once every message of the frame has its reply
+        replies[index] = self._data_bytes(reply or b'')
+        if(None in replies):
+            return
+        data = bytearray()
+        for i in range(len(sub_packets)):
+            #Replies that no longer fit the ack frame are cut short
+            message = replies[i][:max(0, self.aggregate_max_length - len(data) - 2)]
+            data.append(sub_packets[i].header_id)
+            data.append(len(message))
+            data.extend(message)
+        self._send_reply(ack, data)
+
+    def _send_reply(self, ack, reply):
+        reply = self._data_bytes(reply or b'')
+        if(len(reply) > MAX_PAYLOAD_LENGTH - 5):
+            self.pico_logger.Log(LEVEL_WARNING, LOG_SENT, ack[0], "Reply to %s cut to fit one frame", ack[0])
+            reply = reply[:MAX_PAYLOAD_LENGTH - 5]
+        self._remember_reply(ack, reply)
+        self.send_soon(reply, ack[0], ack[1], FLAGS_ACK)
+
+    def _reply_to(self, packet, on_reply):
+        #on_reply(reply) is called now, or by answer() when on_recv returned REPLY_LATER
+        if(self._is_rssi_probe(packet.message)):
+            on_reply(self._set_rssi_snr_to_message(packet.message, packet.rssi, packet.snr))
+            return
+        reply = self.on_recv(packet)
+        if(reply is REPLY_LATER):
+            self._replies_due[(self._origin(packet), packet.header_id)] = [time.ticks_add(time.ticks_ms(), self.reply_wait_ms), on_reply]
+            return
+        on_reply(reply)
+
+    def _origin(self, packet):
+        if(len(packet.relay_Addresses) > 0):
+            return packet.relay_Addresses[0]
+        return packet.header_from
+
+    def replies_due(self):
+        #(origin, header_id) of every frame whose on_recv returned REPLY_LATER and has not been answered
+        return list(self._replies_due)
+
+    def answer(self, origin, header_id, reply):
+        #The reply on_recv promised for header_id from origin, returns False if it is no longer wanted
+        due = self._replies_due.pop((origin, header_id), None)
+        if(due is None):
+            return False
+        due[1](reply)
+        return True
+
+    def _remember_reply(self, ack, reply):
+        seen = self._seen
+        if(ack not in seen and len(seen) >= self.duplicate_cache_size):
+            #Evict the least recently used entry
+            oldest = None
+            for key in seen:
+                if(oldest is None or time.ticks_diff(seen[key][0], seen[oldest][0]) < 0):
+                    oldest = key
+            del seen[oldest]
+        seen[ack] = [time.ticks_ms(), reply]
+
+    def _answer_duplicate(self, packet):
+        #Re-sends the cached ack for a retransmitted frame, returns True if packet was a duplicate
+        key = (packet.header_from, packet.header_id, packet.header_flags)
+        entry = self._seen.get(key)
+        if(entry is None):
+            return False
+        now = time.ticks_ms()
+        if(time.ticks_diff(now, entry[0]) > self.duplicate_ttl * 1000):
+            del self._seen[key]
+            return False
+
+        entry[0] = now
+        self.duplicates += 1
+        if(entry[1] is None):
+            #on_recv has not answered the first copy yet, its ack goes out when it does
+            return True
+        self.send_soon(entry[1], packet.header_from, packet.header_id, FLAGS_ACK, log=False)
+        return True
 
     
+    def _is_rssi_probe(self, message):
+        #"H" messages collect the rssi and snr of every hop as ".<rssi><snr>" pairs
+        return len(message) > 0 and message[0] == ord('H') and (len(message) == 1 or message[1] == ord('.'))
+
     def _set_rssi_snr_to_message(self, message, rssi, snr):
-        if(ord('H') == message[0]) and len(message) == 1 or (len(message)> 1 and ord('.') == message[1]):
+        if(self._is_rssi_probe(message)):
             _rssi = int(rssi*-1) + 40
             _snr = int(snr + 40)
-            return message + '.' + chr(_rssi) + chr(_snr)
+            return bytes(message) + b'.' + bytes((_rssi, _snr))
         return message
 
     def send_relay_ack(self, header_to, header_id):
-        self.send(b'!', header_to, header_id, FLAGS_REPT_REPLY)
-        self.wait_packet_sent()
+        self.send_soon(b'!', header_to, header_id, FLAGS_REPT_REPLY)
 
     def _spi_write(self, register, payload):
+        #Writes one register, or a burst of contiguous registers when payload is a sequence
+        out = self._spi_out
+        out[0] = register | 0x80
         if type(payload) == int:
-            payload = [payload]
-        elif type(payload) == bytes:
-            payload = [p for p in payload]
+            out[1] = payload
+            length = 1
         elif type(payload) == str:
-            payload = [ord(s) for s in payload]
+            length = len(payload)
+            for i in range(length):
+                out[i + 1] = ord(payload[i])
+        elif type(payload) == tuple or type(payload) == list:
+            length = len(payload)
+            for i in range(length):
+                out[i + 1] = payload[i]
+        else:
+            length = len(payload)
+            out[1:length + 1] = payload
+        self.cs.value(0)
+        if length == 1:
+            self.spi.write(self._spi_single_out)
+        else:
+            self.spi.write(self._spi_out_view[:length + 1])
+        self.cs.value(1)
+
+    def _spi_write_fifo(self, header, data):
+        #Header and data go out in a single FIFO burst, returns the payload length
+        out = self._spi_out
+        out[0] = REG_00_FIFO | 0x80
+        header_length = len(header)
+        for i in range(header_length):
+            out[i + 1] = header[i]
+        length = header_length + len(data)
+        out[header_length + 1:length + 1] = data
         self.cs.value(0)
-        self.spi.write(bytearray([register | 0x80] + payload))
+        self.spi.write(self._spi_out_view[:length + 1])
         self.cs.value(1)
+        return length
 
     def _spi_read(self, register, length=1):
+        self._spi_out[0] = register & 0x7f
         self.cs.value(0)
         if length == 1:
-            data = self.spi.read(length + 1, register)[1]
+            self.spi.write_readinto(self._spi_single_out, self._spi_single_in)
+            data = self._spi_in[1]
         else:
-            data = self.spi.read(length + 1, register)[1:]
+            self.spi.write_readinto(self._spi_out_view[:length + 1], self._spi_in_view[:length + 1])
+            data = bytes(self._spi_in_view[1:length + 1])
         self.cs.value(1)
         return data
-        
+
+    def _isr_write(self, register, value):
+        self._isr_out[0] = register | 0x80
+        self._isr_out[1] = value
+        self.cs.value(0)
+        self.spi.write(self._isr_single_out)
+        self.cs.value(1)
+
+    def _isr_read_into(self, register, buffer):
+        #Burst read of len(buffer) bytes straight into buffer, no allocation
+        self._isr_out[0] = register & 0x7f
+        self.cs.value(0)
+        self.spi.write(self._isr_register_view)
+        self.spi.readinto(buffer)
+        self.cs.value(1)
+
+    def _isr_read_status(self):
+        #FIFO address, irq flags, rx length, snr and rssi in one transaction
+        self._isr_out[0] = REG_10_FIFO_RX_CURRENT_ADDR
+        self.cs.value(0)
+        self.spi.write_readinto(self._isr_out, self._isr_in)
+        self.cs.value(1)
+        return self._isr_in
+
     def _decrypt(self, message):
         decrypted_msg = self.crypto.decrypt(message)
         msg_length = decrypted_msg[0]
@@ -411,79 +1218,157 @@ class LoRa(object):
         return encrypted_msg
 
     def _handle_interrupt(self, channel):
-        irq_flags = self._spi_read(REG_12_IRQ_FLAGS)
-        if self._mode == MODE_RXCONTINUOUS and (irq_flags & RX_DONE):
-            
-            packet_len = self._spi_read(REG_13_RX_NB_BYTES)
-            self._spi_write(REG_0D_FIFO_ADDR_PTR, self._spi_read(REG_10_FIFO_RX_CURRENT_ADDR))
-
-            packet = self._spi_read(REG_00_FIFO, packet_len)
-            self._spi_write(REG_12_IRQ_FLAGS, 0xff)  # Clear all IRQ flags
-
-            snr = self._spi_read(REG_19_PKT_SNR_VALUE) / 4
-            rssi = self._spi_read(REG_1A_PKT_RSSI_VALUE)
+        if(not Trace.enabled):
+            self._service_interrupt()
+            return
+        Trace.record(Trace.IRQ_ENTER, self._mode)
+        Trace.record(Trace.IRQ_EXIT, self._service_interrupt())
 
-            if snr < 0:
-                rssi = snr + rssi
-            else:
-                rssi = rssi * 16 / 15
+    def _service_interrupt(self):
+        #Returns the irq flags it handled
+        status = self._isr_read_status()
+        irq_flags = status[RX_STATUS_IRQ_FLAGS]
+        if self._mode == MODE_RXCONTINUOUS and (irq_flags & RX_DONE):
+            if(irq_flags & PAYLOAD_CRC_ERROR):
+                #Corrupted on air, nothing in the FIFO is worth decoding
+                Metrics.count(Metrics.RX_CRC_ERRORS)
+                self._isr_write(REG_12_IRQ_FLAGS, 0xff)
+                return irq_flags
+            self._drain_fifo(status)
+            self._isr_write(REG_12_IRQ_FLAGS, 0xff)  # Clear all IRQ flags
+
+            if(self.rx_event is not None):
+                self.rx_event.set()
+            if(not self._deferred_rx):
+                self.process_rx()
+            elif(self.schedule_rx):
+                try:
+                    micropython.schedule(self._process_rx_ref, None)
+                except RuntimeError:
+                    pass #Schedule queue full, the main loop will drain the ring
+            return irq_flags
 
-            if self._freq >= 779:
-                rssi = round(rssi - 157, 2)
-            else:
-                rssi = round(rssi - 164, 2)
-
-            if packet_len >= 5:
-                header_to = packet[0]
-                header_from = packet[1]
-                header_id = packet[2]
-                header_flags = packet[3]
-                relay_Addresses_len = packet[4]
-                
-                relay_Addresses = []
-                for charicter in packet[5: 5 + relay_Addresses_len]:
-                    relay_Addresses.append(int(charicter))
+        elif self._mode == MODE_TX and (irq_flags and TX_DONE):
+            #Straight back to listening, nobody has to wait for TxDone to call set_mode_rx
+            self._isr_write(REG_01_OP_MODE, MODE_RXCONTINUOUS)
+            self._isr_write(REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
+            self._mode = MODE_RXCONTINUOUS
+            Trace.record(Trace.MODE, MODE_RXCONTINUOUS)
+            if(self.tx_event is not None):
+                self.tx_event.set()
 
-                message = bytes(packet[5 + relay_Addresses_len:]) if packet_len > 5 else b''
-                
-                self.pico_logger.WriteNewLog("LoRa Message on Air: header_from: " + str(header_from) + "\theader_to: " + str(header_to) + "\theader_id: " + str(header_id) +  "\tmessage: " + str(message) + "\trssi: " + str(rssi) + "\tsnr: " + str(snr))
-                #print("header_to: " + str(header_to) + "___header_from: " + str(header_from) + "___message: " + str(message))
-                if(self.relay_check_ack(header_to, header_from, header_id, header_flags, relay_Addresses_len, relay_Addresses, message, rssi, snr)):
-                    return
-                if self.crypto and len(message) % 16 == 0:
-                    message = self._decrypt(message)
+        elif self._mode == MODE_CAD and (irq_flags and CAD_DONE):
+            self._cad = irq_flags and CAD_DETECTED
+            self._isr_write(REG_01_OP_MODE, MODE_STDBY)
+            self._mode = MODE_STDBY
+            Trace.record(Trace.MODE, MODE_STDBY)
+
+        self._isr_write(REG_12_IRQ_FLAGS, 0xff)
+        return irq_flags
+
+    def _drain_fifo(self, status):
+        #Only copies the frame into the next free rx slot, everything else happens in process_rx
+        head = self._rx_head
+        next_head = (head + 1) % self._rx_size
+        if(next_head == self._rx_tail):
+            self.rx_dropped += 1
+            Metrics.count(Metrics.RX_DROPPED)
+            return
 
-                
-                if(relay_Addresses_len > 0 and header_to == self._this_address and (header_flags ==  FLAGS_REPT_SEND or header_flags ==  FLAGS_REPT_REPLY) and FLAGS_ACK):
-                    self.relay_payload = namedtuple(
-                            "Payload",
-                            ['message', 'header_to', 'header_from', 'header_from_previous', 'header_id', 'header_flags', 'relay_Addresses', 'rssi', 'snr']
-                        )(message, header_to, header_from, self._this_address, header_id, header_flags, relay_Addresses, rssi, snr)
+        packet = self._rx_packets[head]
+        packet_len = status[RX_STATUS_NB_BYTES]
+        packet.length = packet_len
+        packet.snr_raw = status[RX_STATUS_SNR]
+        packet.rssi_raw = status[RX_STATUS_RSSI]
 
-                self._last_payload = namedtuple(
-                    "Payload",
-                    ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'relay_Addresses', 'rssi', 'snr']
-                )(message, header_to, header_from, header_id, header_flags, relay_Addresses, rssi, snr)
+        self._isr_write(REG_0D_FIFO_ADDR_PTR, status[RX_STATUS_CURRENT_ADDR])
+        self._isr_read_into(REG_00_FIFO, packet.view[:packet_len])
+        self._rx_head = next_head
+        Trace.record(Trace.FIFO_READ, packet_len)
 
-                #Sender Requires Ack 
-                if self._acks and header_to == self._this_address and not header_flags & FLAGS_ACK and relay_Addresses_len == 0:
-                    self.send_ack(header_from, header_id)
+    def _scheduled_process_rx(self, _):
+        self.process_rx()
 
-                self.set_mode_rx()
+    def process_rx(self):
+        #Decodes, logs, acks and calls on_recv for every frame waiting in the rx ring
+        if(self._rx_busy):
+            return
+        self._rx_busy = True
+        try:
+            while self._rx_tail != self._rx_head:
+                tail = self._rx_tail
+                try:
+                    self._process_frame(self._rx_packets[tail])
+                finally:
+                    #The slot is only handed back to the interrupt once the frame is done with
+                    self._rx_tail = (tail + 1) % self._rx_size
+
+            if(self.rx_dropped != self._rx_dropped_logged):
+                self._rx_dropped_logged = self.rx_dropped
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RADIO, 0, "LoRa rx ring full, dropped frames: %s", self.rx_dropped)
+        finally:
+            self._rx_busy = False
+
+    def _process_frame(self, packet):
+        if(not packet.decode(self._freq) or not self._open_payload(packet)):
+            return
+        Metrics.count(Metrics.RX_FRAMES)
+        if(self.router is not None):
+            self.router.learn(packet)
 
-                #if not header_flags & FLAGS_ACK:
-                #    print("not header_flags & FLAGS_ACK")
-                #    self.on_recv(self._last_payload)
+        #Our ack got lost and the sender retried, answer again without bothering on_recv or the log
+        if(self._acks and packet.header_to == self._this_address and not packet.header_flags & FLAGS_ACK and
+                len(packet.relay_Addresses) == 0 and self._answer_duplicate(packet)):
+            return
 
+        handler = self.flag_handlers.get(packet.header_flags)
+        if(handler is not None and (packet.header_to == self._this_address or packet.header_to == BROADCAST_ADDRESS)):
+            handler(packet)
+            return
 
-        elif self._mode == MODE_TX and (irq_flags and TX_DONE):
-            self.set_mode_idle()
+        if(self.pico_logger.Enabled(LEVEL_DEBUG, LOG_RADIO)):
+            self.pico_logger.Log(LEVEL_DEBUG, LOG_RADIO, packet.header_from, "LoRa Message on Air: header_from: %s\theader_to: %s\theader_id: %s\tmessage: %s\trssi: %s\tsnr: %s",
+                                 packet.header_from, packet.header_to, packet.header_id, bytes(packet.message), packet.rssi, packet.snr)
+        if(self.relay_check_ack(packet)):
+            return
+        if(len(packet.relay_Addresses) > 0 and packet.header_to == self._this_address and (packet.header_flags ==  FLAGS_REPT_SEND or packet.header_flags ==  FLAGS_REPT_REPLY)):
+            if(len(self._relay_inbox) < self.max_relays):
+                relay_payload = packet.copy()
+                relay_payload.header_from_previous = self._this_address
+                self._relay_inbox.append(relay_payload)
+            else:
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, packet.header_from, "Relay queue full, dropped frame from %s", packet.header_from)
 
-        elif self._mode == MODE_CAD and (irq_flags and CAD_DONE):
-            self._cad = irq_flags and CAD_DETECTED
-            self.set_mode_idle()
+        self._match_pending(packet)
+        if(self.on_frame is not None and packet.header_to == self._this_address):
+            if(packet.header_flags == FLAGS_AGGREGATE):
+                for sub_packet in self._aggregate_packets(packet):
+                    self.on_frame(sub_packet)
+            else:
+                self.on_frame(packet)
+
+        #Sender Requires Ack 
+        if self._acks and packet.header_to == self._this_address and not packet.header_flags & FLAGS_ACK and len(packet.relay_Addresses) == 0:
+            self.send_ack(packet)
+
+        self.set_mode_rx()
+
+    def _open_payload(self, packet):
+        #Decrypts and decompresses the data portion, compression bits are removed from header_flags
+        if self.crypto and len(packet.message) % 16 == 0:
+            packet.message = self._decrypt(packet.message)
+        compression = packet.header_flags & FLAGS_COMPRESSION
+        if(compression):
+            try:
+                packet.message = LoRaCompression.decompress(compression, packet.message)
+            except Exception as e:
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RECEIVED, packet.header_from, "LoRa frame from %s could not be decompressed: %s", packet.header_from, e)
+                return False
+            packet.header_flags &= ~FLAGS_COMPRESSION
+        return True
 
-        self._spi_write(REG_12_IRQ_FLAGS, 0xff)
+    def compression_stats(self):
+        return "frames" + str(self.compressed_frames) + ",bytes" + str(self.compression_saved_bytes) + ",ms" + str(int(self.compression_saved_ms))
 
     def relay_list_to_number(self, relay_Addresses, header):
         if(relay_Addresses is None):
@@ -494,123 +1379,200 @@ class LoRa(object):
         for address in relay_Addresses:
             header.append(address)
                 
-    def relay_check_ack(self, header_to, header_from, header_id, header_flags, relay_Addresses_len, relay_Addresses, message, rssi, snr):
+    def relay_check_ack(self, packet):
         #TODO make this more robust
-        if(header_to != BROADCAST_ADDRESS or self._receive_all is False):
-            if(self._this_address != header_to):
-                if(relay_Addresses_len > 0 and self._this_address in relay_Addresses):
-                    destination_position = relay_Addresses.index(header_from)
+        relay_Addresses = packet.relay_Addresses
+        if(packet.header_to != BROADCAST_ADDRESS or self._receive_all is False):
+            if(self._this_address != packet.header_to):
+                if(len(relay_Addresses) > 0 and self._this_address in relay_Addresses and packet.header_from in relay_Addresses):
+                    destination_position = relay_Addresses.index(packet.header_from)
                     if(destination_position != 0 and relay_Addresses.index(self._this_address) + 1 == destination_position):
-                        self._last_relay_payload = namedtuple(
-                                "Payload",
-                                ['message', 'header_to', 'header_from', 'header_from_previous', 'header_id', 'header_flags', 'rssi', 'snr']
-                            )(message, header_to, header_from, self._this_address, header_id, header_flags, rssi, snr)
+                        packet.header_from_previous = self._this_address
+                        self._match_pending(packet, overheard=True)
                 return True
         return False
 
     def relay_check_repeat(self):
-        if(self.relay_payload is None):
+        """
+        Works off the relay queue: starts a RelayTransaction for every queued frame and expires the
+        ones whose reply never came back. Never waits on the radio, the transactions are moved on by
+        on_done of their pending sends and by the replies process_rx queues.
+        """
+        while len(self._relay_inbox) > 0:
+            self._relay_start(self._relay_inbox.pop(0))
+        now = time.ticks_ms()
+        for header_id in list(self._relay_replies):
+            waiter = self._relay_replies[header_id]
+            if(waiter[0] is not None and time.ticks_diff(now, waiter[0]) >= 0):
+                del self._relay_replies[header_id]
+                self.pico_logger.WriteNewLog("2."+ str(waiter[2]) + ".Fording message never returned Time_ms: " + str(time.ticks_diff(now, waiter[3])))
+                waiter[1]("2."+ str(waiter[2]) + ".Fording message never returned")
+        if(len(self._relays) == 0):
             return
-        payload = self.relay_payload
+        for key in list(self._relays):
+            relay = self._relays[key]
+            if((relay.state != RELAY_WAITING and relay.state != RELAY_DONE) or time.ticks_diff(now, relay.deadline) < 0):
+                continue
+            if(relay.state == RELAY_WAITING):
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, self._relay_next_hop(relay.payload), "2.%s.Fording message never returned", self._relay_next_hop(relay.payload))
+            del self._relays[key]
 
-        position = payload.relay_Addresses.index(self._this_address)
-        
-        if(position < len(payload.relay_Addresses) -1 ):
-            self.pico_logger.WriteNewLog("Relaying Message to: " + str(payload.relay_Addresses[position + 1]) + "\t Message: " + str(payload.message) + "\tRelay List: " + str(payload.relay_Addresses))
-            payloadMessage = self._set_rssi_snr_to_message(payload.message, payload.rssi, payload.snr)
-            result = self.send_to_wait_relay(payloadMessage, payload.relay_Addresses[position + 1], header_flags=payload.header_flags, relay_Addresses=payload.relay_Addresses, header_id=payload.header_id)
-            if(result):
-                start = time.time_ns()
-                responded_payload = self.repeat_wait_return(payload)
-                if(responded_payload):
-                    
-                    responded_position = responded_payload.relay_Addresses.index(self._this_address)
-                    self._last_payload = None
-                    payloadMessage = self._set_rssi_snr_to_message(responded_payload.message, responded_payload.rssi, responded_payload.snr)
-                    result = self.send_to_wait_relay(payloadMessage, responded_payload.relay_Addresses[responded_position + 1], header_flags=responded_payload.header_flags, relay_Addresses=responded_payload.relay_Addresses, header_id=responded_payload.header_id)
-                    self.pico_logger.WriteNewLog("LoRa got a response from Repeat Reply: " + str(responded_payload.message))
-                else:    
-                    self.pico_logger.WriteNewLog("2."+ str(payload.relay_Addresses[position + 1]) + ".Fording message never returned Time_ns: " + str(time.time_ns() - start))
-            else:
-                self.pico_logger.WriteNewLog("1." + str(payload.relay_Addresses[position + 1]) +".LoRa Could not Contact")
-                #If failed, send message back
-                self.send_relay_reply(payload, position)
-            self.relay_payload = None
-            
-        
-        #Repeat reach its end
-        elif(position == len(payload.relay_Addresses) -1 and payload.header_flags != FLAGS_REPT_REPLY):
-            self.send_relay_reply(payload, position)
+    def _relay_next_hop(self, payload):
+        relay_Addresses = payload.relay_Addresses
+        return relay_Addresses[relay_Addresses.index(self._this_address) + 1]
 
-    def send_relay_reply(self, payload, position):
-        reply = None
-        retries = 0
+    def _relay_start(self, payload):
         relay_Addresses = payload.relay_Addresses
-        #Relay Made it to destination
-        if(position == len(relay_Addresses) -1):
-            payloadMessage = self._set_rssi_snr_to_message(payload.message, payload.rssi, payload.snr)
-            if(payloadMessage != payload.message):
-                reply = payloadMessage
-            else:
-                reply = self.on_recv(payload)
-            
+        if(self._this_address not in relay_Addresses):
+            return
+        position = relay_Addresses.index(self._this_address)
+        last = position == len(relay_Addresses) - 1
+        if(payload.header_flags == FLAGS_REPT_REPLY):
+            #The origin is last on the way back
+            if(last):
+                self._relay_replied(payload)
+                return
+            key = (relay_Addresses[len(relay_Addresses) - 1], payload.header_id)
         else:
-            reply = "3." + str(relay_Addresses[position + 1])
-            retries = 3
-            relay_Addresses = []
-            for address in payload.relay_Addresses:
-                relay_Addresses.append(address)
-                if(address == self._this_address):
-                    break
-
-        relay_Addresses_reversed = self.reverse_list(relay_Addresses)
-
-        position = relay_Addresses_reversed.index(self._this_address)
-
-        result = self.send_to_wait_relay(reply, relay_Addresses_reversed[position+1], header_flags=FLAGS_REPT_REPLY, relay_Addresses=relay_Addresses_reversed, header_id=payload.header_id, retries=retries)
-        
-        self.relay_payload = None
+            key = (relay_Addresses[0], payload.header_id)
+
+        relay = self._relays.get(key)
+        if(payload.header_flags == FLAGS_REPT_SEND and relay is not None):
+            #A retransmission, the previous hop missed our copy of its frame (or the destination's reply)
+            if(relay.state == RELAY_WAITING):
+                self.send_soon(relay.message, self._relay_next_hop(payload), payload.header_id, payload.header_flags, relay_Addresses)
+            elif(last and relay.message is not None):
+                reversed_Addresses = self.reverse_list(relay_Addresses)
+                self.send_soon(relay.message, reversed_Addresses[1], payload.header_id, FLAGS_REPT_REPLY, reversed_Addresses)
+            return
+        if(relay is None):
+            if(len(self._relays) >= self.max_relays):
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, payload.header_from, "Relay table full, dropped frame from %s", payload.header_from)
+                return
+            relay = RelayTransaction(payload)
+            self._relays[key] = relay
+        elif(relay.state == RELAY_RETURNING or relay.state == RELAY_DONE):
+            return
 
-    def repeat_wait_return(self, recieved_payload):
-            position = recieved_payload.relay_Addresses.index(self._this_address)
-            wait_repeater_jumps = len(recieved_payload.relay_Addresses) - position
-            start = time.time()
-            
-            while time.time() - start < (self.retry_timeout + (self.retry_timeout * (getrandbits(16) / (2**16 - 1))))*4*wait_repeater_jumps:
-                if self._last_payload and self._last_payload.header_flags == FLAGS_REPT_REPLY and \
-                    self._last_payload.header_id == recieved_payload.header_id:
-                    if(b'H.' == self._last_payload.message[:2] and self._last_payload.relay_Addresses.index(self._this_address) == len(self._last_payload.relay_Addresses) -1):
-                        modifiedMessage = self.convert_lora_rssi_snr(self._last_payload.message[2:])
-                        return namedtuple(
-                                "Payload",
-                                ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'relay_Addresses', 'rssi', 'snr']
-                                )(modifiedMessage, self._last_payload.header_to, self._last_payload.header_from, self._last_payload.header_id, self._last_payload.header_flags, self._last_payload.relay_Addresses, self._last_payload.rssi, self._last_payload.snr)
-                    return self._last_payload
-            return None        
-        
-    def relay_send(self, message, Send_To_ADDRESS, Send_To_Relay_Addresses, header_id = 0):
-        result = self.send_to_wait_relay(str(message), Send_To_ADDRESS, Send_To_Relay_Addresses, header_id=header_id)
-        if(result == False):
-            self.pico_logger.WriteNewLog("1." + str(Send_To_ADDRESS) +".LoRa Could not Contact")
-            return "1." + str(Send_To_ADDRESS) +".LoRa Could not Contact"
-        
-        payload = namedtuple(
-                "Payload",
-                ['message', 'header_id', 'relay_Addresses']
-            )(message, self._last_header_id, Send_To_Relay_Addresses)
-                    
-        start = time.time_ns()
-        responded_payload = self.repeat_wait_return(payload)
-        if(responded_payload):
-            self.pico_logger.WriteNewLog("Responded Relay: Time_ns: " + str(time.time_ns() - start) + "\t Paylaod: " + str(responded_payload))
-            result = self.send_relay_ack(responded_payload.header_from, responded_payload.header_id)
-            self.relay_payload = None
-            return responded_payload
+        if(payload.header_flags == FLAGS_REPT_REPLY):
+            #A reply on its way back to the origin, hand it to the next hop along
+            Metrics.count(Metrics.RELAY_RETURNED)
+            self.pico_logger.Log(LEVEL_DEBUG, LOG_RELAY, payload.header_from, "LoRa got a response from Repeat Reply: %s", payload.message)
+            message = self._set_rssi_snr_to_message(payload.message, payload.rssi, payload.snr)
+            self._relay_return(key, relay, message, relay_Addresses, relay_Addresses[position + 1], 3)
+        elif(last):
+            #Relay Made it to destination, the reply goes back along the path once on_recv has it
+            self._reply_to(payload, lambda reply: self._relay_answered(key, reply))
         else:
-            self.relay_payload = None
-            self.pico_logger.WriteNewLog("2."+ str(Send_To_ADDRESS) + ".Fording message never returned Time_ns: " + str(time.time_ns() - start))
-            return "2."+ str(Send_To_ADDRESS) + ".Fording message never returned"    
-        
+            next_hop = relay_Addresses[position + 1]
+            self.pico_logger.Log(LEVEL_DEBUG, LOG_RELAY, next_hop, "Relaying Message to: %s\t Message: %s\tRelay List: %s", next_hop, payload.message, relay_Addresses)
+            relay.message = self._set_rssi_snr_to_message(payload.message, payload.rssi, payload.snr)
+            try:
+                self.start_send(relay.message, next_hop, header_flags=payload.header_flags, header_id=payload.header_id,
+                                relay_Addresses=relay_Addresses, on_done=lambda entry: self._relay_forwarded(key, entry))
+            except Exception as e:
+                #e.g. the rssi and snr we add no longer fit the frame, the origin is told like for a dead next hop
+                self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, next_hop, "Relay to %s failed: %s", next_hop, str(e))
+                self._relay_failed(key, relay, next_hop)
+
+    def _relay_forwarded(self, key, entry):
+        relay = self._relays.get(key)
+        if(relay is None or relay.state != RELAY_FORWARDING):
+            return
+        if(entry.result is None):
+            self.pico_logger.WriteNewLog("1." + str(entry.header_to) +".LoRa Could not Contact")
+            self._relay_failed(key, relay, entry.header_to)
+            return
+        Metrics.count(Metrics.RELAY_FORWARDED)
+        relay.state = RELAY_WAITING
+        relay.deadline = time.ticks_add(time.ticks_ms(), self._relay_window_ms(relay.payload.relay_Addresses))
+
+    def _relay_failed(self, key, relay, next_hop):
+        #Sends "3.<next hop>" back along the part of the path that got here
+        Metrics.count(Metrics.RELAY_FAILED)
+        relay_Addresses = []
+        for address in relay.payload.relay_Addresses:
+            relay_Addresses.append(address)
+            if(address == self._this_address):
+                break
+        relay_Addresses = self.reverse_list(relay_Addresses)
+        self._relay_return(key, relay, "3." + str(next_hop), relay_Addresses, relay_Addresses[1], 3)
+
+    def _relay_answered(self, key, reply):
+        relay = self._relays.get(key)
+        if(relay is None):
+            return
+        if(reply is None):
+            reply = self.no_reply
+        reversed_Addresses = self.reverse_list(relay.payload.relay_Addresses)
+        reply = self._data_bytes(reply)
+        if(len(reply) > MAX_PAYLOAD_LENGTH - 5 - len(reversed_Addresses)):
+            self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, reversed_Addresses[1], "Reply to %s cut to fit one frame", reversed_Addresses[0])
+            reply = reply[:MAX_PAYLOAD_LENGTH - 5 - len(reversed_Addresses)]
+        relay.message = reply
+        self._relay_return(key, relay, reply, reversed_Addresses, reversed_Addresses[1], 0)
+
+    def _relay_return(self, key, relay, message, relay_Addresses, next_hop, retries):
+        relay.state = RELAY_RETURNING
+        try:
+            self.start_send(message, next_hop, header_flags=FLAGS_REPT_REPLY, retries=retries, header_id=relay.payload.header_id,
+                            relay_Addresses=relay_Addresses, on_done=lambda entry: self._relay_done(key))
+        except Exception as e:
+            #Nothing is pending that would ever finish the transaction, so it is finished here
+            self.pico_logger.Log(LEVEL_WARNING, LOG_RELAY, next_hop, "Relay reply to %s failed: %s", next_hop, str(e))
+            relay.message = None
+            self._relay_done(key)
+
+    def _relay_done(self, key):
+        relay = self._relays.get(key)
+        if(relay is None):
+            return
+        relay.state = RELAY_DONE
+        relay.deadline = time.ticks_add(time.ticks_ms(), self.duplicate_ttl * 1000)
+
+    def _relay_window_ms(self, relay_Addresses):
+        #Every hop out and back may need a few tries, estimated from the round trip to our next hop
+        position = relay_Addresses.index(self._this_address)
+        wait_repeater_jumps = len(relay_Addresses) - position
+        next_hop = relay_Addresses[min(position + 1, len(relay_Addresses) - 1)]
+        timeout = self.retransmission_timeout_ms(next_hop, 5 + len(relay_Addresses))
+        timeout = max(timeout, int(2 * self._tx_airtime_ms))
+        return (timeout + (timeout * getrandbits(8) >> 9))*4*wait_repeater_jumps
+
+    def start_relay_send(self, data, header_to, relay_Addresses, header_id=0, on_done=None):
+        """
+        Sends data along relay_Addresses (this node first, the destination last) through header_to,
+        the first hop, without waiting. on_done(result) gets the destination's reply Packet, or the
+        "1." (first hop never took it) or "2." (reply never came back) warning text.
+        """
+        entry = self.start_send(str(data), header_to, header_flags=FLAGS_REPT_SEND, header_id=header_id,
+                                relay_Addresses=relay_Addresses, on_done=self._relay_sent)
+        self._relay_replies[entry.header_id] = [None, on_done, header_to, time.ticks_ms()]
+        return entry.header_id
+
+    def _relay_sent(self, entry):
+        waiter = self._relay_replies.get(entry.header_id)
+        if(waiter is None or waiter[0] is not None):
+            return
+        if(entry.result is None):
+            del self._relay_replies[entry.header_id]
+            self.pico_logger.WriteNewLog("1." + str(entry.header_to) +".LoRa Could not Contact")
+            waiter[1]("1." + str(entry.header_to) +".LoRa Could not Contact")
+            return
+        #The first hop has it, the reply has the whole way there and back to arrive
+        waiter[0] = time.ticks_add(time.ticks_ms(), self._relay_window_ms(entry.relay_Addresses))
+
+    def _relay_replied(self, payload):
+        #The last hop keeps sending the reply until we ack it, also when it comes too late for us
+        self.send_relay_ack(payload.header_from, payload.header_id)
+        waiter = self._relay_replies.pop(payload.header_id, None)
+        if(waiter is None):
+            return
+        if(payload.message[:2] == b'H.'):
+            payload.message = self.convert_lora_rssi_snr(payload.message[2:])
+        self.pico_logger.WriteNewLog("Responded Relay: Time_ms: " + str(time.ticks_diff(time.ticks_ms(), waiter[3])) + "\t Paylaod: " + str(payload))
+        waiter[1](payload)
+
     def reverse_list(self, list):
         newList = []
         for element in reversed(list):
@@ -622,4 +1584,105 @@ class LoRa(object):
         self.spi.deinit()
 
 
+class AsyncLoRa(object):
+    """
+    AsyncLoRa(lora, queue_size=8)
+    uasyncio front end for a LoRa driver created with deferred_rx=True.
+    The interrupt sets ThreadSafeFlags, poll() drains the rx ring and wakes whoever is waiting on a frame.
+    lora: the LoRa driver
+    queue_size: frames kept for packets() before the oldest is dropped
+    """
+    def __init__(self, lora, queue_size=8):
+        self.lora = lora
+        self.queue_size = queue_size
+        self._rx_flag = asyncio.ThreadSafeFlag()
+        self._tx_flag = asyncio.ThreadSafeFlag()
+        self._packet_event = asyncio.Event()
+        self._tx_lock = asyncio.Lock()
+        self._packets = []
+        lora.rx_event = self._rx_flag
+        lora.tx_event = self._tx_flag
+        lora.on_frame = self._on_frame
+
+    def _on_frame(self, packet):
+        if(len(self._packets) >= self.queue_size):
+            self._packets.pop(0)
+        self._packets.append(packet.copy())
+        self._packet_event.set()
+
+    def new_header_id(self):
+        return self.lora.get_new_header_id()
+
+    async def poll(self, timeout_ms=100):
+        #Waits for the rx interrupt (or timeout_ms, or the next retry) and processes everything in the rx ring
+        try:
+            await asyncio.wait_for_ms(self._rx_flag.wait(), self.lora.next_pending_ms(timeout_ms))
+        except asyncio.TimeoutError:
+            pass
+        self.lora.process_rx()
+        self.lora.poll_pending()
+
+    async def run(self):
+        while True:
+            await self.poll()
+
+    async def _wait_tx_done(self):
+        while self.lora._mode == MODE_TX:
+            remaining = self.lora.tx_remaining_ms()
+            if(remaining <= 0):
+                return False
+            try:
+                await asyncio.wait_for_ms(self._tx_flag.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def send(self, data, header_to, header_id=0, header_flags=0, relay_Addresses=None):
+        #Transmits one frame and returns once TxDone fired, the radio is left listening
+        async with self._tx_lock:
+            await self._wait_tx_done()
+            while not self.lora.send(data, header_to, header_id=header_id, header_flags=header_flags, relay_Addresses=relay_Addresses):
+                #Over the duty cycle budget, wait until the frame fits
+                await asyncio.sleep_ms(max(self.lora.tx_delay_ms(5 + len(data)), 100))
+            sent = await self._wait_tx_done()
+            self.lora.set_mode_rx()
+            return sent
+
+    async def send_relay(self, data, header_to, relay_Addresses, header_id=0):
+        #LoRa.start_relay_send, returns the destination's reply Packet or the warning text
+        done = asyncio.Event()
+        results = []
+        await self._wait_tx_done()
+        self.lora.start_relay_send(data, header_to, relay_Addresses, header_id, lambda result: (results.append(result), done.set()))
+        await done.wait()
+        return results[0]
+
+    async def send_reliable(self, data, header_to, header_flags=0, retries=3, header_id=0, relay_Addresses=None):
+        #Same contract as LoRa.send_to_wait, retries are driven by poll() while other tasks keep running
+        done = asyncio.Event()
+        await self._wait_tx_done()
+        if(relay_Addresses is None and header_flags == 0):
+            #Held for lora.aggregate_hold_ms so messages to the same node can share a frame
+            entry = self.lora.queue_send(data, header_to, retries=retries, header_id=header_id, on_done=lambda entry: done.set())
+        else:
+            entry = self.lora.start_send(data, header_to, header_flags=header_flags, retries=retries, header_id=header_id,
+                                         relay_Addresses=relay_Addresses, on_done=lambda entry: done.set())
+        await done.wait()
+        if entry.result:
+            return entry.result
+        if(relay_Addresses is not None):
+            return False
+        return "1." + str(header_to) +".LoRa Could not Contact"
+
+    def packets(self):
+        #async for packet in lora.packets(): every frame addressed to this node, as detached copies
+        return self
+
+    def __aiter__(self):
+        return self
 
+    async def __anext__(self):
+        while len(self._packets) == 0:
+            self._packet_event.clear()
+            await self._packet_event.wait()
+        return self._packets.pop(0)
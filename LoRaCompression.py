@@ -0,0 +1,117 @@
+import uio
+try:
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    import uzlib
+except ImportError:
+    uzlib = None
+
+#Header flag bits, set on top of the frame type when the data portion is compressed
+COMPRESSED_DICTIONARY = 0x40
+COMPRESSED_DEFLATE = 0x20
+
+#Shorter than this deflate only adds to the frame
+DEFLATE_MIN_LENGTH = 48
+
+#Shared by every node, bytes 0x80 + index stand for an entry. Only append to this list,
+#changing an entry breaks decompression on nodes running the old list
+STATIC_DICTIONARY = (
+    b"Recieved,", b"Send,", b"LoRa Could not Contact", b"Could not Contact",
+    b"rssi-", b"rssi", b"snr-", b"snr", b"header_", b"message",
+    b"temperature", b"temp", b"humidity", b"hum", b"pressure", b"battery", b"batt",
+    b"voltage", b"volt", b"current", b"status", b"error", b"Error", b"true", b"false",
+    b"ok", b"on", b"off", b"low", b"high", b"level", b"time", b"date", b"count",
+    b"value", b"sensor", b"relay", b"Relay", b"pump", b"tank", b"water", b"soil",
+    b"wind", b"rain", b"light", b"door", b"open", b"close", b"alarm", b"node",
+    b", ", b",0", b",1", b".0", b".5", b"00", b"0.", b"1.", b"10", b"20", b"-1",
+)
+
+def _build_index():
+    #first byte -> entries starting with it, longest first
+    index = {}
+    for token in range(len(STATIC_DICTIONARY)):
+        entry = STATIC_DICTIONARY[token]
+        index.setdefault(entry[0], []).append((entry, 0x80 | token))
+    for entries in index.values():
+        entries.sort(key=lambda item: -len(item[0]))
+    return index
+
+_INDEX = _build_index()
+
+def _deflate(data):
+    stream = uio.BytesIO()
+    compressor = deflate.DeflateIO(stream, deflate.RAW, 8)
+    compressor.write(data)
+    compressor.close()
+    return stream.getvalue()
+
+def _can_deflate():
+    #Stock rp2 firmware builds deflate without compression, its DeflateIO.write raises
+    if(deflate is None):
+        return False
+    try:
+        _deflate(b"probe")
+        return True
+    except Exception:
+        return False
+
+_CAN_DEFLATE = _can_deflate()
+
+def dictionary_encode(data):
+    #None when data is not 7 bit ASCII, the upper half of the byte range is used for tokens
+    out = bytearray()
+    position = 0
+    length = len(data)
+    while position < length:
+        byte = data[position]
+        if(byte >= 0x80):
+            return None
+        for entry, token in _INDEX.get(byte, ()):
+            if(data[position:position + len(entry)] == entry):
+                out.append(token)
+                position += len(entry)
+                break
+        else:
+            out.append(byte)
+            position += 1
+    return out
+
+def dictionary_decode(data):
+    out = bytearray()
+    for byte in data:
+        if(byte >= 0x80):
+            out.extend(STATIC_DICTIONARY[byte & 0x7f])
+        else:
+            out.append(byte)
+    return out
+
+def compress(data):
+    """
+    Returns (flag, data) with the shortest encoding of data, flag is 0 when
+    nothing beats sending it as it is.
+    """
+    data = bytes(data)
+    flag = 0
+    best = data
+    encoded = dictionary_encode(data)
+    if(encoded is not None and len(encoded) < len(best)):
+        flag = COMPRESSED_DICTIONARY
+        best = encoded
+    if(_CAN_DEFLATE and len(data) >= DEFLATE_MIN_LENGTH):
+        encoded = _deflate(data)
+        if(len(encoded) < len(best)):
+            flag = COMPRESSED_DEFLATE
+            best = encoded
+    return flag, best
+
+def decompress(flag, data):
+    if(flag == COMPRESSED_DICTIONARY):
+        return dictionary_decode(data)
+    if(flag == COMPRESSED_DEFLATE):
+        if(deflate is not None):
+            return deflate.DeflateIO(uio.BytesIO(bytes(data)), deflate.RAW, 8).read()
+        if(uzlib is not None):
+            return uzlib.decompress(bytes(data), -8)
+    raise ValueError("Unsupported compression flag " + hex(flag))
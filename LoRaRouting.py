@@ -0,0 +1,195 @@
+import time
+from urandom import getrandbits
+from LoRa import FLAGS_ROUTE_REQUEST, FLAGS_ROUTE_REPLY, BROADCAST_ADDRESS, MODE_TX
+
+#Route cost per hop, plus up to LINK_PENALTY for a first hop heard with a poor snr
+HOP_COST = 10
+LINK_PENALTY = 10
+
+class Router(object):
+    """
+    Router(lora, max_hops=6, route_ttl=600, max_routes=32)
+    Routing table for LoRa relays, learned from every frame the radio hears and filled on demand
+    with a broadcast route request (FLAGS_ROUTE_REQUEST) answered by the destination along the
+    reverse path (FLAGS_ROUTE_REPLY).
+    route(address) returns the hops to address, ending with it ([address] for a neighbour), or None.
+    discover(address, on_done) floods a route request, on_done(route) gets the new route or None.
+    poll() has to be called regularly, it forwards route requests and retries discoveries.
+    """
+    def __init__(self, lora, max_hops=6, route_ttl=600, max_routes=32):
+        self.lora = lora
+        self.max_hops = max_hops
+        self.route_ttl = route_ttl
+        self.max_routes = max_routes
+        self.retries = 2
+
+        # destination -> [hops, cost, ticks_ms learned]
+        self._routes = {}
+        # destination -> [header_id, deadline, attempts, [on_done]]
+        self._discoveries = {}
+        # (origin, header_id) -> ticks_ms, route requests already forwarded or answered
+        self._requests_seen = {}
+        # [due ticks_ms, data, header_id] route requests waiting for their rebroadcast slot
+        self._forward = []
+
+        lora.router = self
+        lora.flag_handlers[FLAGS_ROUTE_REQUEST] = self._on_route_request
+        lora.flag_handlers[FLAGS_ROUTE_REPLY] = self._on_route_reply
+
+    def route(self, address):
+        route = self._routes.get(address)
+        if(route is None):
+            return None
+        if(time.ticks_diff(time.ticks_ms(), route[2]) > self.route_ttl * 1000):
+            del self._routes[address]
+            return None
+        return route[0]
+
+    def forget(self, address):
+        self._routes.pop(address, None)
+
+    def link_failed(self, address):
+        #address stopped answering, every route through it is gone
+        for destination in list(self._routes):
+            if(self._routes[destination][0][0] == address):
+                del self._routes[destination]
+
+    def routes_text(self):
+        text = ""
+        for destination in self._routes:
+            route = self._routes[destination]
+            text += str(destination) + ":" + "-".join([str(hop) for hop in route[0]]) + "/" + str(route[1]) + ";"
+        return text
+
+    def _penalty(self, packet):
+        return max(0, min(LINK_PENALTY, 5 - int(packet.snr)))
+
+    def learn(self, packet):
+        #Every frame proves the link to its transmitter and, for relayed frames, the hops it already took
+        penalty = self._penalty(packet)
+        self._learn_path([packet.header_from], penalty)
+        relay_Addresses = packet.relay_Addresses
+        if(len(relay_Addresses) > 0 and packet.header_from in relay_Addresses):
+            position = relay_Addresses.index(packet.header_from)
+            self._learn_path([relay_Addresses[i] for i in range(position, -1, -1)], penalty)
+
+    def _learn_path(self, hops, penalty):
+        #hops starts with a neighbour, every prefix of it is a route to its last hop
+        this_address = self.lora._this_address
+        now = time.ticks_ms()
+        for length in range(1, len(hops) + 1):
+            destination = hops[length - 1]
+            if(destination == this_address or destination == BROADCAST_ADDRESS):
+                return
+            cost = length * HOP_COST + penalty
+            route = self._routes.get(destination)
+            if(route is not None and route[1] < cost and time.ticks_diff(now, route[2]) <= self.route_ttl * 1000):
+                continue
+            if(route is None and len(self._routes) >= self.max_routes):
+                self._evict()
+            self._routes[destination] = [hops[:length], cost, now]
+
+    def _evict(self):
+        oldest = None
+        for destination in self._routes:
+            if(oldest is None or time.ticks_diff(self._routes[oldest][2], self._routes[destination][2]) > 0):
+                oldest = destination
+        del self._routes[oldest]
+
+    def discover(self, address, on_done):
+        discovery = self._discoveries.get(address)
+        if(discovery is not None):
+            discovery[3].append(on_done)
+            return
+        self._discoveries[address] = [self.lora.get_new_header_id(), time.ticks_ms(), 0, [on_done]]
+
+    def _discovery_timeout_ms(self):
+        #Time for the request to spread max_hops out and the reply to come back, forwarding jitter included
+        hop = 3 * self.lora.airtime_ms(6 + self.max_hops)
+        return int(2 * self.max_hops * hop + self.lora.retry_timeout * 1000)
+
+    def _finish_discovery(self, address, route):
+        discovery = self._discoveries.pop(address, None)
+        if(discovery is None):
+            return
+        if(route is None):
+            self.lora.pico_logger.WriteNewLog("No route to " + str(address))
+        for on_done in discovery[3]:
+            on_done(route)
+
+    def next_poll_ms(self, default):
+        now = time.ticks_ms()
+        wait = default
+        for forward in self._forward:
+            wait = min(wait, max(0, time.ticks_diff(forward[0], now)))
+        for discovery in self._discoveries.values():
+            wait = min(wait, max(0, time.ticks_diff(discovery[1], now)))
+        return wait
+
+    def poll(self):
+        lora = self.lora
+        now = time.ticks_ms()
+        for key in list(self._requests_seen):
+            if(time.ticks_diff(now, self._requests_seen[key]) > self.route_ttl * 1000):
+                del self._requests_seen[key]
+
+        for address in list(self._discoveries):
+            discovery = self._discoveries[address]
+            if(time.ticks_diff(now, discovery[1]) < 0):
+                continue
+            if(discovery[2] > self.retries):
+                self._finish_discovery(address, None)
+                continue
+            if(lora._mode == MODE_TX):
+                return
+            discovery[2] += 1
+            self._requests_seen[(lora._this_address, discovery[0])] = now
+            lora.send(bytes((address, lora._this_address)), BROADCAST_ADDRESS, discovery[0], FLAGS_ROUTE_REQUEST)
+            lora.set_mode_rx()
+            discovery[1] = time.ticks_add(now, self._discovery_timeout_ms() << (discovery[2] - 1))
+
+        while len(self._forward) > 0 and time.ticks_diff(now, self._forward[0][0]) >= 0:
+            if(lora._mode == MODE_TX):
+                return
+            forward = self._forward.pop(0)
+            lora.send(forward[1], BROADCAST_ADDRESS, forward[2], FLAGS_ROUTE_REQUEST)
+            lora.set_mode_rx()
+
+    def _on_route_request(self, packet):
+        #data: destination, then the path so far starting with the origin
+        message = packet.message
+        if(len(message) < 2):
+            return
+        destination = message[0]
+        path = list(message[1:])
+        this_address = self.lora._this_address
+        key = (path[0], packet.header_id)
+        if(key in self._requests_seen or this_address in path):
+            return
+        self._requests_seen[key] = time.ticks_ms()
+        self._learn_path(self.lora.reverse_list(path), self._penalty(packet))
+
+        if(destination == this_address):
+            path.append(this_address)
+            self.lora.send_soon(bytes(path), packet.header_from, packet.header_id, FLAGS_ROUTE_REPLY)
+            return
+        if(len(path) >= self.max_hops):
+            return
+        #Neighbours that heard the same request wait a random slot so their copies don't collide
+        airtime = self.lora.airtime_ms(len(message) + 6)
+        due = time.ticks_add(time.ticks_ms(), int(airtime * (1 + (getrandbits(8) >> 6))))
+        self._forward.append([due, bytes(message) + bytes((this_address,)), packet.header_id])
+        self._forward.sort(key=lambda forward: time.ticks_diff(forward[0], due))
+
+    def _on_route_reply(self, packet):
+        #data: the whole path from the origin to the destination, sent back hop by hop
+        path = list(packet.message)
+        this_address = self.lora._this_address
+        if(len(path) < 2 or this_address not in path):
+            return
+        position = path.index(this_address)
+        self._learn_path(path[position + 1:], self._penalty(packet))
+        if(position == 0):
+            self._finish_discovery(path[-1], self.route(path[-1]))
+            return
+        self.lora.send_soon(packet.message, path[position - 1], packet.header_id, FLAGS_ROUTE_REPLY)
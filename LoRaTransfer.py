@@ -0,0 +1,367 @@
+import time
+import uio
+from LoRa import FLAGS_FRAGMENT, FLAGS_FRAGMENT_ACK, FLAGS_TRANSFER_REQUEST, MODE_TX, MODE_STDBY
+
+#Fragment data per frame, 5 byte header + 3 byte subheader + data still fits the FIFO after AES padding
+FRAGMENT_SIZE = 236
+FRAGMENT_HEADER = 3
+FRAGMENT_STRIDE = FRAGMENT_HEADER + FRAGMENT_SIZE
+#Fragments per window, one FLAGS_FRAGMENT_ACK bitmap byte covers a window
+TRANSFER_WINDOW = 8
+
+#Fragment subheader: sequence (2 bytes, big endian), control
+FRAGMENT_FINAL = 0x01
+FRAGMENT_POLL = 0x02
+FRAGMENT_ERROR = 0x04
+#Set on every fragment (and echoed in the ack) of a transfer asked for with request(), the transfer id
+#then comes from the receiver's header ids so it is kept apart from the sender's own transfers
+FRAGMENT_REQUESTED = 0x08
+
+class OutgoingTransfer(object):
+    __slots__ = ('header_to', 'transfer_id', 'stream', 'buffer', 'view', 'lengths', 'base', 'count', 'final',
+                 'to_send', 'poll_slot', 'waiting', 'deadline', 'retries', 'sent_bytes', 'error', 'on_done', 'control')
+
+    def __init__(self, header_to, transfer_id, stream, on_done=None, requested=False):
+        self.header_to = header_to
+        self.transfer_id = transfer_id
+        self.stream = stream
+        self.control = FRAGMENT_REQUESTED if requested else 0
+        # one window of fragments, each slot is subheader + data so a fragment goes out without a copy
+        self.buffer = bytearray(TRANSFER_WINDOW * FRAGMENT_STRIDE)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * TRANSFER_WINDOW
+        self.base = 0
+        self.count = 0
+        self.final = False
+        self.to_send = []
+        self.poll_slot = 0
+        self.waiting = False
+        self.deadline = 0
+        self.retries = 0
+        self.sent_bytes = 0
+        self.error = None
+        self.on_done = on_done
+
+    def fill(self):
+        #Reads the next window from the stream, a short read is the end of it
+        self.count = 0
+        for slot in range(TRANSFER_WINDOW):
+            start = slot * FRAGMENT_STRIDE
+            length = self.stream.readinto(self.view[start + FRAGMENT_HEADER:start + FRAGMENT_STRIDE]) or 0
+            seq = self.base + slot
+            self.buffer[start] = (seq >> 8) & 0xff
+            self.buffer[start + 1] = seq & 0xff
+            self.buffer[start + 2] = self.control
+            self.lengths[slot] = length
+            self.count += 1
+            if(length < FRAGMENT_SIZE):
+                self.final = True
+                self.buffer[start + 2] = self.control | FRAGMENT_FINAL
+                break
+        self.to_send = list(range(self.count))
+
+    def fragment(self, slot, poll):
+        start = slot * FRAGMENT_STRIDE
+        if(poll):
+            self.buffer[start + 2] |= FRAGMENT_POLL
+        else:
+            self.buffer[start + 2] &= ~FRAGMENT_POLL
+        return self.view[start:start + FRAGMENT_HEADER + self.lengths[slot]]
+
+class IncomingTransfer(object):
+    __slots__ = ('header_from', 'transfer_id', 'buffer', 'view', 'lengths', 'base', 'received', 'final_slot',
+                 'offset', 'message', 'last_heard')
+
+    def __init__(self, header_from, transfer_id, assemble):
+        self.header_from = header_from
+        self.transfer_id = transfer_id
+        self.buffer = bytearray(TRANSFER_WINDOW * FRAGMENT_SIZE)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * TRANSFER_WINDOW
+        self.base = 0
+        self.received = 0
+        self.final_slot = None
+        self.offset = 0
+        self.message = bytearray() if assemble else None
+        self.last_heard = time.ticks_ms()
+
+    def window_complete(self):
+        last = TRANSFER_WINDOW - 1 if self.final_slot is None else self.final_slot
+        return self.received == (1 << (last + 1)) - 1
+
+class LoRaTransfer(object):
+    """
+    LoRaTransfer(lora, max_message_bytes=8192, max_incoming=2, retries=5)
+    Moves payloads larger than one frame between neighbours. The data is split into numbered
+    fragments and sent TRANSFER_WINDOW at a time, the last fragment of a window asks the
+    receiver for one FLAGS_FRAGMENT_ACK bitmap and only the missing fragments are sent again.
+    The receiver hands each completed window to on_data(address, transfer_id, offset, data),
+    or without on_data assembles up to max_message_bytes for on_complete.
+    on_complete(address, transfer_id, message, error) ends every incoming transfer,
+    on_request(address, name) returns a readable stream (or None) for request() from a neighbour.
+    poll() has to be called regularly, it sends the next fragment and handles timeouts.
+    """
+    def __init__(self, lora, max_message_bytes=8192, max_incoming=2, retries=5):
+        self.lora = lora
+        self.max_message_bytes = max_message_bytes
+        self.max_incoming = max_incoming
+        self.retries = retries
+        self.idle_timeout = 30000 #ms without a fragment before an incoming transfer is dropped
+
+        self.on_data = None
+        self.on_complete = None
+        self.on_request = None
+
+        # (address, transfer_id, requested) -> transfer
+        self._outgoing = {}
+        self._incoming = {}
+        # (address, transfer_id) -> [name, deadline, attempts]
+        self._requests = {}
+        # (address, transfer_id, requested) -> ticks_ms, incoming transfers seen within idle_timeout
+        self._recent = {}
+        self._sack = bytearray(4)
+
+        lora.flag_handlers[FLAGS_FRAGMENT] = self._on_fragment
+        lora.flag_handlers[FLAGS_FRAGMENT_ACK] = self._on_fragment_ack
+        lora.flag_handlers[FLAGS_TRANSFER_REQUEST] = self._on_request
+
+    def send(self, header_to, data, on_done=None):
+        """
+        Starts sending data (bytes, str or a stream with readinto) to header_to and returns the
+        OutgoingTransfer, on_done(transfer) is called with transfer.error None on success.
+        """
+        if type(data) == str:
+            data = data.encode()
+        if type(data) in (bytes, bytearray, memoryview):
+            data = uio.BytesIO(data)
+        return self._start(header_to, self.lora.get_new_header_id(), data, on_done)
+
+    def request(self, header_to, name):
+        #Asks header_to to send us name, the answer arrives through on_data/on_complete
+        transfer_id = self.lora.get_new_header_id()
+        self._requests[(header_to, transfer_id)] = [name, time.ticks_ms(), 0]
+        return transfer_id
+
+    def busy(self):
+        return len(self._outgoing) > 0 or len(self._incoming) > 0 or len(self._requests) > 0
+
+    def _start(self, header_to, transfer_id, stream, on_done, requested=False):
+        transfer = OutgoingTransfer(header_to, transfer_id, stream, on_done, requested)
+        transfer.fill()
+        self._outgoing[(header_to, transfer_id, requested)] = transfer
+        return transfer
+
+    def _timeout_ms(self, address):
+        return self.lora.retransmission_timeout_ms(address, 5 + FRAGMENT_STRIDE)
+
+    def next_poll_ms(self, default):
+        #How long the caller can sleep before poll() has work again
+        now = time.ticks_ms()
+        wait = default
+        for transfer in self._outgoing.values():
+            if(len(transfer.to_send) > 0):
+                ready = self.lora.tx_delay_ms(5 + FRAGMENT_STRIDE)
+                if(self.lora._mode == MODE_TX):
+                    #TxDone does not wake the rx wait, sleep for the rest of the airtime instead
+                    ready = max(ready, self.lora._tx_airtime_ms - time.ticks_diff(now, self.lora._tx_start))
+                return max(1, min(wait, ready))
+            if(transfer.waiting):
+                wait = min(wait, max(0, time.ticks_diff(transfer.deadline, now)))
+        for request in self._requests.values():
+            wait = min(wait, max(0, time.ticks_diff(request[1], now)))
+        return wait
+
+    def poll(self):
+        lora = self.lora
+        now = time.ticks_ms()
+        for key in list(self._requests):
+            request = self._requests[key]
+            if(time.ticks_diff(request[1], now) > 0):
+                continue
+            if(request[2] > self.retries):
+                del self._requests[key]
+                self._complete(key[0], key[1], None, "no answer to request")
+                continue
+            if(lora._mode == MODE_TX):
+                return
+            request[2] += 1
+            if(lora.send(request[0], key[0], key[1], FLAGS_TRANSFER_REQUEST)):
+                request[1] = time.ticks_add(now, self._timeout_ms(key[0]) << min(request[2] - 1, 4))
+
+        for key in list(self._outgoing):
+            transfer = self._outgoing[key]
+            if(len(transfer.to_send) > 0):
+                if(lora._mode == MODE_TX):
+                    return
+                slot = transfer.to_send[0]
+                last = len(transfer.to_send) == 1
+                if(not lora.send(transfer.fragment(slot, last), transfer.header_to, transfer.transfer_id, FLAGS_FRAGMENT, log=False)):
+                    return
+                transfer.to_send.pop(0)
+                transfer.sent_bytes += transfer.lengths[slot]
+                if(last):
+                    lora.set_mode_rx()
+                    transfer.poll_slot = slot
+                    transfer.waiting = True
+                    transfer.deadline = time.ticks_add(time.ticks_ms(), self._timeout_ms(transfer.header_to))
+                return
+            if(transfer.waiting and time.ticks_diff(now, transfer.deadline) >= 0):
+                transfer.retries += 1
+                if(transfer.retries > self.retries):
+                    self._finish(key, "no fragment ack from " + str(transfer.header_to))
+                    continue
+                #Either the polling fragment or its ack got lost, asking again covers both
+                transfer.waiting = False
+                transfer.to_send = [transfer.poll_slot]
+
+        for key in list(self._recent):
+            if(time.ticks_diff(now, self._recent[key]) > self.idle_timeout):
+                del self._recent[key]
+        for key in list(self._incoming):
+            if(time.ticks_diff(now, self._incoming[key].last_heard) > self.idle_timeout):
+                del self._incoming[key]
+                self._complete(key[0], key[1], None, "transfer timed out")
+
+        if(lora._mode == MODE_STDBY):
+            lora.set_mode_rx()
+
+    def _finish(self, key, error):
+        transfer = self._outgoing.pop(key)
+        transfer.error = error
+        if(hasattr(transfer.stream, 'close')):
+            transfer.stream.close()
+        if(error is not None):
+            self.lora.pico_logger.WriteNewLog("LoRaTransfer " + str(transfer.transfer_id) + " to " + str(transfer.header_to) + " failed: " + error)
+        if(transfer.on_done is not None):
+            transfer.on_done(transfer)
+
+    def _complete(self, address, transfer_id, message, error):
+        if(self.on_complete is not None):
+            self.on_complete(address, transfer_id, message, error)
+
+    def _on_fragment_ack(self, packet):
+        message = packet.message
+        if(len(message) < 4):
+            return
+        key = (packet.header_from, packet.header_id, message[3] & FRAGMENT_REQUESTED != 0)
+        transfer = self._outgoing.get(key)
+        if(transfer is None):
+            return
+        base = (message[0] << 8) | message[1]
+        if(base != transfer.base or len(transfer.to_send) > 0):
+            return
+        transfer.waiting = False
+        transfer.retries = 0
+        missing = [slot for slot in range(transfer.count) if not message[2] & (1 << slot)]
+        if(len(missing) > 0):
+            transfer.to_send = missing
+        elif(transfer.final):
+            self._finish(key, None)
+        else:
+            transfer.base += TRANSFER_WINDOW
+            transfer.fill()
+
+    def _on_request(self, packet):
+        if((packet.header_from, packet.header_id, True) in self._outgoing):
+            return
+        name = bytes(packet.message).decode()
+        stream = None
+        try:
+            if(self.on_request is not None):
+                stream = self.on_request(packet.header_from, name)
+        except Exception as e:
+            self.lora.pico_logger.WriteNewLog("LoRaTransfer request " + name + " failed: " + str(e))
+        if(stream is None):
+            stream = uio.BytesIO(name.encode())
+            transfer = self._start(packet.header_from, packet.header_id, stream, None, True)
+            transfer.buffer[2] |= FRAGMENT_ERROR
+            return
+        self._start(packet.header_from, packet.header_id, stream, None, True)
+
+    def _on_fragment(self, packet):
+        message = packet.message
+        if(len(message) < FRAGMENT_HEADER):
+            return
+        seq = (message[0] << 8) | message[1]
+        control = message[2]
+        requested = control & FRAGMENT_REQUESTED != 0
+        key = (packet.header_from, packet.header_id, requested)
+        if(requested):
+            self._requests.pop((packet.header_from, packet.header_id), None)
+
+        transfer = self._incoming.get(key)
+        if(transfer is None):
+            if(key in self._recent):
+                #Tail of a transfer we already delivered, the sender missed our last ack
+                self._recent[key] = time.ticks_ms()
+                if(control & FRAGMENT_POLL):
+                    self._send_sack(packet.header_from, packet.header_id, control, seq - seq % TRANSFER_WINDOW, 0xff)
+                return
+            if(control & FRAGMENT_ERROR):
+                self._recent[key] = time.ticks_ms()
+                if(control & FRAGMENT_POLL):
+                    self._send_sack(packet.header_from, packet.header_id, control, 0, 0xff)
+                self._complete(packet.header_from, packet.header_id, None, "not available: " + bytes(message[FRAGMENT_HEADER:]).decode())
+                return
+            if(len(self._incoming) >= self.max_incoming):
+                return
+            transfer = IncomingTransfer(packet.header_from, packet.header_id, self.on_data is None)
+            self._incoming[key] = transfer
+
+        #Kept until idle_timeout after the last fragment so the final ack can be sent again
+        transfer.last_heard = time.ticks_ms()
+        self._recent[key] = transfer.last_heard
+        base = seq - seq % TRANSFER_WINDOW
+        if(base < transfer.base):
+            if(control & FRAGMENT_POLL):
+                self._send_sack(packet.header_from, packet.header_id, control, base, 0xff)
+            return
+        if(base > transfer.base):
+            return
+
+        slot = seq - base
+        length = len(message) - FRAGMENT_HEADER
+        if(not transfer.received & (1 << slot)):
+            transfer.view[slot * FRAGMENT_SIZE:slot * FRAGMENT_SIZE + length] = message[FRAGMENT_HEADER:]
+            transfer.lengths[slot] = length
+            transfer.received |= 1 << slot
+            if(control & FRAGMENT_FINAL):
+                transfer.final_slot = slot
+
+        received = transfer.received
+        if(transfer.window_complete()):
+            received = 0xff
+            if(not self._deliver(key, transfer)):
+                return
+        if(control & FRAGMENT_POLL):
+            self._send_sack(packet.header_from, packet.header_id, control, base, received)
+
+    def _deliver(self, key, transfer):
+        #Hands the completed window on in order and moves to the next one
+        last = TRANSFER_WINDOW - 1 if transfer.final_slot is None else transfer.final_slot
+        for slot in range(last + 1):
+            data = transfer.view[slot * FRAGMENT_SIZE:slot * FRAGMENT_SIZE + transfer.lengths[slot]]
+            if(transfer.message is not None):
+                if(len(transfer.message) + len(data) > self.max_message_bytes):
+                    del self._incoming[key]
+                    self._complete(key[0], key[1], None, "message larger than " + str(self.max_message_bytes) + " bytes")
+                    return False
+                transfer.message.extend(data)
+            elif(len(data) > 0):
+                self.on_data(key[0], key[1], transfer.offset, data)
+            transfer.offset += len(data)
+        transfer.base += TRANSFER_WINDOW
+        transfer.received = 0
+        if(transfer.final_slot is not None):
+            del self._incoming[key]
+            self._recent[key] = time.ticks_ms()
+            self._complete(key[0], key[1], bytes(transfer.message) if transfer.message is not None else None, None)
+        return True
+
+    def _send_sack(self, header_to, transfer_id, control, base, received):
+        sack = self._sack
+        sack[0] = (base >> 8) & 0xff
+        sack[1] = base & 0xff
+        sack[2] = received & 0xff
+        sack[3] = control & FRAGMENT_REQUESTED
+        self.lora.send_soon(sack, header_to, transfer_id, FLAGS_FRAGMENT_ACK, log=False)
@@ -0,0 +1,63 @@
+from array import array
+
+#Counter slots, count(slot) from anywhere, GetStats prints them with COUNTER_NAMES
+RX_FRAMES = 0
+RX_CRC_ERRORS = 1
+RX_DROPPED = 2 #rx ring full
+TX_FRAMES = 3
+TX_AIRTIME_MS = 4
+TX_DEFERRED = 5 #duty cycle
+SEND_RETRIES = 6
+ACK_OK = 7
+ACK_FAILED = 8
+RELAY_FORWARDED = 9
+RELAY_FAILED = 10
+RELAY_RETURNED = 11 #replies from the far end handed back towards the origin
+SERIAL_COMMANDS = 12
+SERIAL_QUEUE_FULL = 13
+SERIAL_BAD_FRAMES = 14
+LOG_RECORDS = 15
+LOG_DROPPED = 16
+COUNTER_NAMES = ("rx", "crc", "rxDropped", "tx", "airMs", "deferred", "retries", "ackOk", "ackFailed",
+                 "relayed", "relayFailed", "relayReturned", "commands", "queueFull", "badFrames", "logs", "logsDropped")
+
+#Histograms, a value goes in the first bucket whose bound it does not exceed, the last bucket takes the rest
+ACK_RTT_MS = 0
+SEND_ATTEMPTS = 1
+SERIAL_QUEUE_DEPTH = 2
+LOG_BACKLOG = 3
+HISTOGRAM_NAMES = ("rttMs", "attempts", "queue", "logBacklog")
+HISTOGRAM_BOUNDS = (
+    (50, 100, 200, 500, 1000, 2000, 5000),
+    (1, 2, 3, 4, 5, 6, 8),
+    (0, 1, 2, 4, 8, 16, 32),
+    (0, 8, 16, 32, 64, 128, 256),
+)
+HISTOGRAM_BUCKETS = 8
+
+counters = array('L', [0] * len(COUNTER_NAMES))
+histograms = array('L', [0] * (len(HISTOGRAM_NAMES) * HISTOGRAM_BUCKETS))
+
+def count(slot, amount=1):
+    counters[slot] += amount
+
+def observe(histogram, value):
+    bounds = HISTOGRAM_BOUNDS[histogram]
+    bucket = 0
+    while bucket < len(bounds) and value > bounds[bucket]:
+        bucket += 1
+    histograms[histogram * HISTOGRAM_BUCKETS + bucket] += 1
+
+def reset():
+    for i in range(len(counters)):
+        counters[i] = 0
+    for i in range(len(histograms)):
+        histograms[i] = 0
+
+def stats_text():
+    #name:value,... for the counters, then name:bucket/bucket/...; for each histogram
+    text = ",".join([COUNTER_NAMES[i] + ":" + str(counters[i]) for i in range(len(counters))])
+    for histogram in range(len(HISTOGRAM_NAMES)):
+        start = histogram * HISTOGRAM_BUCKETS
+        text += ";" + HISTOGRAM_NAMES[histogram] + ":" + "/".join([str(histograms[i]) for i in range(start, start + HISTOGRAM_BUCKETS)])
+    return text
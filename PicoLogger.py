@@ -1,46 +1,160 @@
 import utime
 import os
+import binascii
+import array
+import Metrics
+
+LOG_CHUNK_SIZE = 256 #bytes per GetLog reply frame
+LOG_MAX_REQUEST = 4096 #largest GetLog request served in one go, serial stays free for other commands
+
+#Binary log record: time (4 bytes, big endian), category, node, varint text length, text
+LOG_RECORD_HEADER = 6
+#Every segment has an index file of (time, offset) pairs, 4 bytes each, one per LOG_INDEX_INTERVAL bytes of log
+LOG_INDEX_INTERVAL = 4096
+
+#Categories, stored with each record
+LOG_GENERAL = 0
+LOG_RECEIVED = 1 #messages from other nodes and the replies to them
+LOG_SENT = 2
+LOG_RELAY = 3
+LOG_RADIO = 4 #frames on air, radio state
+LOG_ERROR = 5
+LOG_CATEGORIES = 8
+
+#Levels, records below PicoLogger.Level are never stored
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_ERROR = 40
 
 class PicoLogger:
-    def __init__(self, picoSerial):
+    def __init__(self, picoSerial, capacity = 256, binaryLog = False):
         self.PicoSerial = picoSerial
-        self.LogFileName = "log.txt"
+        #binaryLog saves compact records to log.bin with a time index in log.idx, QueryLog reads them back
+        self.BinaryLog = binaryLog
+        self.LogFileName = "log.bin" if binaryLog else "log.txt"
+        self.IndexFileName = "log.idx"
         self.Max_File_Size = 300000
         self.TimeDelta = None #Needs to be set from serial
-        self._PendingLoggedData = list()
         self.lastLogged = 0
         self.loggedTimeFrame = 60 #Save Log every 1 min
-        
+        self._chunk = bytearray(LOG_CHUNK_SIZE)
+
+        #Pending records, a ring of fixed slots: time logged (seconds, TimeDelta applied) and text
+        self.capacity = capacity
+        self._times = array.array('L', [0] * capacity)
+        self._texts = [None] * capacity #text, or a % template when _args has its arguments
+        self._args = [None] * capacity
+        self._categories = bytearray(capacity)
+        self._nodes = bytearray(capacity)
+        self._head = 0 #oldest record
+        self._count = 0
+        self.droppedLogs = 0 #records overwritten before they were saved
+        self._droppedReported = 0
+
+        #What gets logged: level, one bit per category, and keep 1 in N of a category's records below warning
+        self.Level = LEVEL_INFO
+        self.CategoryMask = (1 << LOG_CATEGORIES) - 1
+        self._sampleEvery = bytearray(LOG_CATEGORIES)
+        self._sampleCount = bytearray(LOG_CATEGORIES)
+
+        self._logFile = None
+        self._logFileSize = 0
+        self._indexFile = None
+        self._lastIndexed = -LOG_INDEX_INTERVAL
+        self._header = bytearray(LOG_RECORD_HEADER + 3) #varint length up to 2 MB
+
     def commit_log(self, forceCommit = False):
-        if (utime.time() - self.lastLogged < self.loggedTimeFrame and forceCommit == False):
+        #Saves early once the ring is 3/4 full so a busy minute does not overwrite records
+        if (utime.time() - self.lastLogged < self.loggedTimeFrame and forceCommit == False and self._count < (self.capacity * 3) // 4):
             return
-        self.lastLogged = utime.time()    
-        
+        self.lastLogged = utime.time()
+        Metrics.observe(Metrics.LOG_BACKLOG, self._count)
+
         try:
-            splitList = []
-            for logged in list(self._PendingLoggedData):
-                if(len(splitList) > 50):
-                    if(self.CheckFileSize() > self.Max_File_Size):
-                        self.SaveLogToNewFileDeleteOld()
-                    self.BatchWriteFile(splitList)
-                    splitList = []
-
-                splitList.append(logged)
-                self._PendingLoggedData.remove(logged)
-            if(len(splitList)>0):
-                self.BatchWriteFile(splitList)
+            if(self.droppedLogs != self._droppedReported):
+                self._WriteLine(utime.time() + (self.TimeDelta or 0), LOG_ERROR, 0, "5: " + str(self.droppedLogs - self._droppedReported) + " log entries dropped, logging faster than saving")
+                self._droppedReported = self.droppedLogs
+            while self._count > 0:
+                slot = self._head
+                text = self._texts[slot]
+                args = self._args[slot]
+                self._texts[slot] = None
+                self._args[slot] = None
+                if(args):
+                    text = self._Format(text, args)
+                self._head = (slot + 1) % self.capacity
+                self._count -= 1
+                self._WriteLine(self._times[slot], self._categories[slot], self._nodes[slot], text)
+            if(self._logFile is not None):
+                self._logFile.flush()
+            if(self._indexFile is not None):
+                self._indexFile.flush()
         except Exception as e:
+            self._CloseLogFile()
             self.PicoSerial.Write("4: commit_log Logged data could not be saved to board: " + str(e))
 
-    def BatchWriteFile(self, loggTextList):
-        try:
-            logFile = open(self.LogFileName,"a") 
-            for logText in loggTextList:
-                logFile.write(logText)
-            logFile.flush()
-            logFile.close()
-        except Exception as e:
-            self.PicoSerial.Write("4: BatchWriteFile Logged data could not be saved to board: " + str(e))
+    def _WriteLine(self, loggedTime, category, node, logText):
+        if(self._logFile is None):
+            self._logFile = open(self.LogFileName, "ab" if self.BinaryLog else "a")
+            self._logFileSize = self.CheckFileSize()
+            self._lastIndexed = -LOG_INDEX_INTERVAL
+        elif(self._logFileSize > self.Max_File_Size):
+            self._CloseLogFile()
+            self.SaveLogToNewFileDeleteOld()
+            self._logFile = open(self.LogFileName, "ab" if self.BinaryLog else "a")
+            self._logFileSize = 0
+            self._lastIndexed = -LOG_INDEX_INTERVAL
+        if(self.BinaryLog):
+            self._WriteRecord(loggedTime, category, node, logText)
+            return
+        line = self.FormatLine(loggedTime, logText)
+        self._logFile.write(line)
+        self._logFileSize += len(line)
+
+    def FormatLine(self, loggedTime, logText):
+        dateTime = utime.localtime(loggedTime)
+        line = "%04d-%02d-%02d %02d:%02d:%02d\t"%(dateTime[0:3] + dateTime[3:6]) + logText
+        if("\r\n" not in line):
+            line += "\r\n"
+        return line
+
+    def _WriteRecord(self, loggedTime, category, node, logText):
+        if(self._logFileSize - self._lastIndexed >= LOG_INDEX_INTERVAL):
+            #Sparse index, a query seeks to the last entry before its start time
+            if(self._indexFile is None):
+                self._indexFile = open(self.IndexFileName, "ab")
+            self._indexFile.write(loggedTime.to_bytes(4, "big") + self._logFileSize.to_bytes(4, "big"))
+            self._lastIndexed = self._logFileSize
+        text = logText.encode()
+        header = self._header
+        header[0] = (loggedTime >> 24) & 0xff
+        header[1] = (loggedTime >> 16) & 0xff
+        header[2] = (loggedTime >> 8) & 0xff
+        header[3] = loggedTime & 0xff
+        header[4] = category
+        header[5] = node
+        length = len(text)
+        headerLength = LOG_RECORD_HEADER
+        while True:
+            header[headerLength] = (length & 0x7f) | (0x80 if length > 0x7f else 0)
+            headerLength += 1
+            length >>= 7
+            if(length == 0 or headerLength == len(header)):
+                break
+        self._logFile.write(memoryview(header)[:headerLength])
+        self._logFile.write(text)
+        self._logFileSize += headerLength + len(text)
+
+    def _CloseLogFile(self):
+        for logFile in (self._logFile, self._indexFile):
+            if(logFile is not None):
+                try:
+                    logFile.close()
+                except:
+                    pass
+        self._logFile = None
+        self._indexFile = None
 
     def TimeNow(self):
         if(self.TimeDelta is not None):
@@ -59,14 +173,22 @@ class PicoLogger:
             return 0 
   
     def SaveLogToNewFileDeleteOld(self):
-        for fileName in os.listdir():
-            if(self.LogFileName in fileName):
-                if(fileName == self.LogFileName):
-                    os.rename(fileName, self.LogFileName + "1")
-                elif(fileName[len(fileName)-1] == "1"):
-                    os.rename(fileName, self.LogFileName + "2")
-                else:
-                    os.remove(fileName)
+        self._RotateFiles(self.LogFileName)
+        if(self.BinaryLog):
+            self._RotateFiles(self.IndexFileName)
+
+    def _RotateFiles(self, baseName):
+        #Oldest first, listdir order would let name1 be moved on top of the file just rotated into it
+        files = os.listdir()
+        for fileName in files:
+            if(fileName.startswith(baseName) and fileName[len(baseName):] not in ("", "1", "2")):
+                os.remove(fileName)
+        if(baseName + "2" in files):
+            os.remove(baseName + "2")
+        if(baseName + "1" in files):
+            os.rename(baseName + "1", baseName + "2")
+        if(baseName in files):
+            os.rename(baseName, baseName + "1")
 
     #YYYY MM DD HH MM SS
     def SetDateTime(self, dateTimeInput):
@@ -76,21 +198,69 @@ class PicoLogger:
         dateTime = self.TimeNow()
         return str("%04d-%02d-%02d %02d:%02d:%02d"%(dateTime[0:3] + dateTime[3:6]))
 
-    def WriteNewLog(self, logText):
-        dateTime = self.TimeNow()
-        dateTimeFormatted = "%04d-%02d-%02d %02d:%02d:%02d"%(dateTime[0:3] + dateTime[3:6])
-        logText = dateTimeFormatted + "\t" + logText
-        if("\r\n" not in logText):
-            logText += "\r\n"
-        self._PendingLoggedData.append(logText)
+    def _Format(self, template, args):
+        try:
+            return template % args
+        except Exception:
+            return template + " " + str(args)
+
+    def Enabled(self, level, category):
+        #For callers that have to copy something before they can log it, sampling still happens in Log
+        return level >= self.Level and (self.CategoryMask >> category) & 1
+
+    def Log(self, level, category, node, template, *args):
+        #template % args is only formatted when commit_log saves the record, args must not change until then
+        if(level < self.Level or not (self.CategoryMask >> category) & 1):
+            return
+        every = self._sampleEvery[category]
+        if(every > 1 and level < LEVEL_WARNING):
+            count = self._sampleCount[category] + 1
+            if(count < every):
+                self._sampleCount[category] = count
+                return
+            self._sampleCount[category] = 0
+        self._Store(category, node, template, args)
+
+    def SetLevel(self, level, categoryMask = None):
+        self.Level = level
+        if(categoryMask is not None):
+            self.CategoryMask = categoryMask
+
+    def SetSample(self, category, every):
+        #Keep 1 in every records of category below warning, 0 or 1 keeps them all
+        self._sampleEvery[category] = min(every, 255)
+        self._sampleCount[category] = 0
+
+    def LevelText(self):
+        return str(self.Level) + "," + hex(self.CategoryMask) + "," + ":".join([str(every) for every in self._sampleEvery])
+
+    def WriteNewLog(self, logText, category = LOG_GENERAL, node = 0):
+        self.Log(LEVEL_INFO, category, node, logText)
+
+    def _Store(self, category, node, template, args):
+        #Only stored here, the line is formatted when commit_log saves it. node is the address the record is about
+        if(self._count == self.capacity):
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            self.droppedLogs += 1
+            Metrics.count(Metrics.LOG_DROPPED)
+        slot = (self._head + self._count) % self.capacity
+        self._times[slot] = utime.time() + (self.TimeDelta or 0)
+        self._texts[slot] = template
+        self._args[slot] = args
+        self._categories[slot] = category
+        self._nodes[slot] = node
+        self._count += 1
+        Metrics.count(Metrics.LOG_RECORDS)
 
     def SendLogToSerial(self, logFile):
-        line = logFile.readline()
-        while line:
-             self.PicoSerial.Write(str(line), False)
-             line = logFile.readline()
-        
+        #Every line of the file behind one driver enable
+        self.PicoSerial.WriteBatch(logFile)
+
     def SendLoggedDataToSerial(self):
+        if(self.BinaryLog):
+            self.SendQueryToSerial(0, 0xffffffff)
+            return
         self.commit_log(True)
         for fileName in os.listdir():
             if(self.LogFileName not in fileName):
@@ -98,4 +268,110 @@ class PicoLogger:
             file = open(fileName, "r")
             self.SendLogToSerial(file)
             file.close()
-        self.PicoSerial.Write(None)
\ No newline at end of file
+
+    def LogFiles(self):
+        #(name, size) of every log segment, newest first
+        files = []
+        for fileName in sorted(os.listdir()):
+            if(fileName.startswith(self.LogFileName)):
+                files.append((fileName, os.stat(fileName)[6]))
+        return files
+
+    def SendLogFilesToSerial(self):
+        self.commit_log(True)
+        text = ""
+        for fileName, size in self.LogFiles():
+            text += fileName + ":" + str(size) + ";"
+        self.PicoSerial.Write("0,GetLogFiles," + text)
+
+    def SendLogChunksToSerial(self, fileName, offset, length):
+        #Each chunk is one frame "GetLog,file,offset,crc32," + data, then "0,GetLog,file,next offset,size"
+        size = None
+        for logFile in self.LogFiles():
+            if(logFile[0] == fileName):
+                size = logFile[1]
+        if(size is None or offset < 0 or length <= 0):
+            self.PicoSerial.Write("1,GetLog," + str(fileName) + ",404")
+            return
+        if(fileName == self.LogFileName):
+            self.commit_log(True)
+            size = os.stat(fileName)[6]
+
+        end = min(size, offset + min(length, LOG_MAX_REQUEST))
+        chunk = memoryview(self._chunk)
+        file = open(fileName, "rb")
+        try:
+            file.seek(offset)
+            while offset < end:
+                read = file.readinto(chunk[:min(LOG_CHUNK_SIZE, end - offset)])
+                if(not read):
+                    break
+                header = "GetLog," + fileName + "," + str(offset) + "," + str(binascii.crc32(chunk[:read])) + ","
+                self.PicoSerial.WriteFrame(header.encode() + chunk[:read])
+                offset += read
+        finally:
+            file.close()
+        self.PicoSerial.Write("0,GetLog," + fileName + "," + str(offset) + "," + str(size))
+
+    def _StartOffset(self, segment, fromTime):
+        #Offset of the last indexed record before fromTime, 0 without an index. Records of the same
+        #second can sit just before an entry with fromTime, so that entry is not a safe start
+        indexName = self.IndexFileName + segment[len(self.LogFileName):]
+        offset = 0
+        try:
+            indexFile = open(indexName, "rb")
+        except OSError:
+            return 0
+        entry = bytearray(8)
+        try:
+            while indexFile.readinto(entry) == 8:
+                if(int.from_bytes(entry[:4], "big") >= fromTime):
+                    break
+                offset = int.from_bytes(entry[4:], "big")
+        finally:
+            indexFile.close()
+        return offset
+
+    def _QuerySegment(self, segment, fromTime, toTime, node):
+        #Streams matching records of one segment, returns how many were sent
+        sent = 0
+        header = self._header
+        text = self._chunk
+        logFile = open(segment, "rb")
+        try:
+            logFile.seek(self._StartOffset(segment, fromTime))
+            while logFile.readinto(memoryview(header)[:LOG_RECORD_HEADER]) == LOG_RECORD_HEADER:
+                length = 0
+                shift = 0
+                while logFile.readinto(memoryview(header)[LOG_RECORD_HEADER:LOG_RECORD_HEADER + 1]) == 1:
+                    length |= (header[LOG_RECORD_HEADER] & 0x7f) << shift
+                    shift += 7
+                    if(header[LOG_RECORD_HEADER] < 0x80):
+                        break
+                loggedTime = int.from_bytes(header[:4], "big")
+                #Not the end of the range, SetLoRaDateTime can move the clock back in the middle of a segment
+                if(loggedTime < fromTime or loggedTime > toTime or (node is not None and header[5] != node)):
+                    logFile.seek(length, 1)
+                    continue
+                if(length > len(text)):
+                    logText = logFile.read(length)
+                else:
+                    logFile.readinto(memoryview(text)[:length])
+                    logText = bytes(memoryview(text)[:length])
+                self.PicoSerial.Write(self.FormatLine(loggedTime, logText.decode()), False)
+                sent += 1
+        finally:
+            logFile.close()
+        return sent
+
+    def SendQueryToSerial(self, fromTime, toTime, node = None):
+        #Records logged from fromTime to toTime (seconds) as text lines, oldest first, then 0,QueryLog,count
+        if(not self.BinaryLog):
+            self.PicoSerial.Write("1,QueryLog,Binary log is off")
+            return
+        self.commit_log(True)
+        sent = 0
+        for segment in (self.LogFileName + "2", self.LogFileName + "1", self.LogFileName):
+            if(segment in os.listdir()):
+                sent += self._QuerySegment(segment, fromTime, toTime, node)
+        self.PicoSerial.Write("0,QueryLog," + str(sent))
@@ -0,0 +1,102 @@
+import time
+
+#Fields a reply template can use, {value:name} takes a value set with SetValue
+TEMPLATE_FIELDS = ('from', 'id', 'message', 'rssi', 'snr', 'count', 'rule')
+
+class ReplyRule(object):
+    __slots__ = ('name', 'sender', 'prefix', 'template', 'expires', 'count')
+
+    def __init__(self, name, sender, prefix, template, expires):
+        self.name = name
+        self.sender = sender
+        self.prefix = prefix
+        self.template = template
+        self.expires = expires
+        self.count = 0
+
+class ReplyRules(object):
+    """
+    ReplyRules(max_rules=16)
+    Standing replies set by the controller, so predictable messages are answered on the node
+    without the serial round trip.
+    set_rule("SetRule,name,sender,prefix,ttl,template") sender is an address or *, a message starting
+    with prefix gets template back for ttl seconds (0 keeps it). {from} {id} {message} {rssi} {snr}
+    {count} {rule} and {value:name} in the template are filled in on the node.
+    reply(header_from, payload, message) returns (rule, reply) for the first matching rule or None.
+    """
+    def __init__(self, max_rules=16):
+        self.max_rules = max_rules
+        self.rules = [] #ReplyRule, checked in the order they were set
+        self.values = {}
+
+    def set_rule(self, message):
+        #SetRule,name,sender,prefix,ttl,template - the template is the rest of the line
+        splitmessage = message.split(',', 5)
+        if(len(splitmessage) < 6):
+            return "Error required SetRule,name,sender,prefix,ttl,template"
+        name = splitmessage[1]
+        sender = None if splitmessage[2] == '*' else int(splitmessage[2])
+        ttl = int(splitmessage[4])
+        expires = time.ticks_add(time.ticks_ms(), ttl * 1000) if ttl > 0 else None
+        self.clear_rules(name)
+        if(len(self.rules) >= self.max_rules):
+            return "1,SetRule," + name + ",Full"
+        self.rules.append(ReplyRule(name, sender, splitmessage[3], splitmessage[5], expires))
+        return "0,SetRule," + name
+
+    def clear_rules(self, name=None):
+        if(name is None):
+            self.rules = []
+            return
+        self.rules = [rule for rule in self.rules if rule.name != name]
+
+    def set_value(self, name, value):
+        self.values[name] = value
+
+    def rules_text(self):
+        #name:sender:prefix:seconds left (-1 never expires):count:template;
+        self._expire()
+        text = ""
+        for rule in self.rules:
+            left = -1 if rule.expires is None else time.ticks_diff(rule.expires, time.ticks_ms()) // 1000
+            text += rule.name + ":" + ("*" if rule.sender is None else str(rule.sender)) + ":" + rule.prefix + ":" + str(left) + ":" + str(rule.count) + ":" + rule.template + ";"
+        return text
+
+    def _expire(self):
+        now = time.ticks_ms()
+        for rule in list(self.rules):
+            if(rule.expires is not None and time.ticks_diff(rule.expires, now) <= 0):
+                self.rules.remove(rule)
+
+    def reply(self, header_from, payload, message):
+        if(len(self.rules) == 0):
+            return None
+        self._expire()
+        for rule in self.rules:
+            if((rule.sender is None or rule.sender == header_from) and message.startswith(rule.prefix)):
+                rule.count += 1
+                return rule, self._fill(rule, header_from, payload, message)
+        return None
+
+    def _fill(self, rule, header_from, payload, message):
+        template = rule.template
+        if('{' not in template):
+            return template
+        fields = {'from': header_from, 'id': payload.header_id, 'message': message, 'rssi': payload.rssi,
+                  'snr': payload.snr, 'count': rule.count, 'rule': rule.name}
+        text = ""
+        position = 0
+        while True:
+            start = template.find('{', position)
+            end = template.find('}', start + 1) if start != -1 else -1
+            if(end == -1):
+                return text + template[position:]
+            field = template[start + 1:end]
+            if(field.startswith('value:')):
+                value = self.values.get(field[6:], '')
+            elif(field in TEMPLATE_FIELDS):
+                value = fields[field]
+            else:
+                value = template[start:end + 1]
+            text += template[position:start] + str(value)
+            position = end + 1
@@ -1,83 +1,300 @@
 import machine
-from sys import stdin
+from sys import stdin, stdout
 import uselect
 import utime
+import Metrics
+
+#Binary frame: FRAME_START, payload length (2 bytes, big endian), payload, crc16 of length + payload
+#Anything else is text, one message per line (or per burst for controllers that send no newline)
+FRAME_START = 0x02
+FRAME_OVERHEAD = 5
+TEXT_IDLE_MS = 20 #unterminated text counts as a message once the line is quiet this long
+REPLY_TIMEOUT_MS = 10000 #controller replies nobody took are dropped after this
+
+#RS485 driver timing, a byte on the line is start + 8 data + stop bits
+SERIAL_BAUDRATE = 38400
+BITS_PER_BYTE = 10
+TX_MARGIN_US = 300 #turnaround slack after the last stop bit
+
+def crc16(data, crc=0xffff):
+    #CRC-16/CCITT-FALSE
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if(crc & 0x8000):
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+class FrameReader():
+    #Splits one input stream into messages, bytes are read straight into a fixed buffer
+    def __init__(self, size=512):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.lastReceived = utime.ticks_ms()
+        self.badFrames = 0
+
+    def Free(self):
+        return self.view[self.length:]
+
+    def Received(self, count):
+        if(count):
+            self.length += count
+            self.lastReceived = utime.ticks_ms()
+
+    def _Consume(self, count):
+        remaining = self.length - count
+        if(remaining > 0):
+            self.view[:remaining] = self.view[count:self.length]
+        self.length = remaining
+
+    def _Find(self, start):
+        #Index of the next line end or frame start, -1 when there is none yet
+        buffer = self.buffer
+        for i in range(start, self.length):
+            if(buffer[i] == 0x0a or buffer[i] == 0x0d or buffer[i] == FRAME_START):
+                return i
+        return -1
+
+    def _BadFrame(self):
+        #Drop everything up to the next frame or line, none of it can be trusted
+        self.badFrames += 1
+        Metrics.count(Metrics.SERIAL_BAD_FRAMES)
+        end = self._Find(1)
+        self._Consume(end if end != -1 else self.length)
+
+    def _Text(self, start, end, consume):
+        text = bytes(self.view[start:end])
+        self._Consume(consume)
+        try:
+            return text.decode("utf-8").replace("\t", "").strip()
+        except:
+            self.badFrames += 1
+            return ""
+
+    def NextMessage(self):
+        #The next complete message as a str, None until there is one
+        buffer = self.buffer
+        while self.length > 0:
+            if(buffer[0] == FRAME_START):
+                if(self.length < 3):
+                    return None
+                payloadLength = (buffer[1] << 8) | buffer[2]
+                if(payloadLength > len(buffer) - FRAME_OVERHEAD):
+                    #Can never fit, not a frame after all
+                    self._BadFrame()
+                    continue
+                if(self.length < payloadLength + FRAME_OVERHEAD):
+                    return None
+                end = 3 + payloadLength
+                if(crc16(self.view[1:end]) != (buffer[end] << 8) | buffer[end + 1]):
+                    self._BadFrame()
+                    continue
+                message = self._Text(3, end, end + 2)
+                if(message != ""):
+                    return message
+                continue
+
+            end = self._Find(0)
+            if(end == -1):
+                if(self.length == len(buffer)):
+                    #A buffer full of text without a line end is no command we could tell apart
+                    self._BadFrame()
+                    continue
+                #No terminator yet, older controllers end a command by going quiet
+                if(utime.ticks_diff(utime.ticks_ms(), self.lastReceived) >= TEXT_IDLE_MS):
+                    return self._Text(0, self.length, self.length)
+                return None
+            message = self._Text(0, end, end + 1 if buffer[end] != FRAME_START else end)
+            if(message != ""):
+                return message
+        return None
+
+class SerialCommand():
+    #One controller command waiting in PicoSerial.commands
+    __slots__ = ("sequence", "verb", "message", "received")
+
+    def __init__(self, sequence, message):
+        self.sequence = sequence
+        self.verb = message.split(',', 1)[0]
+        self.message = message
+        self.received = utime.ticks_ms()
 
 class PicoSerial():
-    def __init__(self):
-        self.buffered_input = []
-        self.loRaReplies = {}
-        self.loRaSending = {}
-        self.uart = machine.UART(0, 38400)
+    def __init__(self, maxCommands = 32):
+        self.loRaReplies = {} #(headerFrom, headerId) -> (ticks_ms, reply), headerFrom is None for the legacy form
+        self.commands = [] #SerialCommand, oldest first
+        self.maxCommands = maxCommands
+        self.commandSequence = 0
+        self.commandsDropped = 0
+        self.maxCommandWaitMs = 0
+        self.uart = machine.UART(0, SERIAL_BAUDRATE)
         self.pinSerialWrite = machine.Pin(2, machine.Pin.OUT)
         self.pinSerialWrite.low()
+        self.writing = False
+        self.txDone = 0 #ticks_us when the last byte queued so far is on the line
+        self.usbReader = FrameReader()
+        self.pinReader = FrameReader()
+        self.stdinPoll = uselect.poll()
+        self.stdinPoll.register(stdin, uselect.POLLIN)
+        self.stdinBuffer = getattr(stdin, "buffer", stdin)
+        self.stdinByte = bytearray(1)
+        self.stdoutBuffer = getattr(stdout, "buffer", stdout)
 
     def GetSerialUSBInput(self):
         try:
-            select_result = uselect.select([stdin], [], [], 0)
-            if(select_result[0]):
-                utime.sleep_ms(100)
-            while select_result[0]:
-                input_character = stdin.read(1)
-                self.buffered_input.append(input_character)
-                select_result = uselect.select([stdin], [], [], 0)
-            if(len(self.buffered_input)>0):
-                message = ""
-                for charicter in self.buffered_input:
-                    if(charicter == "\t" or charicter == "\n" or charicter == ""):
-                        continue
-                    message += charicter
-                self.buffered_input = []
-                return message
+            reader = self.usbReader
+            byte = self.stdinByte
+            while reader.length < len(reader.buffer) and self.stdinPoll.poll(0):
+                #stdin only says whether a byte is waiting, so it is taken one at a time
+                if(self.stdinBuffer.readinto(byte) != 1):
+                    break
+                reader.buffer[reader.length] = byte[0]
+                reader.Received(1)
+            return reader.NextMessage()
         except:
             return None
 
     def GetSerialPinInput(self):
         try:
-            message = ""
-            bitesLen = self.uart.any()
-            while bitesLen:
-                uartCharicter = self.uart.read(bitesLen)
-                utime.sleep(0.1)
-                bitesLen = self.uart.any()
-                if(uartCharicter is not None):
-                    message += uartCharicter.decode("utf-8") 
-            if(message == ""):
-                return None
-            
-            return message
+            reader = self.pinReader
+            bitesLen = min(self.uart.any(), len(reader.buffer) - reader.length)
+            if(bitesLen):
+                reader.Received(self.uart.readinto(reader.Free(), bitesLen))
+            return reader.NextMessage()
         except:
             return None
 
     def ReadInput(self):
-        self._SetMessageToDic(self.GetSerialUSBInput())
-        self._SetMessageToDic(self.GetSerialPinInput())
-        
+        #Every complete message waiting on either input, several commands in one read stay separate
+        for reader in (self.GetSerialUSBInput, self.GetSerialPinInput):
+            message = reader()
+            while message is not None:
+                self._SetMessageToDic(message)
+                message = reader()
+
         #Clean Old Messages
-        for key in list(self.loRaReplies):
-            if(utime.time() - key > 10):
-                del self.loRaReplies[key]
-                
-        for key in list(self.loRaSending):
-            if(utime.time() - key > 10):
-                del self.loRaSending[key]
+        if(len(self.loRaReplies) > 0):
+            now = utime.ticks_ms()
+            for key in list(self.loRaReplies):
+                if(utime.ticks_diff(now, self.loRaReplies[key][0]) > REPLY_TIMEOUT_MS):
+                    del self.loRaReplies[key]
+
+    def TakeReply(self, headerFrom, headerId):
+        #The controller's reply to a message from headerFrom, None until it has answered
+        reply = self.loRaReplies.pop((str(headerFrom), str(headerId)), None)
+        if(reply is None):
+            reply = self.loRaReplies.pop((None, str(headerId)), None)
+        return None if reply is None else reply[1]
+
+    def NextCommand(self):
+        #Oldest queued SerialCommand or None, the wait it had in the queue is tracked
+        if(len(self.commands) == 0):
+            return None
+        command = self.commands.pop(0)
+        self.maxCommandWaitMs = max(self.maxCommandWaitMs, utime.ticks_diff(utime.ticks_ms(), command.received))
+        return command
+
+    def PutBack(self, command):
+        #A command taken with NextCommand that cannot run yet, it is next again
+        self.commands.insert(0, command)
+
+    def CommandStats(self):
+        return str(len(self.commands)) + "," + str(self.commandSequence) + "," + str(self.commandsDropped) + "," + str(self.maxCommandWaitMs)
 
     def _SetMessageToDic(self, message):
+        #Recieved,headerFrom:headerId,reply or the older Recieved,headerId,reply go to loRaReplies,
+        #everything else is a command
         if(message and message != ""):
-            if("Recieved," in message):
-                splitmessage = message.split(',')
-                self.loRaReplies[utime.time()] = {splitmessage[1]: splitmessage[2]}
+            if(message.startswith("Recieved,")):
+                splitmessage = message.split(',', 2)
+                if(len(splitmessage) < 3):
+                    return
+                key = splitmessage[1].split(':')
+                if(len(key) == 1):
+                    key.insert(0, None)
+                self.loRaReplies[(key[0], key[1])] = (utime.ticks_ms(), splitmessage[2])
+                return
+            self.commandSequence += 1
+            Metrics.count(Metrics.SERIAL_COMMANDS)
+            Metrics.observe(Metrics.SERIAL_QUEUE_DEPTH, len(self.commands))
+            if(len(self.commands) >= self.maxCommands):
+                #The controller has to resend, it is never dropped without telling it
+                self.commandsDropped += 1
+                Metrics.count(Metrics.SERIAL_QUEUE_FULL)
+                self.Write("1,QueueFull," + str(self.commandSequence) + "," + message)
+                return
+            self.commands.append(SerialCommand(self.commandSequence, message))
+
+    def _UartWrite(self, data):
+        #Raises the driver on the first write, it stays up until _EndWrite
+        now = utime.ticks_us()
+        if(not self.writing):
+            self.pinSerialWrite.high()
+            self.writing = True
+            self.txDone = now
+        #These bytes go out after whatever is still queued, or straight away after a pause
+        start = self.txDone if utime.ticks_diff(self.txDone, now) > 0 else now
+        self.uart.write(data)
+        self.txDone = utime.ticks_add(start, len(data) * BITS_PER_BYTE * 1000000 // SERIAL_BAUDRATE)
+
+    def _EndWrite(self):
+        #uart.write only queues, the driver has to stay up until the last stop bit is on the line
+        if(not self.writing):
+            return
+        deadline = utime.ticks_add(self.txDone, TX_MARGIN_US)
+        txdone = getattr(self.uart, "txdone", None)
+        if(txdone is not None):
+            #Byte count only bounds the wait, the UART knows when it is actually done
+            while not txdone() and utime.ticks_diff(deadline, utime.ticks_us()) > 0:
+                pass
+            utime.sleep_us(TX_MARGIN_US)
+        else:
+            remaining = utime.ticks_diff(deadline, utime.ticks_us())
+            if(remaining > 0):
+                utime.sleep_us(remaining)
+        self.pinSerialWrite.low()
+        self.writing = False
+
+    def WriteFrame(self, payload):
+        #Same framing as the input side, for replies that are not plain text
+        if type(payload) == str:
+            payload = payload.encode()
+        header = bytes((FRAME_START, (len(payload) >> 8) & 0xff, len(payload) & 0xff))
+        crc = crc16(payload, crc16(header[1:]))
+        trailer = bytes(((crc >> 8) & 0xff, crc & 0xff))
+        #Both outputs like Write, USB gets the raw bytes since print would show the bytes object
+        for part in (header, payload, trailer):
+            self.stdoutBuffer.write(part)
+        self._UartWrite(header)
+        self._UartWrite(payload)
+        self._UartWrite(trailer)
+        self._EndWrite()
+
+    def _Line(self, message):
+        if(type(message) == str and not message.endswith("\n")):
+            return message + "\r\n"
+        return message
+
+    def WriteBatch(self, messages):
+        #Several messages behind one driver enable, each its own line
+        for message in messages:
+            if(type(message) == str):
+                print(message)
             else:
-                self.loRaSending[utime.time()] = message
+                self.stdoutBuffer.write(message)
+            self._UartWrite(self._Line(message))
+        self._EndWrite()
 
     def Write(self, message, streamDataComplete = True):
+        #A complete message is one line, streamed parts go out as they are until the stream completes
         if(message is not None):
-            print(message)
-            self.pinSerialWrite.high()
-            self.uart.write(message)
+            if(type(message) == str):
+                print(message)
+            else:
+                self.stdoutBuffer.write(message)
+            self._UartWrite(self._Line(message) if streamDataComplete else message)
         if(streamDataComplete):
-            utime.sleep(0.5)
-            self.pinSerialWrite.low()
-            
-
-
+            self._EndWrite()
@@ -0,0 +1,75 @@
+from array import array
+import time
+
+#Event codes, value is what the event carries
+MODE = 1 #radio mode set (LoRa MODE_*)
+IRQ_ENTER = 2 #radio mode when the interrupt came in
+IRQ_EXIT = 3 #irq flags the interrupt handled
+FIFO_READ = 4 #frame length copied out of the FIFO
+SEND = 5 #frame length written to the FIFO
+ACK_MATCH = 6 #header id of the pending send an ack completed
+RETRY = 7 #header_to << 8 | attempt number
+ACK_TIMEOUT = 8 #header_to of a send that ran out of retries
+
+#Off until start(), record() then costs one check
+enabled = False
+
+_times = array('L')
+_events = bytearray()
+_values = array('H')
+_next = 0
+_count = 0
+
+def start(size=256):
+    #Clears the ring and records the next size events, older ones are overwritten
+    global enabled, _times, _events, _values, _next, _count
+    enabled = False
+    if(len(_events) != size):
+        _times = array('L', [0] * size)
+        _events = bytearray(size)
+        _values = array('H', [0] * size)
+    _next = 0
+    _count = 0
+    enabled = True
+
+def stop():
+    global enabled
+    enabled = False
+
+def record(event, value=0):
+    global _next, _count
+    if(not enabled):
+        return
+    #The slot is claimed before it is written, an interrupt recording in between gets the next one
+    now = time.ticks_us()
+    i = _next
+    _next = 0 if i + 1 == len(_events) else i + 1
+    if(_count < len(_events)):
+        _count += 1
+    _times[i] = now
+    _events[i] = event
+    _values[i] = value & 0xffff
+
+def dump():
+    """
+    Recorded events oldest first: count (2 bytes), then per event ticks_us (4 bytes, wraps at 2**30 on the rp2),
+    event code (1 byte) and value (2 bytes), all big endian. tools/trace_timeline.py turns it into a timeline.
+    """
+    count = _count
+    out = bytearray(2 + count * 7)
+    out[0] = (count >> 8) & 0xff
+    out[1] = count & 0xff
+    i = (_next - count) % len(_events) if count else 0
+    position = 2
+    for _ in range(count):
+        ticks = _times[i]
+        out[position] = (ticks >> 24) & 0xff
+        out[position + 1] = (ticks >> 16) & 0xff
+        out[position + 2] = (ticks >> 8) & 0xff
+        out[position + 3] = ticks & 0xff
+        out[position + 4] = _events[i]
+        out[position + 5] = (_values[i] >> 8) & 0xff
+        out[position + 6] = _values[i] & 0xff
+        position += 7
+        i = (i + 1) % len(_events)
+    return out
@@ -1,28 +1,61 @@
 import utime
 import LoRa
+import LoRaTransfer
+import LoRaRouting
+import ReplyRules
+import Metrics
+import Trace
 import PicoLogger
 import LoRaConfig
 import Serial
 import machine
+import binascii
+import uasyncio as asyncio
 from time import sleep
 
 import time
+import os
 
 led = machine.Pin(25, machine.Pin.OUT)
 
 picoSerial = Serial.PicoSerial()
-picoLogger = PicoLogger.PicoLogger(picoSerial)
+binary_log = False #Compact log records with a time index, needed for QueryLog
+picoLogger = PicoLogger.PicoLogger(picoSerial, binaryLog=binary_log)
 loRaConfig = LoRaConfig.LoRaConfig(picoSerial, picoLogger)
+replyRules = ReplyRules.ReplyRules()
 reply_timeout = 1 #seconds
+aggregate_hold_ms = 50 #Send commands to the same node within this window share one frame and ack
+max_sends = 4 #Send commands in flight at once, later ones wait in the command queue
+sends_in_flight = 0
 
 #Commands
 #Send,path,message [use H for message to get all RSSI and SNR]
 #Send,path,path,message
-#Recieved,headerId,message
+#Send,address,message finds the route itself when address is not a neighbour
+#Recieved,address:headerId,message [reply to Recieved,address,headerId,... the older Recieved,headerId,message still works]
 #SetLoRaDateTime,YYYY MM DD HH MM SS
 #SendLoggedDataToSerial
 #SetConfig,client_address,freq,tx_power,modem_config
 #GetConfig
+#GetRtt
+#GetCompression [frames compressed, bytes and airtime saved]
+#GetRoutes [address:hop-hop-address/cost;]
+#GetRemoteLog,address,file [file is log.txt, log.txt1 or log.txt2 on the remote node, framed chunks "GetRemoteLog,address,transfer_id,offset,crc32,data", then 0,GetRemoteLog,address,transfer_id,Done]
+#GetLogFiles [file:size; for every log segment]
+#GetLog,file,offset,length [framed chunks "GetLog,file,offset,crc32,data", then 0,GetLog,file,next offset,size]
+#GetQueue [queued commands, commands received, dropped as QueueFull, longest wait in ms]
+#SetRule,name,sender,prefix,ttl,template [sender address or *, ttl seconds (0 keeps it), answers on the node]
+#ClearRules or ClearRules,name
+#GetRules [name:sender:prefix:seconds left:count:template;]
+#SetValue,name,value [for {value:name} in rule templates]
+#SetLogLevel,level or SetLogLevel,level,categoryMask [10 debug, 20 info, 30 warning, 40 error, mask bit per category]
+#SetLogSample,category,every [log 1 in every records of category below warning, categories in PicoLogger]
+#GetLogLevel [level,categoryMask,every per category]
+#GetStats [counters name:value, then histogram name:bucket/bucket/..., see Metrics]
+#ResetStats
+#SetTrace,1 or SetTrace,0 [start (clearing it) or stop the radio event trace]
+#GetTrace [one frame "GetTrace," + binary events, tools/trace_timeline.py reads it]
+#QueryLog,from,to or QueryLog,from,to,address [seconds since epoch, log lines in that range, needs binary_log]
 
 #Warning numbers
 #1 - Failed to send to Target
@@ -41,37 +74,39 @@ led.toggle()
 def on_recv(payload):
     led.toggle()
     headerFrom = payload.header_from
-    message = payload.message
-    if('relay_Addresses' in str(payload) and len(payload.relay_Addresses) > 0):
+    if(len(payload.relay_Addresses) > 0):
         headerFrom = payload.relay_Addresses[0]
     
-    if(type(message) is bytes):
-        message = message.decode("utf-8") 
+    message = bytes(payload.message).decode("utf-8")
 
-    picoLogger.WriteNewLog("Recieved," + str(headerFrom)  + ',' + str(payload.header_id) + "," + str(message) + ',rssi' + str(payload.rssi) + ',snr' + str(payload.snr))
+    rule = replyRules.reply(headerFrom, payload, message)
+    if(rule is not None):
+        #Answered on the node, the controller is only told about it
+        picoLogger.WriteNewLog("AutoReplied," + str(headerFrom) + ',' + str(payload.header_id) + "," + str(message) + "," + rule[0].name, PicoLogger.LOG_RECEIVED, headerFrom)
+        picoSerial.Write("AutoReplied," + str(headerFrom) + ',' + str(payload.header_id) + "," + str(message) + "," + rule[0].name)
+        return rule[1]
+
+    picoLogger.WriteNewLog("Recieved," + str(headerFrom)  + ',' + str(payload.header_id) + "," + str(message) + ',rssi' + str(payload.rssi) + ',snr' + str(payload.snr), PicoLogger.LOG_RECEIVED, headerFrom)
     
     picoSerial.Write("Recieved," + str(headerFrom)  + ',' + str(payload.header_id) + "," + str(message) + ',rssi' + str(payload.rssi) + ',snr' + str(payload.snr))
-    #0.5 seconds to reply, is that too fast?
-    Start_reply_time = time.ticks_us()
-    while (float(time.ticks_diff(time.ticks_us(), Start_reply_time)) < reply_timeout * 1000000):
-        picoSerial.ReadInput()
-        for timestamp in list(picoSerial.loRaReplies):
-            for headerId in picoSerial.loRaReplies[timestamp]:
-                if(str(headerId) == str(payload.header_id)):
-                    picoLogger.WriteNewLog("Returning Message: " + str(picoSerial.loRaReplies[timestamp][headerId]))
-                    reply = picoSerial.loRaReplies[timestamp][headerId]
-                    #TODO do we want to delete straigh away?
-                    del  picoSerial.loRaReplies[timestamp]
-                    return reply
-    return "4"
+    #The ack waits for the controller's reply, serial_task hands it over with answer_replies
+    return LoRa.REPLY_LATER
+
+def answer_replies():
+    for headerFrom, headerId in lora.replies_due():
+        reply = picoSerial.TakeReply(headerFrom, headerId)
+        if(reply is not None):
+            picoLogger.WriteNewLog("Returning Message: " + str(reply), PicoLogger.LOG_RECEIVED, headerFrom)
+            lora.answer(headerFrom, headerId, reply)
 
 # Lora Parameters
 RFM95_RST = 27
 RFM95_SPIBUS = LoRa.SPIConfig.rp2_0
 RFM95_CS = 5
 RFM95_INT = 28
+modemList = [LoRa.ModemConfig.Bw125Cr45Sf128, LoRa.ModemConfig.Bw500Cr45Sf128, LoRa.ModemConfig.Bw31_25Cr48Sf512, LoRa.ModemConfig.Bw125Cr48Sf4096, LoRa.ModemConfig.Bw125Cr45Sf2048]
 
-def send_to_lora(message):
+async def send_to_lora(message):
     splitmessage = message.split(',')
     if(len(splitmessage) < 3):
         picoSerial.Write("Error required Send,path,message")
@@ -82,7 +117,7 @@ def send_to_lora(message):
         picoSerial.Write("0,404," + str(message))
         return
     #send,path,message
-    header_id = lora.get_new_header_id()
+    header_id = alora.new_header_id()
     picoSerial.Write("0," + str(header_id) + "," + str(message))
     result = None
     
@@ -90,77 +125,292 @@ def send_to_lora(message):
     for address in splitmessage[1:len(splitmessage) -1]:
         Send_To_Relay_Addresses.append(int(address))
 
-    if(len(Send_To_Relay_Addresses) > 1):
-        Send_To_Relay_Addresses.insert(0, lora._this_address)
-        result = lora.relay_send(str(splitmessage[len(splitmessage)-1]), Send_To_Relay_Addresses[1], Send_To_Relay_Addresses, header_id)
-    else:
-        result = lora.send_to_wait(str(splitmessage[len(splitmessage)-1]), Send_To_Relay_Addresses[0], headerId = header_id)
+    try:
+        if(len(Send_To_Relay_Addresses) > 1):
+            Send_To_Relay_Addresses.insert(0, lora._this_address)
+            result = await alora.send_relay(str(splitmessage[len(splitmessage)-1]), Send_To_Relay_Addresses[1], Send_To_Relay_Addresses, header_id)
+        else:
+            result = await send_routed(str(splitmessage[len(splitmessage)-1]), Send_To_Relay_Addresses[0], header_id)
+    except ValueError as e:
+        result = "1." + str(Send_To_Relay_Addresses[len(Send_To_Relay_Addresses)-1]) + "." + str(e)
     picoSerial.Write(str(result))
     led.toggle()
     lora.set_mode_rx()
 
+async def send_task(message):
+    global sends_in_flight
+    try:
+        await send_to_lora(message)
+    finally:
+        sends_in_flight -= 1
+
+def start_send_task(message):
+    global sends_in_flight
+    sends_in_flight += 1
+    asyncio.create_task(send_task(message))
+
+async def find_route(address):
+    found = asyncio.Event()
+    routes = []
+    router.discover(address, lambda route: (routes.append(route), found.set()))
+    await found.wait()
+    return routes[0]
+
+async def send_on_route(message, route, header_id):
+    if(len(route) == 1):
+        return await alora.send_reliable(message, route[0], header_id = header_id)
+    return await alora.send_relay(message, route[0], [lora._this_address] + route, header_id)
+
+async def send_routed(message, address, header_id):
+    #Cached route first, a neighbour we never heard is tried directly before asking the network
+    route = router.route(address)
+    if(route is None):
+        route = [address]
+    result = await send_on_route(message, route, header_id)
+    if(type(result) != str):
+        return result
+    router.forget(address)
+    route = await find_route(address)
+    if(route is None):
+        return result
+    return await send_on_route(message, route, header_id)
+
 def set_lora_config(message):
     config =  message[10:]
     result = loRaConfig.write_config(config)
     picoSerial.Write('0,' + str(message) + ',' + str(result))
         
-    if(type(result) == str):
-        return
-    return get_LoRa(result)
+    if(result is None or type(result) == str):
+        return lora
+    if(lora is None):
+        return get_LoRa(picoLogger)
+    #Retune the running driver instead of re-initialising the chip
+    lora.reconfigure(freq=result.freq, tx_power=result.tx_power, modem_config=modemList[result.modem_config], this_address=result.client_address)
+    return lora
 
 def get_lora_config():
     picoSerial.Write('0,GetConfig,' + str(loRaConfig.read_config()))
 
 def get_LoRa(pico_logger):
     try:
-        modemList = [LoRa.ModemConfig.Bw125Cr45Sf128, LoRa.ModemConfig.Bw500Cr45Sf128, LoRa.ModemConfig.Bw31_25Cr48Sf512, LoRa.ModemConfig.Bw125Cr48Sf4096, LoRa.ModemConfig.Bw125Cr45Sf2048]
         loraConfig = loRaConfig.read_config()
         if(loraConfig is None):
             pico_logger.WriteNewLog("LoRa not setup")
             return loraConfig
-        lora = LoRa.LoRa(RFM95_SPIBUS, RFM95_INT, loraConfig.client_address, RFM95_CS, picoLogger, reset_pin=RFM95_RST, freq=loraConfig.freq, tx_power=loraConfig.tx_power, acks=True, modem_config=modemList[loraConfig.modem_config])
+        lora = LoRa.LoRa(RFM95_SPIBUS, RFM95_INT, loraConfig.client_address, RFM95_CS, picoLogger, reset_pin=RFM95_RST, freq=loraConfig.freq, tx_power=loraConfig.tx_power, acks=True, modem_config=modemList[loraConfig.modem_config], deferred_rx=True, compress=True)
         # set callback
         lora.on_recv = on_recv
+        lora.reply_wait_ms = reply_timeout * 1000
+        lora.aggregate_hold_ms = aggregate_hold_ms
         # set to listen continuously
         lora.set_mode_rx()
         return lora
     except Exception as e:
         picoSerial.Write("LoRa Fatal: " + str(e))
 
-lora = get_LoRa(picoLogger)
+def on_transfer_request(address, name):
+    #A neighbour pulls one of our log files
+    if(not name.startswith(picoLogger.LogFileName) or name not in os.listdir()):
+        return None
+    picoLogger.WriteNewLog("Sending " + name + " to " + str(address))
+    picoLogger.commit_log(True)
+    return open(name, "rb")
 
-while True:
-    try:
-        for timestapm in list(picoSerial.loRaSending):
-            message = picoSerial.loRaSending[timestapm]
-            del picoSerial.loRaSending[timestapm]
-            
-            #YYYY MM DD HH MM SS
-            if("SetLoRaDateTime" in message):
-                picoSerial.Write(picoLogger.SetDateTime(message.split(',')[1]))
-
-            if(message == "SendLoggedDataToSerial"):
-                picoLogger.SendLoggedDataToSerial()
+def on_transfer_data(address, transfer_id, offset, data):
+    #One frame per window like GetLog, raw bytes so a chunk can end in the middle of a UTF-8 character
+    header = "GetRemoteLog," + str(address) + "," + str(transfer_id) + "," + str(offset) + "," + str(binascii.crc32(data)) + ","
+    picoSerial.WriteFrame(header.encode() + bytes(data))
+
+def on_transfer_complete(address, transfer_id, message, error):
+    if(error is not None):
+        picoSerial.Write("1,GetRemoteLog," + str(address) + "," + str(transfer_id) + "," + str(error))
+        return
+    picoSerial.Write("0,GetRemoteLog," + str(address) + "," + str(transfer_id) + ",Done")
+
+def get_transfer(lora):
+    transfer = LoRaTransfer.LoRaTransfer(lora)
+    transfer.on_request = on_transfer_request
+    transfer.on_data = on_transfer_data
+    transfer.on_complete = on_transfer_complete
+    return transfer
+
+def get_remote_log(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) < 3):
+        picoSerial.Write("Error required GetRemoteLog,address,file")
+        return
+    if(transfer is None):
+        picoSerial.Write("1,GetRemoteLog,404")
+        return
+    transfer_id = transfer.request(int(splitmessage[1]), splitmessage[2])
+    picoSerial.Write("0,GetRemoteLog," + splitmessage[1] + "," + str(transfer_id) + "," + splitmessage[2])
+
+def get_log(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) < 4):
+        picoSerial.Write("Error required GetLog,file,offset,length")
+        return
+    picoLogger.SendLogChunksToSerial(splitmessage[1], int(splitmessage[2]), int(splitmessage[3]))
+
+def set_date_time(message):
+    #YYYY MM DD HH MM SS
+    picoSerial.Write(picoLogger.SetDateTime(message.split(',')[1]))
+
+def set_config(message):
+    global lora, alora, transfer, router
+    lora = set_lora_config(message)
+    if(lora is not None and (alora is None or alora.lora is not lora)):
+        alora = LoRa.AsyncLoRa(lora)
+        transfer = get_transfer(lora)
+        router = LoRaRouting.Router(lora)
+
+def clear_rules(message):
+    splitmessage = message.split(',')
+    replyRules.clear_rules(splitmessage[1] if len(splitmessage) > 1 else None)
+    picoSerial.Write('0,' + message)
+
+def set_value(message):
+    splitmessage = message.split(',', 2)
+    if(len(splitmessage) < 3):
+        picoSerial.Write("Error required SetValue,name,value")
+        return
+    replyRules.set_value(splitmessage[1], splitmessage[2])
+    picoSerial.Write('0,SetValue,' + splitmessage[1])
+
+def query_log(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) < 3):
+        picoSerial.Write("Error required QueryLog,from,to")
+        return
+    node = int(splitmessage[3]) if len(splitmessage) > 3 else None
+    picoLogger.SendQueryToSerial(int(splitmessage[1]), int(splitmessage[2]), node)
+
+def set_log_level(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) < 2):
+        picoSerial.Write("Error required SetLogLevel,level")
+        return
+    picoLogger.SetLevel(int(splitmessage[1]), int(splitmessage[2], 0) if len(splitmessage) > 2 else None)
+    picoSerial.Write('0,GetLogLevel,' + picoLogger.LevelText())
+
+def set_log_sample(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) < 3):
+        picoSerial.Write("Error required SetLogSample,category,every")
+        return
+    picoLogger.SetSample(int(splitmessage[1]), int(splitmessage[2]))
+    picoSerial.Write('0,GetLogLevel,' + picoLogger.LevelText())
+
+def reset_stats(message):
+    Metrics.reset()
+    picoSerial.Write('0,ResetStats')
+
+def set_trace(message):
+    splitmessage = message.split(',')
+    if(len(splitmessage) > 1 and splitmessage[1] == '1'):
+        Trace.start()
+    else:
+        Trace.stop()
+    picoSerial.Write('0,SetTrace,' + ('1' if Trace.enabled else '0'))
+
+#Command verb (text before the first comma) -> handler(message)
+commands = {
+    'SetLoRaDateTime': set_date_time,
+    'SendLoggedDataToSerial': lambda message: picoLogger.SendLoggedDataToSerial(),
+    'Send': start_send_task,
+    'SetConfig': set_config,
+    'GetConfig': lambda message: get_lora_config(),
+    'GetRtt': lambda message: picoSerial.Write('0,GetRtt,' + (lora.rtt_stats() if lora is not None else '')),
+    'GetCompression': lambda message: picoSerial.Write('0,GetCompression,' + (lora.compression_stats() if lora is not None else '')),
+    'GetRoutes': lambda message: picoSerial.Write('0,GetRoutes,' + (router.routes_text() if router is not None else '')),
+    'GetRemoteLog': get_remote_log,
+    'GetLogFiles': lambda message: picoLogger.SendLogFilesToSerial(),
+    'GetLog': get_log,
+    'GetQueue': lambda message: picoSerial.Write('0,GetQueue,' + picoSerial.CommandStats()),
+    'SetRule': lambda message: picoSerial.Write(replyRules.set_rule(message)),
+    'ClearRules': clear_rules,
+    'GetRules': lambda message: picoSerial.Write('0,GetRules,' + replyRules.rules_text()),
+    'SetValue': set_value,
+    'QueryLog': query_log,
+    'GetStats': lambda message: picoSerial.Write('0,GetStats,' + Metrics.stats_text()),
+    'ResetStats': reset_stats,
+    'SetTrace': set_trace,
+    'GetTrace': lambda message: picoSerial.WriteFrame(b"GetTrace," + Trace.dump()),
+    'SetLogLevel': set_log_level,
+    'SetLogSample': set_log_sample,
+    'GetLogLevel': lambda message: picoSerial.Write('0,GetLogLevel,' + picoLogger.LevelText()),
+}
+
+def handle_command(command):
+    handler = commands.get(command.verb)
+    if(handler is None):
+        picoSerial.Write("Error unknown command " + str(command.verb))
+        return
+    handler(command.message)
+
+async def serial_task():
+    while True:
+        try:
+            picoSerial.ReadInput()
+            if(lora is not None):
+                answer_replies()
+            #Only Sends wait for a free slot, other commands go ahead of them. The held Sends keep their
+            #order at the front of the queue, which answers QueueFull once it is full
+            held = []
+            try:
+                command = picoSerial.NextCommand()
+                while command is not None:
+                    if(command.verb == 'Send' and (len(held) > 0 or sends_in_flight >= max_sends)):
+                        held.append(command)
+                    else:
+                        handle_command(command)
+                    command = picoSerial.NextCommand()
+            finally:
+                for command in reversed(held):
+                    picoSerial.PutBack(command)
+        except Exception as e:
+            picoSerial.Write("Exception: " + str(e))
+        await asyncio.sleep_ms(10)
+
+async def lora_task():
+    while True:
+        try:
+            if(alora is None):
+                await asyncio.sleep(1)
                 continue
+            await alora.poll(router.next_poll_ms(transfer.next_poll_ms(100)))
+            transfer.poll()
+            router.poll()
+        except Exception as e:
+            picoSerial.Write("Exception: " + str(e))
+            await asyncio.sleep_ms(100)
 
-            elif('Send,' in message):
-                send_to_lora(message)
-                
-            elif('SetConfig,' in message):
-                lora = set_lora_config(message)
-
-            elif(message == 'GetConfig'):
-                lora = get_lora_config()
-            
-        if(lora is not None):
-            lora.relay_check_repeat()
-        
-        picoLogger.commit_log()
-        picoSerial.ReadInput()
-        
+async def relay_task():
+    while True:
+        try:
+            if(lora is not None):
+                lora.relay_check_repeat()
+        except Exception as e:
+            picoSerial.Write("Exception: " + str(e))
+        await asyncio.sleep_ms(10)
 
-    except Exception as e:
-        picoSerial.Write("Exception: " + str(e))
+async def log_task():
+    while True:
+        try:
+            picoLogger.commit_log()
+        except Exception as e:
+            picoSerial.Write("Exception: " + str(e))
+        await asyncio.sleep(1)
 
-    
+async def run():
+    asyncio.create_task(serial_task())
+    asyncio.create_task(lora_task())
+    asyncio.create_task(relay_task())
+    await log_task()
+
+lora = get_LoRa(picoLogger)
+alora = LoRa.AsyncLoRa(lora) if lora is not None else None
+transfer = get_transfer(lora) if lora is not None else None
+router = LoRaRouting.Router(lora) if lora is not None else None
 
+asyncio.run(run())
@@ -0,0 +1,205 @@
+#Host side tests, run with python -m pytest from the repo root.
+#Stand-ins for the MicroPython modules the tested code imports, only used when the real ones are missing
+import io
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+if "utime" not in sys.modules:
+    try:
+        import utime
+    except ImportError:
+        sys.modules["utime"] = _module("utime",
+            ticks_ms=lambda: int(time.monotonic() * 1000),
+            ticks_us=lambda: int(time.monotonic() * 1000000),
+            ticks_add=lambda ticks, delta: ticks + delta,
+            ticks_diff=lambda end, start: end - start,
+            sleep_us=lambda us: time.sleep(us / 1000000),
+            sleep_ms=lambda ms: time.sleep(ms / 1000),
+            time=lambda: int(time.time()),
+            localtime=time.gmtime)
+
+#MicroPython's time module carries the ticks functions too
+for _name in ("ticks_ms", "ticks_us", "ticks_add", "ticks_diff", "sleep_ms", "sleep_us"):
+    if(not hasattr(time, _name)):
+        setattr(time, _name, getattr(sys.modules["utime"], _name))
+
+if "uio" not in sys.modules:
+    try:
+        import uio
+    except ImportError:
+        sys.modules["uio"] = io
+
+if "micropython" not in sys.modules:
+    try:
+        import micropython
+    except ImportError:
+        sys.modules["micropython"] = _module("micropython", const=lambda value: value, schedule=lambda function, argument: function(argument))
+
+if "uasyncio" not in sys.modules:
+    try:
+        import uasyncio
+    except ImportError:
+        import asyncio
+        sys.modules["uasyncio"] = asyncio
+
+if "urandom" not in sys.modules:
+    try:
+        import urandom
+    except ImportError:
+        import random
+        sys.modules["urandom"] = _module("urandom", getrandbits=random.getrandbits)
+
+class _Poll():
+    def register(self, stream, events):
+        pass
+
+    def poll(self, timeout):
+        return []
+
+if "uselect" not in sys.modules:
+    try:
+        import uselect
+    except ImportError:
+        sys.modules["uselect"] = _module("uselect", poll=_Poll, POLLIN=1)
+
+class _Pin():
+    OUT = 1
+    IN = 0
+    IRQ_RISING = 1
+
+    def __init__(self, pin, mode=None):
+        self.state = 0
+
+    def high(self):
+        self.state = 1
+
+    def low(self):
+        self.state = 0
+
+    def value(self, state=None):
+        if(state is None):
+            return self.state
+        self.state = state
+
+    def irq(self, trigger=None, handler=None):
+        pass
+
+class _UART():
+    def __init__(self, channel, baudrate):
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written.extend(data.encode() if type(data) == str else data)
+
+    def any(self):
+        return 0
+
+    def readinto(self, buffer, count=None):
+        return 0
+
+class _SPI():
+    """
+    Register file of an SX127x, enough for LoRa to configure, send and receive.
+    Every FIFO burst written is kept in frames, receive(frame) and tx_done() raise the irq flags
+    the radio would, the test then calls the LoRa object's _handle_interrupt.
+    """
+    def __init__(self, channel, baudrate, sck=None, mosi=None, miso=None):
+        self.registers = bytearray(0x80)
+        self.fifo = bytearray(256)
+        self.frames = []
+        self._read_register = 0
+
+    def write(self, data):
+        register = data[0] & 0x7f
+        if(not data[0] & 0x80):
+            self._read_register = register
+        elif(register == 0x00):
+            self.frames.append(bytes(data[1:]))
+        elif(register == 0x12):
+            #Irq flags are cleared by writing ones
+            self.registers[0x12] &= ~data[1] & 0xff
+        else:
+            self.registers[register:register + len(data) - 1] = data[1:]
+
+    def readinto(self, buffer):
+        if(self._read_register == 0x00):
+            pointer = self.registers[0x0d]
+            buffer[:] = self.fifo[pointer:pointer + len(buffer)]
+        else:
+            buffer[:] = self.registers[self._read_register:self._read_register + len(buffer)]
+
+    def write_readinto(self, data, buffer):
+        register = data[0] & 0x7f
+        buffer[0] = 0
+        buffer[1:] = self.registers[register:register + len(buffer) - 1]
+
+    def receive(self, frame, rssi=100, snr=40):
+        self.fifo[:len(frame)] = frame
+        self.registers[0x10] = 0
+        self.registers[0x12] |= 0x40
+        self.registers[0x13] = len(frame)
+        self.registers[0x19] = snr
+        self.registers[0x1a] = rssi
+
+    def tx_done(self):
+        self.registers[0x12] |= 0x08
+
+if "machine" not in sys.modules:
+    try:
+        import machine
+    except ImportError:
+        sys.modules["machine"] = _module("machine", Pin=_Pin, UART=_UART, SPI=_SPI, idle=lambda: None)
+
+import pytest
+
+class _Serial():
+    def Write(self, message, streamDataComplete = True):
+        pass
+
+    def WriteFrame(self, payload):
+        pass
+
+class _Clock():
+    def __init__(self):
+        self.now = 0
+
+    def advance(self, ms):
+        self.now += ms
+
+@pytest.fixture
+def clock(monkeypatch):
+    #time.ticks_ms under the test's control
+    clock = _Clock()
+    monkeypatch.setattr(time, "ticks_ms", lambda: clock.now)
+    return clock
+
+@pytest.fixture
+def make_lora(tmp_path, monkeypatch):
+    #make_lora(address, **options) builds a listening LoRa on the _SPI register file, its frames are in lora.spi.frames
+    import LoRa
+    import PicoLogger
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    def make(address=2, **options):
+        lora = LoRa.LoRa(LoRa.SPIConfig.rp2_0, 28, address, 5, PicoLogger.PicoLogger(_Serial()), acks=True, **options)
+        lora.set_mode_rx()
+        return lora
+    return make
+
+def receive(lora, frame):
+    #frame as sent on air (header, relay list, data) received by lora
+    lora.spi.receive(bytes(frame))
+    lora._handle_interrupt(None)
+
+def tx_done(lora):
+    lora.spi.tx_done()
+    lora._handle_interrupt(None)
@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import receive, tx_done
+from LoRa import FLAGS_ACK, FLAGS_AGGREGATE
+
+@pytest.fixture
+def lora(make_lora, clock):
+    lora = make_lora(2)
+    lora.aggregate_hold_ms = 50
+    return lora
+
+def test_split(lora):
+    assert lora._split_aggregate(b'\x05\x02hi\x06\x00\x07\x01x') == [(5, b'hi'), (6, b''), (7, b'x')]
+
+def test_split_truncated_record_ends_list(lora):
+    assert lora._split_aggregate(b'\x05\x02hi\x06\x05abc') == [(5, b'hi')]
+    assert lora._split_aggregate(b'\x05\x02hi\x06') == [(5, b'hi')]
+    assert lora._split_aggregate(b'') == []
+
+def test_queued_messages_share_a_frame(lora, clock):
+    done = []
+    lora.queue_send("a", 1, header_id=5, on_done=done.append)
+    lora.queue_send("bc", 1, header_id=6, on_done=done.append)
+    lora.poll_pending()
+    assert lora.spi.frames == []
+    clock.advance(lora.aggregate_hold_ms)
+    lora.poll_pending()
+    tx_done(lora)
+    frame = lora.spi.frames[0]
+    assert frame[3] == FLAGS_AGGREGATE
+    assert lora._split_aggregate(frame[5:]) == [(5, b'a'), (6, b'bc')]
+
+    receive(lora, bytes((2, 1, frame[2], FLAGS_ACK, 0)) + b'\x05\x02ra\x06\x00')
+    assert [(entry.header_id, bytes(entry.result.message)) for entry in done] == [(5, b'ra'), (6, b'')]
+
+def test_single_queued_message_goes_alone(lora, clock):
+    lora.queue_send("a", 1, header_id=5)
+    clock.advance(lora.aggregate_hold_ms)
+    lora.poll_pending()
+    frame = lora.spi.frames[0]
+    assert (frame[2], frame[3], frame[5:]) == (5, 0, b'a')
+
+def test_aggregate_received_is_answered_as_one(lora, clock):
+    lora.on_recv = lambda packet: b'r' + bytes(packet.message)
+    receive(lora, bytes((2, 1, 9, FLAGS_AGGREGATE, 0)) + b'\x05\x01a\x06\x01b')
+    frame = lora.spi.frames[0]
+    assert (frame[2], frame[3]) == (9, FLAGS_ACK)
+    assert lora._split_aggregate(frame[5:]) == [(5, b'ra'), (6, b'rb')]
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from LoRa import time_on_air_ms, ModemConfig, DutyCycle
+
+def test_time_on_air():
+    #SX1276 datasheet formula worked by hand: (preamble + 4.25 + payload symbols) * symbol time
+    assert time_on_air_ms(ModemConfig.Bw125Cr45Sf128, 10) == pytest.approx((12.25 + 8 + 4 * 5) * 1.024)
+    assert time_on_air_ms(ModemConfig.Bw125Cr45Sf128, 20) == pytest.approx((12.25 + 8 + 7 * 5) * 1.024)
+    assert time_on_air_ms(ModemConfig.Bw500Cr45Sf128, 20) == pytest.approx((12.25 + 8 + 7 * 5) * 0.256)
+    #Low data rate optimisation, a 20 byte ack at the slowest setting
+    assert time_on_air_ms(ModemConfig.Bw125Cr48Sf4096, 20) == pytest.approx((12.25 + 8 + 4 * 8) * 32.768)
+
+def test_time_on_air_grows_with_payload():
+    airtimes = [time_on_air_ms(ModemConfig.Bw125Cr45Sf2048, length) for length in range(0, 256, 16)]
+    assert airtimes == sorted(airtimes)
+    assert time_on_air_ms(ModemConfig.Bw125Cr45Sf128, 10, preamble_length=16) == pytest.approx(time_on_air_ms(ModemConfig.Bw125Cr45Sf128, 10) + 8 * 1.024)
+
+@pytest.fixture
+def now(monkeypatch):
+    #time.time() in seconds, set now[0]
+    now = [36000 * 60 + 30]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+def test_duty_cycle_within_budget(now):
+    duty_cycle = DutyCycle(1)
+    assert duty_cycle.budget_ms == 36000
+    assert duty_cycle.delay_ms(1000) == 0
+    duty_cycle.record(30000)
+    assert duty_cycle.used_ms() == 30000
+    assert duty_cycle.delay_ms(6000) == 0
+
+def test_duty_cycle_waits_for_oldest_minute(now):
+    duty_cycle = DutyCycle(1)
+    duty_cycle.record(20000)
+    now[0] += 600
+    duty_cycle.record(15000)
+    #The first minute's airtime has to expire, an hour after that minute started
+    assert duty_cycle.delay_ms(2000) == (3600 - 30 - 600) * 1000
+    now[0] += 3600 - 600 - 30
+    assert duty_cycle.used_ms() == 15000
+    assert duty_cycle.delay_ms(2000) == 0
+
+def test_duty_cycle_frame_over_budget(now):
+    assert DutyCycle(1).delay_ms(40000) == 3600000
+
+def test_send_deferred_over_budget(make_lora, clock, now):
+    lora = make_lora(2, duty_cycle=0.001)
+    assert not lora.send(b'x' * 200, 1)
+    assert lora.tx_deferred == 1
+    assert lora.spi.frames == []
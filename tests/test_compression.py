@@ -0,0 +1,43 @@
+import pytest
+
+import LoRaCompression
+from LoRaCompression import compress, decompress, COMPRESSED_DICTIONARY
+
+SAMPLES = [
+    b"temperature 21.5,humidity 40,battery 3.9",
+    b"Recieved,2,LoRa Could not Contact",
+    b"rssi-100snr10.rssi-97snr8",
+    b"status ok,door open,alarm off,light on,pump off,tank level 0.5",
+    b"x",
+    b"",
+    bytes(range(256)),
+]
+
+@pytest.mark.parametrize("data", SAMPLES)
+def test_round_trip(data):
+    flag, encoded = compress(data)
+    if(flag == 0):
+        assert encoded == data
+    else:
+        assert len(encoded) < len(data)
+        assert bytes(decompress(flag, encoded)) == data
+
+def test_dictionary_shortens_known_words():
+    flag, encoded = compress(b"temperature 21.5,humidity 40")
+    assert flag == COMPRESSED_DICTIONARY
+    assert len(encoded) < 20
+
+def test_dictionary_leaves_binary_data_alone():
+    assert LoRaCompression.dictionary_encode(b"\x80abc") is None
+    assert compress(b"\x80\x81\x82") == (0, b"\x80\x81\x82")
+
+def test_every_dictionary_entry_round_trips():
+    for entry in LoRaCompression.STATIC_DICTIONARY:
+        assert bytes(LoRaCompression.dictionary_decode(LoRaCompression.dictionary_encode(entry))) == entry
+
+def test_dictionary_fits_the_token_range():
+    assert len(LoRaCompression.STATIC_DICTIONARY) <= 0x80
+
+def test_unknown_flag_raises():
+    with pytest.raises(ValueError):
+        decompress(0x60, b"abc")
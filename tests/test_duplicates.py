@@ -0,0 +1,75 @@
+import pytest
+
+from conftest import receive, tx_done
+from LoRa import FLAGS_ACK, REPLY_LATER
+
+@pytest.fixture
+def lora(make_lora, clock):
+    lora = make_lora(2)
+    lora.received = []
+    def on_recv(packet):
+        lora.received.append(packet.header_id)
+        return "r" + str(len(lora.received))
+    lora.on_recv = on_recv
+    return lora
+
+def frame(lora, header_id, header_from=1):
+    receive(lora, bytes((2, header_from, header_id, 0, 0)) + b'hi')
+    tx_done(lora)
+
+def acks(lora):
+    return [(frame[2], frame[5:]) for frame in lora.spi.frames if frame[3] == FLAGS_ACK]
+
+def test_retransmission_gets_cached_reply(lora, clock):
+    frame(lora, 5)
+    clock.advance(1000)
+    frame(lora, 5)
+    assert lora.received == [5]
+    assert acks(lora) == [(5, b'r1'), (5, b'r1')]
+    assert lora.duplicates == 1
+
+def test_same_id_from_other_node_is_new(lora, clock):
+    frame(lora, 5)
+    frame(lora, 5, header_from=3)
+    assert lora.received == [5, 5]
+
+def test_expires_after_ttl(lora, clock):
+    frame(lora, 5)
+    clock.advance(lora.duplicate_ttl * 1000 + 1)
+    frame(lora, 5)
+    assert lora.received == [5, 5]
+    assert acks(lora) == [(5, b'r1'), (5, b'r2')]
+
+def test_retransmission_refreshes_ttl(lora, clock):
+    frame(lora, 5)
+    for _ in range(3):
+        clock.advance(lora.duplicate_ttl * 1000 - 1)
+        frame(lora, 5)
+    assert lora.received == [5]
+
+def test_least_recently_used_is_evicted(lora, clock):
+    lora.duplicate_cache_size = 2
+    frame(lora, 1)
+    clock.advance(10)
+    frame(lora, 2)
+    clock.advance(10)
+    frame(lora, 1)
+    clock.advance(10)
+    frame(lora, 3)
+    assert len(lora._seen) == 2
+    clock.advance(10)
+    frame(lora, 1)
+    assert lora.received == [1, 2, 3]
+    frame(lora, 2)
+    assert lora.received == [1, 2, 3, 2]
+
+def test_retransmission_before_reply_is_ignored(lora, clock):
+    lora.on_recv = lambda packet: REPLY_LATER
+    frame(lora, 5)
+    frame(lora, 5)
+    assert acks(lora) == []
+    assert lora.answer(1, 5, "later")
+    assert acks(lora) == [(5, b'later')]
+    tx_done(lora)
+    frame(lora, 5)
+    assert acks(lora) == [(5, b'later'), (5, b'later')]
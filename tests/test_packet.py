@@ -0,0 +1,31 @@
+from conftest import receive
+from LoRa import Packet
+
+def packet(frame):
+    packet = Packet()
+    packet.buffer[:len(frame)] = bytes(frame)
+    packet.length = len(frame)
+    return packet
+
+def test_decode():
+    frame = packet([1, 2, 3, 0x81, 2, 4, 5, 104, 105])
+    assert frame.decode(433.3)
+    assert (frame.header_to, frame.header_from, frame.header_id, frame.header_flags) == (1, 2, 3, 0x81)
+    assert frame.relay_Addresses == [4, 5]
+    assert bytes(frame.message) == b'hi'
+
+def test_too_short_for_header():
+    assert not packet([1, 2, 3, 0]).decode(433.3)
+
+def test_relay_list_longer_than_frame():
+    assert not packet([1, 2, 3, 0, 253, 65]).decode(433.3)
+    assert not packet([1, 2, 3, 0, 2, 4]).decode(433.3)
+    assert packet([1, 2, 3, 0, 2, 4, 5]).decode(433.3)
+
+def test_bad_frame_does_not_stop_rx(make_lora, clock):
+    lora = make_lora(1)
+    frames = []
+    lora.on_frame = lambda packet: frames.append(packet.copy())
+    receive(lora, [1, 2, 3, 0, 253, 65])
+    receive(lora, [1, 2, 4, 0, 0, 104, 105])
+    assert [bytes(frame.message) for frame in frames] == [b'hi']
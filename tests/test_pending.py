@@ -0,0 +1,77 @@
+import pytest
+
+from conftest import receive, tx_done
+from LoRa import FLAGS_ACK, BROADCAST_ADDRESS
+
+@pytest.fixture
+def lora(make_lora, clock):
+    return make_lora(2)
+
+def ack(header_from, header_id, reply=b'ok'):
+    return bytes((2, header_from, header_id, FLAGS_ACK, 0)) + reply
+
+def start(lora, header_to, header_id, retries=3):
+    done = []
+    entry = lora.start_send(b'hello', header_to, retries=retries, header_id=header_id, on_done=done.append)
+    tx_done(lora)
+    return entry, done
+
+def test_several_sends_outstanding(lora, clock):
+    first, first_done = start(lora, 1, 5)
+    second, second_done = start(lora, 3, 6)
+    assert len(lora._pending) == 2
+    receive(lora, ack(3, 6, b'three'))
+    assert second_done == [second] and bytes(second.result.message) == b'three'
+    assert not first.done
+    receive(lora, ack(1, 5, b'one'))
+    assert first_done == [first] and bytes(first.result.message) == b'one'
+    assert lora._pending == {}
+
+def test_ack_from_wrong_node_is_ignored(lora, clock):
+    entry, done = start(lora, 1, 5)
+    receive(lora, ack(3, 5))
+    assert not entry.done
+
+def test_retries_then_gives_up(lora, clock):
+    entry, done = start(lora, 1, 5, retries=2)
+    for attempt in range(2, 4):
+        clock.now = entry.deadline
+        lora.poll_pending()
+        tx_done(lora)
+        assert entry.attempts == attempt
+    assert len(lora.spi.frames) == 3
+    clock.now = entry.deadline
+    lora.poll_pending()
+    assert done == [entry] and entry.result is None
+    assert lora._pending == {}
+
+def test_next_pending_ms(lora, clock):
+    assert lora.next_pending_ms(100) == 100
+    entry, done = start(lora, 1, 5)
+    assert lora.next_pending_ms(1000000) == entry.deadline - clock.now
+    clock.now = entry.deadline + 10
+    assert lora.next_pending_ms(100) == 0
+
+def test_same_key_replaces_pending(lora, clock):
+    first, first_done = start(lora, 1, 5)
+    second, second_done = start(lora, 1, 5)
+    assert first_done == [first] and first.result is None
+    assert lora._pending == {(1, 5): second}
+
+def test_broadcast_done_at_once(lora, clock):
+    entry, done = start(lora, BROADCAST_ADDRESS, 5)
+    assert done == [entry] and entry.result is True
+    assert lora._pending == {}
+
+def test_retry_waits_for_frame_on_air(lora, clock):
+    entry, done = start(lora, 1, 5)
+    clock.now = entry.deadline
+    lora.send(b'other', 3)
+    lora.poll_pending()
+    #Tried again once the other frame is off the air, without using up a retry
+    assert entry.attempts == 1 and len(lora.spi.frames) == 2
+    assert entry.deadline - clock.now == lora.tx_busy_ms()
+    tx_done(lora)
+    clock.now = entry.deadline
+    lora.poll_pending()
+    assert entry.attempts == 2 and len(lora.spi.frames) == 3
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+import PicoLogger
+from PicoLogger import LOG_RECORD_HEADER, LOG_INDEX_INTERVAL
+
+class FakeSerial():
+    def __init__(self):
+        self.lines = []
+
+    def Write(self, message, streamDataComplete = True):
+        if(message is not None):
+            self.lines.append(message)
+
+    def WriteFrame(self, payload):
+        self.lines.append(payload)
+
+@pytest.fixture
+def logger(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return PicoLogger.PicoLogger(FakeSerial(), binaryLog=True)
+
+def read_records(fileName):
+    #(time, category, node, text) of every record, the varint length decoded independently of PicoLogger
+    data = open(fileName, "rb").read()
+    records = []
+    position = 0
+    while position < len(data):
+        header = data[position:position + LOG_RECORD_HEADER]
+        position += LOG_RECORD_HEADER
+        length = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if(byte < 0x80):
+                break
+        records.append((int.from_bytes(header[:4], "big"), header[4], header[5], data[position:position + length].decode()))
+        position += length
+    return records
+
+def query(logger, fromTime, toTime, node = None):
+    logger.PicoSerial.lines = []
+    logger.SendQueryToSerial(fromTime, toTime, node)
+    lines = logger.PicoSerial.lines
+    return [line.split("\t", 1)[1].strip() for line in lines[:-1]], lines[-1]
+
+@pytest.mark.parametrize("length", [0, 1, 127, 128, 300, 16383, 16384, 20000])
+def test_varint_length_round_trip(logger, length):
+    logger._WriteLine(1000, 3, 7, "y" * length)
+    logger._CloseLogFile()
+    assert read_records("log.bin") == [(1000, 3, 7, "y" * length)]
+    size = LOG_RECORD_HEADER + (1 if length < 128 else 2 if length < 16384 else 3) + length
+    assert os.stat("log.bin")[6] == size
+
+def test_records_keep_time_category_and_node(logger):
+    logger._WriteLine(1, 0, 0, "first")
+    logger._WriteLine(0x12345678, 5, 255, "second")
+    logger._CloseLogFile()
+    assert read_records("log.bin") == [(1, 0, 0, "first"), (0x12345678, 5, 255, "second")]
+
+def test_index_has_an_entry_per_interval(logger):
+    for second in range(1000, 1300):
+        logger._WriteLine(second, 1, 1, "x" * 100)
+    logger._CloseLogFile()
+    index = open("log.idx", "rb").read()
+    entries = [(int.from_bytes(index[i:i + 4], "big"), int.from_bytes(index[i + 4:i + 8], "big")) for i in range(0, len(index), 8)]
+    assert entries[0] == (1000, 0)
+    for previous, entry in zip(entries, entries[1:]):
+        assert entry[1] - previous[1] >= LOG_INDEX_INTERVAL
+    #every entry points at the start of a record logged at that time
+    data = open("log.bin", "rb").read()
+    for loggedTime, offset in entries:
+        assert int.from_bytes(data[offset:offset + 4], "big") == loggedTime
+
+def test_start_offset_is_before_every_record_of_from_time(logger):
+    #Three records a second, so seconds straddle index entries
+    for second in range(1000, 1400):
+        for count in range(3):
+            logger._WriteLine(second, 1, 1, "%d-%d" % (second, count) + "x" * 30)
+    logger._CloseLogFile()
+    data = open("log.bin", "rb").read()
+    for second in range(1000, 1400, 7):
+        offset = logger._StartOffset("log.bin", second)
+        assert offset == 0 or int.from_bytes(data[offset:offset + 4], "big") < second
+    for second in (1100, 1200, 1300):
+        lines, done = query(logger, second, second)
+        assert [line[:len(str(second)) + 2] for line in lines] == ["%d-%d" % (second, count) for count in range(3)]
+        assert done == "0,QueryLog,3"
+
+def test_query_filters_by_node(logger):
+    for second in range(1000, 1010):
+        logger._WriteLine(second, 1, second % 2, str(second))
+    logger._CloseLogFile()
+    lines, done = query(logger, 1002, 1005, 1)
+    assert lines == ["1003", "1005"]
+    assert done == "0,QueryLog,2"
+
+def test_query_finds_records_after_the_clock_went_back(logger):
+    logger._WriteLine(2000, 1, 1, "before")
+    logger._WriteLine(3000, 1, 1, "after range")
+    logger._WriteLine(2000, 1, 1, "clock set back")
+    lines, done = query(logger, 1500, 2500)
+    assert lines == ["before", "clock set back"]
+
+def test_query_needs_the_binary_log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    logger = PicoLogger.PicoLogger(FakeSerial())
+    logger.SendQueryToSerial(0, 10)
+    assert logger.PicoSerial.lines == ["1,QueryLog,Binary log is off"]
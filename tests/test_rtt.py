@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import receive, tx_done
+from LoRa import FLAGS_ACK
+
+PEER = 1
+
+def ack(header_id, reply=b'ok'):
+    return bytes((2, PEER, header_id, FLAGS_ACK, 0)) + reply
+
+@pytest.fixture
+def lora(make_lora, clock):
+    return make_lora(2)
+
+def send(lora, clock, header_id, attempts):
+    #Acked after attempts transmissions, returns the entry
+    entry = lora.start_send(b'hello', PEER, header_id=header_id)
+    tx_done(lora)
+    for _ in range(attempts - 1):
+        clock.now = entry.deadline
+        lora.poll_pending()
+        tx_done(lora)
+    clock.advance(50)
+    receive(lora, ack(header_id))
+    assert entry.done and entry.attempts == attempts
+    return entry
+
+def test_smoothing(lora):
+    lora._sample_rtt(PEER, 400)
+    assert lora._rtt[PEER] == [400, 200, 1]
+    lora._sample_rtt(PEER, 600)
+    assert lora._rtt[PEER] == [425, 200, 2]
+    assert lora.rtt_stats() == "1:425/200/2"
+
+def test_timeout_before_and_after_measuring(lora):
+    airtime = int(2 * lora.airtime_ms(10))
+    assert lora.retransmission_timeout_ms(PEER, 10) == airtime + int(lora.retry_timeout * 1000)
+    lora._sample_rtt(PEER, 400)
+    assert lora.retransmission_timeout_ms(PEER, 10) == max(400 + 4 * 200, airtime)
+
+def test_first_try_is_sampled(lora, clock):
+    send(lora, clock, 5, 1)
+    assert lora._rtt[PEER] == [50, 25, 1]
+
+def test_retried_send_is_not_sampled_but_keeps_backoff(lora, clock):
+    timeout = lora.retransmission_timeout_ms(PEER, 10)
+    send(lora, clock, 5, 3)
+    assert PEER not in lora._rtt
+    assert lora.retransmission_timeout_ms(PEER, 10) == timeout << 2
+
+    #The next send waits the backed off timeout, its first try gets answered and clears the backoff
+    entry = lora.start_send(b'hello', PEER, header_id=6)
+    assert entry.deadline - clock.now >= timeout << 2
+    tx_done(lora)
+    clock.advance(1500)
+    receive(lora, ack(6))
+    assert entry.attempts == 1
+    assert lora._rtt[PEER] == [1500, 750, 1]
+    assert lora.retransmission_timeout_ms(PEER, 10) == 1500 + 4 * 750
@@ -0,0 +1,101 @@
+import utime
+
+import Serial
+from Serial import crc16, FrameReader, FRAME_START, TEXT_IDLE_MS
+
+def frame(payload):
+    header = bytes((FRAME_START, len(payload) >> 8, len(payload) & 0xff))
+    crc = crc16(header[1:] + payload)
+    return header + payload + bytes((crc >> 8, crc & 0xff))
+
+def feed(reader, data):
+    reader.Free()[:len(data)] = data
+    reader.Received(len(data))
+
+def messages(reader):
+    found = []
+    message = reader.NextMessage()
+    while message is not None:
+        found.append(message)
+        message = reader.NextMessage()
+    return found
+
+def test_crc16_check_value():
+    #CRC-16/CCITT-FALSE check value
+    assert crc16(b"123456789") == 0x29B1
+    assert crc16(b"") == 0xffff
+
+def test_crc16_continues_from_a_previous_crc():
+    assert crc16(b"56789", crc16(b"1234")) == crc16(b"123456789")
+
+def test_lines_are_split_on_any_line_end():
+    reader = FrameReader()
+    feed(reader, b"Send,2,a\nGetQueue\r\n\r\nGetStats\r")
+    assert messages(reader) == ["Send,2,a", "GetQueue", "GetStats"]
+    assert reader.length == 0
+
+def test_unterminated_text_waits_for_the_line_to_go_quiet():
+    reader = FrameReader()
+    feed(reader, b"GetConfig")
+    assert reader.NextMessage() is None
+    reader.lastReceived = utime.ticks_add(utime.ticks_ms(), -TEXT_IDLE_MS)
+    assert reader.NextMessage() == "GetConfig"
+
+def test_frames_and_text_mixed():
+    reader = FrameReader()
+    feed(reader, b"GetQueue\n" + frame(b"Send,2,a\nb") + b"GetStats\n")
+    assert messages(reader) == ["GetQueue", "Send,2,a\nb", "GetStats"]
+
+def test_frame_split_over_reads():
+    reader = FrameReader()
+    data = frame(b"Send,3,hello")
+    feed(reader, data[:4])
+    assert reader.NextMessage() is None
+    feed(reader, data[4:])
+    assert reader.NextMessage() == "Send,3,hello"
+
+def test_bad_crc_is_dropped_up_to_the_next_line():
+    reader = FrameReader()
+    bad = bytearray(frame(b"Send,2,a"))
+    bad[-1] ^= 0xff
+    feed(reader, bytes(bad) + b"garbage\nGetQueue\n")
+    assert messages(reader) == ["GetQueue"]
+    assert reader.badFrames == 1
+
+def test_frame_longer_than_the_buffer_is_bad():
+    reader = FrameReader(size=64)
+    feed(reader, bytes((FRAME_START, 0x01, 0x00)) + b"x\nGetQueue\n")
+    assert messages(reader) == ["GetQueue"]
+    assert reader.badFrames == 1
+
+def test_full_buffer_without_line_end_is_dropped():
+    reader = FrameReader(size=32)
+    feed(reader, b"x" * 32)
+    assert reader.NextMessage() is None
+    assert reader.length == 0
+    assert reader.badFrames == 1
+    feed(reader, b"GetQueue\n")
+    assert messages(reader) == ["GetQueue"]
+
+def test_invalid_utf8_is_counted_and_skipped():
+    reader = FrameReader()
+    feed(reader, b"\xff\xfe\nGetQueue\n")
+    assert messages(reader) == ["GetQueue"]
+    assert reader.badFrames == 1
+
+def test_write_frame_matches_the_input_framing():
+    serial = Serial.PicoSerial()
+    serial.stdoutBuffer = type("Sink", (), {"write": lambda self, data: None})()
+    serial.WriteFrame(b"GetTrace,\x00\x01")
+    assert bytes(serial.uart.written) == frame(b"GetTrace,\x00\x01")
+    assert not serial.writing
+
+def test_write_batch_is_one_line_per_message_behind_one_enable():
+    serial = Serial.PicoSerial()
+    serial.stdoutBuffer = type("Sink", (), {"write": lambda self, data: None})()
+    raised = []
+    serial.pinSerialWrite.high = lambda: raised.append(1)
+    serial.WriteBatch(["0,a", "b\r\n", b"c"])
+    assert bytes(serial.uart.written) == b"0,a\r\nb\r\nc"
+    assert raised == [1]
+    assert not serial.writing
@@ -0,0 +1,72 @@
+import pytest
+
+from conftest import receive, tx_done
+import LoRaTransfer
+from LoRa import FLAGS_FRAGMENT, FLAGS_FRAGMENT_ACK
+from LoRaTransfer import FRAGMENT_SIZE, FRAGMENT_FINAL, FRAGMENT_POLL
+
+SENDER = 1
+RECEIVER = 2
+TRANSFER_ID = 7
+
+def fragment(seq, data, control=0):
+    return bytes((RECEIVER, SENDER, TRANSFER_ID, FLAGS_FRAGMENT, 0, seq >> 8, seq & 0xff, control)) + data
+
+@pytest.fixture
+def receiver(make_lora, clock):
+    lora = make_lora(RECEIVER)
+    transfer = LoRaTransfer.LoRaTransfer(lora)
+    transfer.completed = []
+    transfer.on_complete = lambda address, transfer_id, message, error: transfer.completed.append((address, transfer_id, message, error))
+    return lora, transfer
+
+def sacks(lora):
+    #(base, received bitmap) of every fragment ack sent
+    return [((frame[5] << 8) | frame[6], frame[7]) for frame in lora.spi.frames if frame[3] == FLAGS_FRAGMENT_ACK]
+
+def test_assembles_message(receiver, clock):
+    lora, transfer = receiver
+    receive(lora, fragment(0, b'a' * FRAGMENT_SIZE))
+    receive(lora, fragment(1, b'bc', FRAGMENT_FINAL | FRAGMENT_POLL))
+    assert transfer.completed == [(SENDER, TRANSFER_ID, b'a' * FRAGMENT_SIZE + b'bc', None)]
+    assert sacks(lora) == [(0, 0xff)]
+
+def test_missing_fragment_is_asked_for(receiver, clock):
+    lora, transfer = receiver
+    receive(lora, fragment(1, b'bc', FRAGMENT_FINAL | FRAGMENT_POLL))
+    assert sacks(lora) == [(0, 0x02)]
+    assert transfer.completed == []
+
+def test_lost_final_ack_after_long_transfer(receiver, clock):
+    #The transfer runs longer than idle_timeout and its final ack gets lost, the sender's poll is acked again
+    lora, transfer = receiver
+    receive(lora, fragment(0, b'a' * FRAGMENT_SIZE))
+    clock.advance(transfer.idle_timeout - 1000)
+    transfer.poll()
+    receive(lora, fragment(1, b'bc', FRAGMENT_FINAL | FRAGMENT_POLL))
+    tx_done(lora)
+    assert len(transfer.completed) == 1
+
+    clock.advance(5000)
+    transfer.poll()
+    receive(lora, fragment(1, b'bc', FRAGMENT_FINAL | FRAGMENT_POLL))
+    tx_done(lora)
+    assert sacks(lora) == [(0, 0xff), (0, 0xff)]
+
+    clock.advance(transfer.idle_timeout + 1000)
+    transfer.poll()
+    assert transfer.completed == [(SENDER, TRANSFER_ID, b'a' * FRAGMENT_SIZE + b'bc', None)]
+
+def test_ack_waits_for_frame_on_air(make_lora, clock):
+    #Both polls come out of the rx ring in one go, the second ack goes out once the first is done
+    lora = make_lora(RECEIVER, deferred_rx=True)
+    LoRaTransfer.LoRaTransfer(lora)
+    receive(lora, fragment(0, b'a' * FRAGMENT_SIZE, FRAGMENT_POLL))
+    receive(lora, fragment(1, b'bc', FRAGMENT_FINAL | FRAGMENT_POLL))
+    lora.process_rx()
+    assert sacks(lora) == [(0, 0x01)]
+    lora.poll_pending()
+    assert sacks(lora) == [(0, 0x01)]
+    tx_done(lora)
+    lora.poll_pending()
+    assert sacks(lora) == [(0, 0x01), (0, 0xff)]
@@ -0,0 +1,124 @@
+"""
+Turns a GetTrace dump from a node into a timeline. Runs on the host, not on the Pico.
+
+    python tools/trace_timeline.py capture.bin
+    python tools/trace_timeline.py --port /dev/ttyUSB0 [--baud 38400]   (needs pyserial)
+
+capture.bin is anything read from the node's serial port after sending GetTrace, text lines around
+the frame are skipped. Start tracing on the node first with SetTrace,1.
+"""
+import argparse
+import struct
+import sys
+import time
+
+FRAME_START = 0x02
+TICKS_PERIOD = 1 << 30 #time.ticks_us wraps here on the rp2
+
+EVENTS = {1: "MODE", 2: "IRQ_ENTER", 3: "IRQ_EXIT", 4: "FIFO_READ", 5: "SEND", 6: "ACK_MATCH", 7: "RETRY", 8: "ACK_TIMEOUT"}
+MODES = {0x00: "sleep", 0x01: "standby", 0x03: "tx", 0x05: "rx", 0x07: "cad"}
+IRQ_FLAGS = ((0x40, "rx_done"), (0x20, "crc_error"), (0x08, "tx_done"), (0x04, "cad_done"), (0x01, "cad_detected"))
+
+
+def crc16(data, crc=0xffff):
+    #CRC-16/CCITT-FALSE, same as Serial.crc16 on the node
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+    return crc
+
+
+def frames(data):
+    #Payloads of every intact frame in data
+    position = 0
+    while True:
+        position = data.find(bytes((FRAME_START,)), position)
+        if position == -1 or position + 5 > len(data):
+            return
+        length = (data[position + 1] << 8) | data[position + 2]
+        end = position + 3 + length
+        if end + 2 <= len(data) and crc16(data[position + 1:end]) == (data[end] << 8) | data[end + 1]:
+            yield data[position + 3:end]
+            position = end + 2
+        else:
+            position += 1
+
+
+def events(dump):
+    count = struct.unpack_from(">H", dump, 0)[0]
+    for i in range(count):
+        yield struct.unpack_from(">LBH", dump, 2 + i * 7)
+
+
+def describe(event, value):
+    if event in (1, 2):
+        return MODES.get(value, hex(value))
+    if event == 3:
+        return ",".join(name for flag, name in IRQ_FLAGS if value & flag) or hex(value)
+    if event == 7:
+        return "to %d attempt %d" % (value >> 8, value & 0xff)
+    if event == 8:
+        return "to %d" % value
+    return str(value)
+
+
+def timeline(dump, out=sys.stdout):
+    #time since the first event, time since the previous one, event, value; IRQ_EXIT also shows the time in the handler
+    first = previous = None
+    irq_start = None
+    for ticks, event, value in events(dump):
+        if first is None:
+            first = previous = ticks
+        since_start = (ticks - first) % TICKS_PERIOD
+        since_previous = (ticks - previous) % TICKS_PERIOD
+        line = "%12d us  +%9d us  %-11s %s" % (since_start, since_previous, EVENTS.get(event, str(event)), describe(event, value))
+        if event == 2:
+            irq_start = ticks
+        elif event == 3 and irq_start is not None:
+            line += "  (isr %d us)" % ((ticks - irq_start) % TICKS_PERIOD)
+            irq_start = None
+        out.write(line + "\n")
+        previous = ticks
+
+
+def read_port(port, baud, timeout):
+    import serial
+    with serial.Serial(port, baud, timeout=0.1) as connection:
+        connection.reset_input_buffer()
+        connection.write(b"GetTrace\n")
+        data = bytearray()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            data += connection.read(4096)
+            for payload in frames(bytes(data)):
+                if payload.startswith(b"GetTrace,"):
+                    return bytes(data)
+        return bytes(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", nargs="?", help="bytes read from the node after GetTrace")
+    parser.add_argument("--port", help="serial port to ask the node directly")
+    parser.add_argument("--baud", type=int, default=38400)
+    parser.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+    if args.port:
+        data = read_port(args.port, args.baud, args.timeout)
+    elif args.capture:
+        with open(args.capture, "rb") as capture:
+            data = capture.read()
+    else:
+        parser.error("give a capture file or --port")
+
+    for payload in frames(data):
+        if payload.startswith(b"GetTrace,"):
+            timeline(payload[len(b"GetTrace,"):])
+            return 0
+    sys.stderr.write("No GetTrace frame found\n")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())